@@ -0,0 +1,69 @@
+# =============================================================================
+# 【起動時間ベンチマーク】
+# main.py の読み込み時間（コールドスタートに相当）を測定するためのスクリプト
+#
+# 使い方:
+#   cd functions
+#   python benchmark_startup.py            # 10回測定して中央値などを表示
+#   python benchmark_startup.py --runs 30  # 測定回数を指定
+#   python benchmark_startup.py --eager    # 比較用：重いライブラリも同時に読み込む
+#
+# 毎回新しいPythonプロセスで読み込むため、実際のコールドスタートに近い値になります
+# 詳しい内訳は `python -X importtime -c "import main"` でも確認できます
+# =============================================================================
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# 子プロセスで実行するコード（読み込み時間を標準出力に書き出す）
+LAZY_SNIPPET = (
+    "import time; t = time.perf_counter(); import main; "
+    "print(time.perf_counter() - t)"
+)
+EAGER_SNIPPET = (
+    "import time; t = time.perf_counter(); import main; "
+    "import requests, google.generativeai; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def measure(snippet, runs):
+    """
+    新しいプロセスで snippet を runs 回実行し、読み込み時間（秒）のリストを返す
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env.pop("WARMUP_ON_START", None)  # 測定中はウォームアップを無効にする
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", snippet],
+            cwd=here, env=env, capture_output=True, text=True, check=True
+        )
+        timings.append(float(out.stdout.strip().splitlines()[-1]))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="main.py の起動時間を測定します")
+    parser.add_argument("--runs", type=int, default=10, help="測定回数")
+    parser.add_argument("--eager", action="store_true", help="重いライブラリも読み込んだ場合と比較する")
+    args = parser.parse_args()
+
+    targets = [("lazy", LAZY_SNIPPET)]
+    if args.eager:
+        targets.append(("eager", EAGER_SNIPPET))
+
+    for label, snippet in targets:
+        timings = measure(snippet, args.runs)
+        print(
+            f"{label:>5}: 中央値 {statistics.median(timings) * 1000:.1f} ms / "
+            f"最小 {min(timings) * 1000:.1f} ms / 最大 {max(timings) * 1000:.1f} ms "
+            f"({args.runs}回)"
+        )
+
+
+if __name__ == "__main__":
+    main()
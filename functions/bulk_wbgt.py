@@ -0,0 +1,252 @@
+# =============================================================================
+# 【過去データの一括WBGT計算】
+# 保存しておいたアメダスの観測データ（CSV / JSON Lines）から、暑さ指数(WBGT)と
+# 年齢グループ別の危険レベル・子どもの体感気温をまとめて計算するスクリプト
+#
+# 使い方:
+#   cd functions
+#   python bulk_wbgt.py archive.csv --out result.csv
+#   python bulk_wbgt.py archive.jsonl --out result.jsonl --workers 8 --chunk-size 20000
+#   python bulk_wbgt.py archive.csv.gz --out - > result.csv      # gzip 圧縮の入力・標準出力への書き出し
+#   python bulk_wbgt.py amedas_map_dir/ --out result.csv          # 気象庁の全国データ（{時刻}.json）を保存したディレクトリ
+#   python bulk_wbgt.py archive.csv --format parquet --out wbgt_parquet/  # 日付ごとの Parquet（columnar_export.py）
+#
+# 入力の列（CSVの見出し / JSONのキー）:
+#   time, station_id, temperature, humidity, wind_speed, solar_radiation
+#   気象庁の形式（temp, humidity, wind, sun1h。値は [値, 品質] でも可）も読み込めます
+#   ディレクトリを指定した場合は、中の {YYYYMMDDHHMMSS}.json（気象庁の map 形式）を時刻順に読み込みます
+#
+# 出力の列:
+#   入力の time, station_id, 気象値 + wbgt + 年齢グループごとの
+#   risk_{年齢}（危険レベル）, child_min_{年齢}, child_max_{年齢}（体感気温）
+#   + ground_normal, ground_asphalt（地面・アスファルトの温度）
+#
+# 入力を chunk-size 行ずつ読み込み、プロセスプールで並列に計算して順番通りに書き出すため、
+# ファイルの大きさに関わらずメモリ使用量は一定です。最後に1秒あたりの処理行数を表示します
+# =============================================================================
+import argparse
+import concurrent.futures
+import csv
+import gzip
+import itertools
+import json
+import os
+import sys
+import time
+
+import main
+
+AGE_GROUPS = ["0-1", "2-3", "4-6"]
+INPUT_FIELDS = ["time", "station_id", "temperature", "humidity", "wind_speed", "solar_radiation"]
+OUTPUT_FIELDS = INPUT_FIELDS + ["wbgt"] + [
+    f"{name}_{group}" for group in AGE_GROUPS for name in ("risk", "child_min", "child_max")
+] + ["ground_normal", "ground_asphalt"]
+
+# 気象庁の形式のキー → このスクリプトで使う名前
+FIELD_ALIASES = {"temp": "temperature", "wind": "wind_speed", "sun1h": "solar_radiation"}
+
+
+def open_text(path, mode):
+    """
+    ファイルをテキストとして開く（"-" は標準入出力、.gz は gzip として扱う）
+    """
+    if path == "-":
+        return sys.stdin if "r" in mode else sys.stdout
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def is_jsonl(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    return name.endswith((".jsonl", ".ndjson"))
+
+
+def read_map_directory(directory):
+    """
+    気象庁の全国データ（1ファイル = 1観測時刻の {観測所ID: 観測値}）を時刻順に1観測所ずつ読み込む
+    （メモリに載るのは1ファイル分だけ）
+    """
+    for name in sorted(os.listdir(directory)):
+        stem = name.split(".")[0]
+        if not (stem.isdigit() and name.endswith((".json", ".json.gz"))):
+            continue
+        f = open_text(os.path.join(directory, name), "r")
+        try:
+            stations = json.load(f)
+        finally:
+            f.close()
+        for station_id, station_data in stations.items():
+            yield {"time": stem, "station_id": station_id, **station_data}
+
+
+def read_rows(path):
+    """
+    入力ファイルを1行ずつ辞書として読み込む（全体をメモリに載せない）
+    """
+    if os.path.isdir(path):
+        yield from read_map_directory(path)
+        return
+    f = open_text(path, "r")
+    try:
+        if is_jsonl(path):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def to_number(value):
+    """
+    数値に変換する（気象庁の [値, 品質] 形式・空文字・変換できない値にも対応）
+    """
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compute_chunk(rows):
+    """
+    【機能説明】
+    1チャンク分の行について暑さ指数と年齢グループ別の判定を計算する（子プロセスで実行）
+
+    【出力データ】
+    OUTPUT_FIELDS の順に並んだ値のリストの一覧
+    """
+    observations = []
+    for row in rows:
+        normalized = {FIELD_ALIASES.get(k, k): v for k, v in row.items()}
+        observations.append({
+            "time": normalized.get("time"),
+            "station_id": normalized.get("station_id"),
+            "temperature": to_number(normalized.get("temperature")),
+            "humidity": to_number(normalized.get("humidity")),
+            "wind_speed": to_number(normalized.get("wind_speed")),
+            "solar_radiation": to_number(normalized.get("solar_radiation")),
+        })
+
+    wbgts = [
+        main.calculate_wbgt(o["temperature"], o["humidity"], o["wind_speed"], o["solar_radiation"])
+        for o in observations
+    ]
+    levels = {group: main.classify_wbgt_batch(wbgts, group) for group in AGE_GROUPS}
+
+    results = []
+    for position, (o, wbgt) in enumerate(zip(observations, wbgts)):
+        out = [o[name] for name in INPUT_FIELDS] + [wbgt]
+        ground = (None, None)
+        for group in AGE_GROUPS:
+            level_index = levels[group][position]
+            child_min, child_max, ground_normal, ground_asphalt, _ = main.calculate_child_temperatures(o["temperature"], group)
+            out += [None if level_index is None else main.RISK_LEVELS[level_index], child_min, child_max]
+            ground = (ground_normal, ground_asphalt)
+        results.append(out + list(ground))
+    return results
+
+
+def chunked(rows, size):
+    iterator = iter(rows)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_stream(chunks, workers):
+    """
+    チャンクを並列に計算し、入力と同じ順番で結果を返す
+    先読みするチャンク数を workers * 2 までに抑えて、メモリ使用量を一定にする
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(compute_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+class ResultWriter:
+    """
+    計算結果を CSV / JSON Lines / Parquet（日付ごとのディレクトリ）で少しずつ書き出す
+    """
+
+    def __init__(self, path, output_format=None):
+        self.path = path
+        self.columnar = None
+        self.csv = None
+        self.file = None
+        if output_format == "parquet":
+            from columnar_export import ColumnarWriter  # pyarrow が必要な時だけ読み込む
+            self.columnar = ColumnarWriter(path, OUTPUT_FIELDS)
+            return
+        self.jsonl = output_format == "jsonl" or (output_format is None and is_jsonl(path))
+        self.file = open_text(path, "w")
+        self.csv = None if self.jsonl else csv.writer(self.file)
+        if self.csv:
+            self.csv.writerow(OUTPUT_FIELDS)
+
+    def write(self, results):
+        if self.columnar:
+            self.columnar.write(results)
+        elif self.csv:
+            self.csv.writerows(results)
+        else:
+            self.file.write("".join(
+                json.dumps(dict(zip(OUTPUT_FIELDS, r)), ensure_ascii=False) + "\n" for r in results
+            ))
+
+    def close(self):
+        if self.columnar:
+            self.columnar.close()
+        elif self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="過去のアメダスデータから暑さ指数と年齢別の危険レベルを一括計算します")
+    parser.add_argument("input", help="入力ファイル（.csv / .jsonl、.gz 可。\"-\" で標準入力のCSV）または気象庁の全国データのディレクトリ")
+    parser.add_argument("--out", default="-", help="出力ファイル（.csv / .jsonl、.gz 可。既定は標準出力）。parquet の場合はディレクトリ")
+    parser.add_argument("--format", choices=["csv", "jsonl", "parquet"], help="出力形式（省略時は --out の拡張子から判断）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="並列に計算するプロセス数")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="1回に読み込む行数")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rows_done = 0
+    if args.format == "parquet" and args.out == "-":
+        parser.error("parquet の場合は --out に出力先のディレクトリを指定してください")
+    writer = ResultWriter(args.out, args.format)
+    try:
+        for results in process_stream(chunked(read_rows(args.input), args.chunk_size), args.workers):
+            writer.write(results)
+            rows_done += len(results)
+            elapsed = time.perf_counter() - started
+            print(f"\r{rows_done}行 処理済み（{rows_done / elapsed:,.0f} 行/秒）", end="", file=sys.stderr)
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"\n完了: {rows_done}行 / {elapsed:.2f}秒 / {rows_done / elapsed if elapsed else 0:,.0f} 行/秒"
+        f"（プロセス数 {args.workers}、チャンク {args.chunk_size}行）",
+        file=sys.stderr
+    )
+
+
+if __name__ == "__main__":
+    main_cli()
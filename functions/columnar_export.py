@@ -0,0 +1,178 @@
+# =============================================================================
+# 【列指向形式（Parquet）での書き出し】
+# 観測所ごとの暑さ指数(WBGT)・年齢グループ別の危険レベル・子どもの体感気温・地面の温度を
+# 日付ごとに分けた Parquet ファイルに書き出します（集計・分析用）
+#
+# 書き出し先の構成（Hive 形式のパーティション）:
+#   {出力先}/date=2025-08-01/part-xxxxxxxx.parquet
+#   {出力先}/date=2025-08-02/part-xxxxxxxx.parquet
+#
+# - 観測所IDと危険レベルは辞書エンコード（同じ文字列を番号で持つ）して容量を抑える
+#   辞書は全ファイル共通（危険レベルは RISK_LEVELS、観測所IDは amedas_id.json の順）のため、
+#   複数のファイルをまとめて集計しても辞書の統合が不要
+# - ファイルは一時ファイル経由で置き換えるため、書き込み途中のファイルは読まれない
+#
+# pyarrow は読み込みに時間がかかり、関数の実行には不要なため、使う時に読み込みます
+# （requirements.txt には含めていません。使う場合は `pip install pyarrow`）
+#
+# 使い方:
+#   python bulk_wbgt.py archive.csv --format parquet --out wbgt_parquet/
+#   python export_static_risk.py --parquet wbgt_parquet/
+# =============================================================================
+import os
+import tempfile
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import main
+
+JST = timezone(timedelta(hours=9))
+ROWS_PER_FILE = 200000  # 1ファイルあたりの最大行数（これを超えたら次のファイルに書く）
+
+_pyarrow = None
+
+
+def get_pyarrow():
+    """
+    pyarrow を初めて使う時に読み込む（入っていなければ分かりやすいエラーにする）
+    """
+    global _pyarrow
+    if _pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise RuntimeError("Parquet で書き出すには pyarrow が必要です（pip install pyarrow）") from e
+        _pyarrow = pyarrow
+    return _pyarrow
+
+
+def parse_time(value):
+    """
+    観測時刻を日時に変換する（ISO 形式、または気象庁の YYYYMMDDHHMMSS 形式（日本時間））
+    変換できない場合は None
+    """
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=JST)
+    if not value:
+        return None
+    value = str(value)
+    try:
+        if value.isdigit() and len(value) == 14:
+            return datetime.strptime(value, "%Y%m%d%H%M%S").replace(tzinfo=JST)
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=JST)
+    except ValueError:
+        return None
+
+
+def column_type(name):
+    """
+    列名から Parquet の型を決める
+    """
+    pa = get_pyarrow()
+    if name == "time":
+        return pa.timestamp("s", tz="Asia/Tokyo")
+    if name == "station_id":
+        return pa.dictionary(pa.int32(), pa.string())
+    if name.startswith("risk_"):
+        return pa.dictionary(pa.int8(), pa.string())
+    return pa.float32()
+
+
+class ColumnarWriter:
+    """
+    行を日付ごとに貯めて、一定の行数ごとに Parquet ファイルとして書き出す
+    （メモリに持つのは書き出し前の行だけ）
+    """
+
+    def __init__(self, root, fields, rows_per_file=ROWS_PER_FILE):
+        pa = get_pyarrow()
+        self.root = root
+        self.fields = list(fields)
+        self.rows_per_file = rows_per_file
+        self.schema = pa.schema([(name, column_type(name)) for name in self.fields])
+        self._time_index = self.fields.index("time")
+        self._buffers = {}  # 日付 → 列ごとの値のリスト
+        self._station_ids = sorted(s["id"] for s in main.load_amedas_stations())
+        self.files_written = 0
+        self.rows_written = 0
+
+    def write(self, rows):
+        """
+        fields の順に値が並んだ行の一覧を追加する
+        """
+        for row in rows:
+            row = list(row)
+            observed = parse_time(row[self._time_index])
+            row[self._time_index] = observed
+            partition = observed.astimezone(JST).strftime("%Y-%m-%d") if observed else "unknown"
+            columns = self._buffers.get(partition)
+            if columns is None:
+                columns = self._buffers[partition] = [[] for _ in self.fields]
+            for column, value in zip(columns, row):
+                column.append(value)
+            if len(columns[0]) >= self.rows_per_file:
+                self._flush(partition)
+
+    def _flush(self, partition):
+        columns = self._buffers.pop(partition, None)
+        if not columns or not columns[0]:
+            return
+        pa = get_pyarrow()
+        arrays = []
+        for field, values in zip(self.schema, columns):
+            if field.name.startswith("risk_"):
+                arrays.append(self._encode(values, main.RISK_LEVELS, field.type))
+            elif field.name == "station_id":
+                arrays.append(self._encode(values, self._station_ids, field.type))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+
+        directory = os.path.join(self.root, f"date={partition}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{uuid.uuid4().hex[:12]}.parquet")
+        # 名前が "." で始まる一時ファイルは、多くの読み込みツールで無視される
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.parquet')
+        os.close(fd)
+        try:
+            pa.parquet.write_table(table, tmp_path, compression="zstd", use_dictionary=True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.files_written += 1
+        self.rows_written += table.num_rows
+
+    @staticmethod
+    def _encode(values, dictionary, dictionary_type):
+        """
+        共通の辞書（dictionary）の番号で辞書エンコードする
+        辞書に無い値（一覧に無い観測所など）は、このファイルだけ辞書の末尾に追加する
+        """
+        pa = get_pyarrow()
+        positions = {value: index for index, value in enumerate(dictionary)}
+        extra = []
+        indices = []
+        for value in values:
+            if value is None:
+                indices.append(None)
+                continue
+            index = positions.get(value)
+            if index is None:
+                index = positions[value] = len(dictionary) + len(extra)
+                extra.append(value)
+            indices.append(index)
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, type=dictionary_type.index_type),
+            pa.array(list(dictionary) + extra, type=dictionary_type.value_type)
+        )
+
+    def close(self):
+        """
+        残っている行を全て書き出す
+        """
+        for partition in list(self._buffers):
+            self._flush(partition)
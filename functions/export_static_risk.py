@@ -0,0 +1,203 @@
+# =============================================================================
+# 【観測所別リスクデータの静的書き出し】
+# アメダスのスナップショットごとに、全観測所の暑さ指数(WBGT)と年齢グループ別の
+# 危険レベル・アドバイス（決まった手順で作成）を JSON ファイルに書き出すスクリプト
+#
+# 書き出し先（既定）:
+#   public/data/risk/{station_id}.json  … 観測所ごとの判定結果
+#   public/data/risk/manifest.json      … 観測時刻と観測所の一覧（最後に書き込む）
+#
+# Firebase Hosting で配信すれば、「自分の観測所の今の危険度」は
+# Cloud Function を呼ばずに CDN から返せます
+#
+# 使い方:
+#   cd functions
+#   python export_static_risk.py                       # 最新のスナップショットを1回書き出す
+#   python export_static_risk.py --watch               # 新しいスナップショットが来るたびに書き出す
+#   python export_static_risk.py --stations 44132,44071 --out /tmp/risk
+#   python export_static_risk.py --watch --parquet wbgt_parquet/  # 分析用の Parquet にも追記（columnar_export.py）
+#
+# 各ファイルは一時ファイル経由で置き換えるため、途中の状態が配信されることはありません
+# 新しいスナップショットに含まれない観測所のファイルは、manifest.json を置き換えた後に削除します
+# （古い観測値が長いキャッシュ時間のまま配信され続けないようにする）
+# manifest.json の snapshot_time が同じ場合は書き出しを省略します（--force で強制）
+# =============================================================================
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import main
+
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public', 'data', 'risk')
+AGE_GROUPS = ["0-1", "2-3", "4-6"]
+
+
+def render_station_files(snapshot, station_ids=None):
+    """
+    【機能説明】
+    スナップショットから観測所ごとの判定結果を作る
+
+    【入力データ】
+    snapshot : {"latest": 観測時刻, "data": 全観測所データ}
+    station_ids : 書き出す観測所IDの集合（None なら観測値のある全観測所）
+
+    【出力データ】
+    {観測所ID: 観測所ファイルの内容}
+    """
+    snapshot_time = main.format_jst(snapshot["latest"])
+    names = {s["id"]: s["name"] for s in main.load_amedas_stations()}
+
+    # ステップ1: 観測所ごとに暑さ指数を計算
+    stations = []
+    for station_id, station_data in snapshot["data"].items():
+        if station_ids is not None and station_id not in station_ids:
+            continue
+        observation = main.observation_from_station_data(station_data)
+        wbgt = main.calculate_wbgt(observation["temperature"], observation["humidity"],
+                                   observation["wind_speed"], observation["solar_radiation"])
+        if wbgt is None:  # 気温・湿度を観測していない観測所
+            continue
+        stations.append((station_id, observation, wbgt))
+
+    # ステップ2: 年齢グループごとにまとめて危険レベルを判定
+    levels = {
+        group: main.classify_wbgt_batch([wbgt for _, _, wbgt in stations], group)
+        for group in AGE_GROUPS
+    }
+
+    # ステップ3: 観測所ファイルの内容を作成
+    files = {}
+    for position, (station_id, observation, wbgt) in enumerate(stations):
+        age_groups = {}
+        for group in AGE_GROUPS:
+            level = main.RISK_LEVELS[levels[group][position]]
+            child_min, child_max, _, _, _ = main.calculate_child_temperatures(observation["temperature"], group)
+            age_groups[group] = {
+                "risk_level": level,
+                "risk_level_index": levels[group][position],
+                "risk_color": main.RISK_COLORS[level],
+                "advice": main.render_deterministic_advice(group, level),
+                "child_feels_like_min": child_min,
+                "child_feels_like_max": child_max,
+            }
+        files[station_id] = {
+            "station_id": station_id,
+            "station": names.get(station_id),
+            "time": snapshot_time,
+            "observation": observation,
+            "wbgt": wbgt,
+            "age_groups": age_groups,
+            "advice_mode": "fast",
+        }
+    return files
+
+
+def export_snapshot(snapshot, output_dir=DEFAULT_OUTPUT_DIR, station_ids=None, force=False):
+    """
+    スナップショットを output_dir に書き出す。書き出した観測所数を返す（省略した場合は None）
+    """
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    snapshot_time = main.format_jst(snapshot["latest"])
+    if not force:
+        try:
+            with open(manifest_path, encoding='utf-8') as f:
+                if json.load(f).get("snapshot_time") == snapshot_time:
+                    return None
+        except (OSError, ValueError):
+            pass
+
+    started = time.perf_counter()
+    files = render_station_files(snapshot, station_ids)
+    for station_id, content in files.items():
+        main.write_json_atomic(os.path.join(output_dir, f"{station_id}.json"), content)
+
+    # 全ての観測所ファイルを書き終えてから manifest を置き換える
+    main.write_json_atomic(manifest_path, {
+        "snapshot_time": snapshot_time,
+        "generated_at": main.format_jst(datetime.now(timezone.utc)),
+        "station_count": len(files),
+        "path_template": "data/risk/{station_id}.json",
+        "stations": {
+            station_id: {
+                "station": content["station"],
+                "wbgt": content["wbgt"],
+                "risk_level_index": {g: v["risk_level_index"] for g, v in content["age_groups"].items()},
+            }
+            for station_id, content in files.items()
+        },
+    })
+    removed = remove_stale_station_files(output_dir, files)
+    print(f"{snapshot_time}: {len(files)}観測所を書き出しました"
+          f"（古いファイル{removed}件を削除、{time.perf_counter() - started:.2f}秒）")
+    return len(files)
+
+
+def remove_stale_station_files(output_dir, current_station_ids):
+    """
+    output_dir の観測所ファイル（{観測所ID}.json）のうち、current_station_ids に無いものを削除する
+    削除した件数を返す
+    """
+    removed = 0
+    for filename in os.listdir(output_dir):
+        station_id, extension = os.path.splitext(filename)
+        # 観測所IDは数字のみ（manifest.json や一時ファイルなどは対象外）
+        if extension != ".json" or not station_id.isdigit() or station_id in current_station_ids:
+            continue
+        try:
+            os.remove(os.path.join(output_dir, filename))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def export_snapshot_columnar(snapshot, root, station_ids=None):
+    """
+    スナップショット1回分を日付ごとの Parquet ファイルとして書き出す（分析用）
+    """
+    import bulk_wbgt
+    from columnar_export import ColumnarWriter  # pyarrow が必要な時だけ読み込む
+
+    observed = snapshot["latest"].isoformat()
+    rows = [
+        {"time": observed, "station_id": station_id, **station_data}
+        for station_id, station_data in snapshot["data"].items()
+        if station_ids is None or station_id in station_ids
+    ]
+    writer = ColumnarWriter(root, bulk_wbgt.OUTPUT_FIELDS)
+    writer.write(bulk_wbgt.compute_chunk(rows))
+    writer.close()
+    return writer.rows_written
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="観測所別のリスクデータを静的JSONとして書き出します")
+    parser.add_argument("--out", default=DEFAULT_OUTPUT_DIR, help="書き出し先のディレクトリ")
+    parser.add_argument("--stations", help="書き出す観測所ID（カンマ区切り。省略時は全観測所）")
+    parser.add_argument("--watch", action="store_true", help="新しいスナップショットが来るたびに書き出し続ける")
+    parser.add_argument("--force", action="store_true", help="同じ観測時刻でも書き出す")
+    parser.add_argument("--parquet", help="分析用の Parquet ファイルも書き出すディレクトリ")
+    args = parser.parse_args()
+
+    station_ids = set(args.stations.split(",")) if args.stations else None
+    force = args.force
+    while True:
+        try:
+            snapshot = main.fetch_amedas_snapshot()
+            exported = export_snapshot(snapshot, args.out, station_ids, force)
+            if exported is not None and args.parquet:
+                export_snapshot_columnar(snapshot, args.parquet, station_ids)
+        except Exception as e:
+            if not args.watch:
+                raise
+            print(f"書き出しに失敗しました: {e}")
+        if not args.watch:
+            break
+        force = False
+        time.sleep(main.AMEDAS_REFRESH_SECONDS)
+
+
+if __name__ == "__main__":
+    main_cli()
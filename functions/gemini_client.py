@@ -0,0 +1,450 @@
+# =============================================================================
+# 【Gemini AI 共通クライアント】
+# 全てのAI機能（アドバイス・推奨事項・画像解析・画像比較）で共有する
+# Gemini の呼び出し口です
+#
+# - モデルと生成設定（GenerationConfig）を1回だけ作って使い回す
+# - テキスト（アドバイス・推奨事項）と画像（画像解析・画像比較）は別のレーンに分け、
+#   レーンごとにスレッドプール・同時実行数・1分あたりの回数・待ち行列の上限を持つ
+#   （画像の解析が集中しても、テキストのアドバイスの応答時間が変わらないようにする）
+# - レーンの制限に達した時は、優先度の高い処理から順に実行する
+# - 処理の種類（prompt_type）ごとに応答時間とトークン使用量を記録する
+# - 待ち行列が一杯、または待ち時間が残り時間を超えそうな時は受け付けずに即座に断る（shed）
+# - 全く同じプロンプトと生成設定の呼び出しが実行中なら、新たに呼ばずにその結果を共有する
+#   （submit の時点でまとめるため、結果を待つだけの呼び出しはスレッドプールの枠を使わない）
+#
+# google.generativeai は読み込みに時間がかかるため、初めて使う時に読み込みます
+# =============================================================================
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+import request_profiler
+
+GEMINI_MODEL_NAME = 'gemini-2.0-flash-lite'  # 最も安価なモデルを使用
+
+# 処理の種類ごとの生成設定・レーン・レーン内の優先度（数字が小さいほど優先）
+PROMPT_TYPES = {
+    "advice": {"max_output_tokens": 250, "temperature": 0.7, "lane": "text", "priority": 0},           # 出力を増やして完全なアドバイスを取得
+    "recommendations": {"max_output_tokens": 300, "temperature": 0.5, "lane": "text", "priority": 1},  # 出力を制限
+    "vision": {"max_output_tokens": 500, "temperature": 0.7, "lane": "vision", "priority": 0},
+    "comparison": {"max_output_tokens": 700, "temperature": 0.7, "lane": "vision", "priority": 0},
+}
+
+# 1分あたりの呼び出し回数の上限（APIの割り当てに合わせて設定）。画像のレーンの分を除いた残りがテキストのレーンの分
+GEMINI_RATE_LIMIT_PER_MINUTE = int(os.environ.get('GEMINI_RATE_LIMIT_PER_MINUTE', '60'))
+GEMINI_VISION_RATE_LIMIT_PER_MINUTE = int(os.environ.get(
+    'GEMINI_VISION_RATE_LIMIT_PER_MINUTE', str(GEMINI_RATE_LIMIT_PER_MINUTE // 4)
+))
+
+# レーンごとの同時実行数と、受け付けるAI処理（実行中＋待ち）の上限
+# 待ち行列の上限を超えたら待たずに固定メッセージにする
+GEMINI_LANES = {
+    "text": {
+        "max_concurrency": int(os.environ.get('GEMINI_TEXT_MAX_CONCURRENCY', '6')),
+        "max_queue": int(os.environ.get('GEMINI_TEXT_MAX_QUEUE', '32')),
+        "rate_per_minute": max(1, GEMINI_RATE_LIMIT_PER_MINUTE - GEMINI_VISION_RATE_LIMIT_PER_MINUTE),
+    },
+    "vision": {
+        "max_concurrency": int(os.environ.get('GEMINI_VISION_MAX_CONCURRENCY', '2')),
+        "max_queue": int(os.environ.get('GEMINI_VISION_MAX_QUEUE', '8')),
+        "rate_per_minute": max(1, GEMINI_VISION_RATE_LIMIT_PER_MINUTE),
+    },
+}
+LATENCY_EWMA_ALPHA = 0.2  # 応答時間の移動平均の重み（待ち時間の見積もり用）
+
+
+class GeminiBusyError(Exception):
+    """
+    同時実行数や回数制限のため、期限内に呼び出しを開始できなかった
+    （Geminiの障害ではないため、サーキットブレーカーの失敗には数えない）
+    """
+
+
+class GeminiShedError(GeminiBusyError):
+    """
+    待ち行列が一杯、または見積もった待ち時間が残り時間を超えるため、受け付けなかった
+    （負荷が高い時に全員がタイムアウトするのを防ぐため、即座に固定メッセージにする）
+    """
+
+
+class _PriorityLimiter:
+    """
+    同時実行数と1分あたりの回数を制限し、待っている処理を優先度順に通す
+    """
+
+    def __init__(self, max_concurrency, rate_per_minute):
+        self.max_concurrency = max_concurrency
+        self.rate_per_minute = rate_per_minute
+        self._cond = threading.Condition()
+        self._running = 0
+        self._calls = deque()        # 直近1分間の呼び出し開始時刻
+        self._waiters = []           # (優先度, 順番) のヒープ
+        self._sequence = itertools.count()
+
+    def _rate_wait(self, now):
+        """
+        回数制限に空きが出るまでの秒数（空いていれば0）
+        """
+        while self._calls and now - self._calls[0] >= 60:
+            self._calls.popleft()
+        if len(self._calls) < self.rate_per_minute:
+            return 0.0
+        return 60 - (now - self._calls[0])
+
+    def acquire(self, priority, deadline=None):
+        """
+        実行枠を確保する。deadline（time.monotonic の時刻）までに確保できなければ GeminiBusyError
+        確保までに待った秒数を返す
+        """
+        started = time.monotonic()
+        with self._cond:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._waiters[0] == ticket and self._running < self.max_concurrency:
+                        rate_wait = self._rate_wait(now)
+                        if rate_wait <= 0:
+                            heapq.heappop(self._waiters)
+                            self._running += 1
+                            self._calls.append(now)
+                            self._cond.notify_all()
+                            return now - started
+                        wait = rate_wait
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            raise GeminiBusyError("Gemini の呼び出し枠を確保できませんでした")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            except BaseException:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+    def release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            self._rate_wait(time.monotonic())
+            return {
+                "running": self._running,
+                "waiting": len(self._waiters),
+                "max_concurrency": self.max_concurrency,
+                "calls_last_minute": len(self._calls),
+                "rate_limit_per_minute": self.rate_per_minute,
+            }
+
+
+class _Lane:
+    """
+    1つのレーンの実行枠（スレッドプール・同時実行数と回数の制限・受け付け状況）
+    受け付け状況（outstanding など）は GeminiClient の _admission_lock の中で更新する
+    """
+
+    def __init__(self, name, max_concurrency, max_queue, rate_per_minute):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.limiter = _PriorityLimiter(max_concurrency, rate_per_minute)
+        # AI処理を時間制限付きで実行するためのスレッドプール（レーンごとに分ける）
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency * 2, thread_name_prefix=f'gemini-{name}'
+        )
+        self.outstanding = 0          # 受け付け済みで終わっていない処理の数（実行中＋待ち）
+        self.coalesced = 0            # 実行中の同じ呼び出しの結果を共有した数
+        self.latency_ewma = None      # 応答時間の移動平均（秒）
+        self.shed = 0                 # 受け付けなかった処理の数
+        self.total_queue_wait = 0.0   # 実行枠の確保までに待った時間の合計（秒）
+        self.max_queue_wait = 0.0
+        self.started = 0              # 実行枠を確保できた呼び出しの数
+
+    def active(self):
+        """
+        Gemini の実行枠を実際に使う（または使う予定の）処理の数
+        （同じ呼び出しの結果を共有するだけの処理は submit の時点でまとめるため含まれない）
+        """
+        return self.outstanding
+
+    def estimated_wait(self):
+        """
+        今受け付けた場合に、実行開始までに待つ時間の見積もり（秒）
+        """
+        if self.latency_ewma is None:
+            return 0.0
+        ahead = self.active() - self.max_concurrency + 1
+        if ahead <= 0:
+            return 0.0
+        return ahead / self.max_concurrency * self.latency_ewma
+
+
+class GeminiClient:
+    """
+    Gemini の共通クライアント
+    """
+
+    def __init__(self, api_key, model_name=GEMINI_MODEL_NAME, lanes=None):
+        self.api_key = api_key
+        self.model_name = model_name
+        self._admission_lock = threading.Lock()
+        self._inflight = {}           # 受け付け済みで終わっていない呼び出し（flight_key → Future）
+        self.import_seconds = None    # SDKの読み込み＋設定にかかった時間
+        self._load_lock = threading.Lock()
+        self._genai = None
+        self._model = None
+        self._configs = {}
+        self.lanes = {
+            name: _Lane(name, **limits)
+            for name, limits in (lanes or GEMINI_LANES).items()
+        }
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def enabled(self):
+        return bool(self.api_key)
+
+    def load(self):
+        """
+        SDKを読み込み、APIキーの設定・モデル・生成設定の作成を1回だけ行う
+        """
+        if self._genai is None:
+            with self._load_lock:
+                if self._genai is None:
+                    started = time.perf_counter()
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)  # AIサービスの初期化
+                    self._model = genai.GenerativeModel(self.model_name)
+                    self._configs = {
+                        name: genai.types.GenerationConfig(
+                            max_output_tokens=spec["max_output_tokens"],
+                            temperature=spec["temperature"]
+                        )
+                        for name, spec in PROMPT_TYPES.items()
+                    }
+                    self._genai = genai
+                    self.import_seconds = round(time.perf_counter() - started, 4)
+        return self._genai
+
+    def warmup(self):
+        """
+        起動時の準備（SDKの読み込みとモデルの作成）。APIキーが無ければ何もしない
+        """
+        if self.enabled:
+            self.load()
+
+    def lane(self, prompt_type):
+        """
+        処理の種類が使うレーン
+        """
+        return self.lanes[PROMPT_TYPES[prompt_type]["lane"]]
+
+    def estimated_wait(self, prompt_type):
+        """
+        今受け付けた場合に、実行開始までに待つ時間の見積もり（秒）
+        """
+        with self._admission_lock:
+            return self.lane(prompt_type).estimated_wait()
+
+    def submit(self, prompt_type, fn, budget, key=None):
+        """
+        【機能説明】
+        AI処理（fn）を処理の種類のレーンのスレッドプールで実行するために受け付ける
+
+        レーンの待ち行列が一杯、または見積もった待ち時間が残り時間（budget 秒）を超える場合は、
+        画像データなどを抱えたまま待たせずに GeminiShedError を送出する
+
+        key（flight_key）を指定し、同じキーの処理が受け付け済みで終わっていない場合は、
+        新たに受け付けずにその Future をそのまま返す（Gemini の呼び出しはキーごとに1回だけ）
+        新たに受け付けたのが自分かどうかは owns(future, fn) で確認できる
+
+        【出力データ】
+        concurrent.futures.Future
+        """
+        lane = self.lane(prompt_type)
+        wrapped = request_profiler.propagate(fn, f"gemini-{lane.name}")  # プロファイル中のリクエストなら一緒に記録
+
+        def run():
+            try:
+                return wrapped()
+            finally:
+                with self._admission_lock:
+                    lane.outstanding -= 1
+
+        with self._admission_lock:
+            flight = self._inflight.get(key) if key is not None else None
+            coalesced = flight is not None
+            reason = None
+            if coalesced:
+                lane.coalesced += 1
+            elif lane.active() >= lane.max_queue:
+                reason = f"{lane.name} の待ち行列が一杯です（{lane.active()}件）"
+            elif lane.estimated_wait() >= budget:
+                reason = f"{lane.name} の待ち時間の見積もり（{lane.estimated_wait():.1f}秒）が残り時間（{budget:.1f}秒）を超えます"
+            if reason:
+                lane.shed += 1
+            elif not coalesced:
+                lane.outstanding += 1
+                flight = lane.executor.submit(run)
+                flight.owner = fn  # 結果を共有しただけの呼び出し元と区別するため
+                if key is not None:
+                    self._inflight[key] = flight
+        if reason:
+            self._count(prompt_type, "shed")
+            raise GeminiShedError(reason)
+        if coalesced:
+            self._count(prompt_type, "coalesced")
+        elif key is not None:
+            # 終わったら対象から外す（既に終わっていればこの場で呼ばれるため、ロックの外で登録する）
+            flight.add_done_callback(lambda done: self._forget(key, done))
+        return flight
+
+    def owns(self, future, fn):
+        """
+        submit(fn=...) が新たに受け付けた Future なら True
+        （False の場合は、実行中の同じ呼び出しの結果を共有しているだけ）
+        """
+        return getattr(future, "owner", None) is fn
+
+    def _forget(self, key, future):
+        """
+        終わった処理を、同じ呼び出しをまとめる対象から外す
+        """
+        with self._admission_lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def flight_key(self, prompt_type, contents):
+        """
+        同じ呼び出しかどうかを判定するキー（モデル・生成設定・空白を整えたプロンプトのハッシュ）
+        submit(key=...) に渡すと、同じキーの処理が終わるまでは結果を共有する
+        画像を含む呼び出しは毎回内容が異なるため、まとめない（None を返す）
+        """
+        if not isinstance(contents, str):
+            return None
+        spec = PROMPT_TYPES[prompt_type]
+        normalized = " ".join(contents.split())
+        material = f"{self.model_name}|{prompt_type}|{spec['max_output_tokens']}|{spec['temperature']}|{normalized}"
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def generate(self, prompt_type, contents, deadline=None):
+        """
+        【機能説明】
+        Gemini にテキストまたは画像付きの生成を依頼する
+
+        【入力データ】
+        prompt_type : "advice" / "recommendations" / "vision" / "comparison"
+        contents : プロンプト（文字列、または文字列と画像のリスト）
+        deadline : この時刻（time.monotonic）までに実行枠が取れなければ GeminiBusyError
+
+        【出力データ】
+        Gemini の応答（response.text で文章を取得）
+        """
+        return self._generate(prompt_type, contents, deadline)
+
+    def _generate(self, prompt_type, contents, deadline):
+        spec = PROMPT_TYPES[prompt_type]
+        lane = self.lanes[spec["lane"]]
+        self.load()
+        try:
+            queue_wait = lane.limiter.acquire(spec["priority"], deadline)
+        except GeminiBusyError:
+            self._count(prompt_type, "rate_limited")
+            raise
+        started = time.perf_counter()
+        ok = False
+        response = None
+        try:
+            response = self._model.generate_content(contents, generation_config=self._configs[prompt_type])
+            ok = True
+            return response
+        finally:
+            lane.limiter.release()
+            self._record(prompt_type, lane, time.perf_counter() - started, queue_wait, ok, response)
+
+    def _entry(self, prompt_type):
+        return self._stats.setdefault(prompt_type, {
+            "calls": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0,
+            "total_queue_wait": 0.0, "max_queue_wait": 0.0, "prompt_tokens": 0, "output_tokens": 0,
+            "shed": 0, "rate_limited": 0, "coalesced": 0,
+        })
+
+    def _count(self, prompt_type, key):
+        with self._stats_lock:
+            self._entry(prompt_type)[key] += 1
+
+    def _record(self, prompt_type, lane, latency, queue_wait, ok, response):
+        usage = getattr(response, "usage_metadata", None)
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+        with self._admission_lock:
+            if lane.latency_ewma is None:
+                lane.latency_ewma = latency
+            else:
+                lane.latency_ewma += LATENCY_EWMA_ALPHA * (latency - lane.latency_ewma)
+            lane.started += 1
+            lane.total_queue_wait += queue_wait
+            lane.max_queue_wait = max(lane.max_queue_wait, queue_wait)
+        with self._stats_lock:
+            s = self._entry(prompt_type)
+            s["calls"] += 1
+            s["errors"] += 0 if ok else 1
+            s["total_latency"] += latency
+            s["max_latency"] = max(s["max_latency"], latency)
+            s["total_queue_wait"] += queue_wait
+            s["max_queue_wait"] = max(s["max_queue_wait"], queue_wait)
+            s["prompt_tokens"] += prompt_tokens
+            s["output_tokens"] += output_tokens
+
+    def stats(self):
+        """
+        処理の種類ごとの呼び出し回数・平均応答時間・トークン使用量と、レーンごとの実行枠・待ち行列の状況
+        """
+        with self._stats_lock:
+            per_type = {
+                name: {
+                    "calls": s["calls"],
+                    "errors": s["errors"],
+                    "shed": s["shed"],
+                    "rate_limited": s["rate_limited"],
+                    "coalesced": s["coalesced"],
+                    "avg_latency": round(s["total_latency"] / s["calls"], 3) if s["calls"] else None,
+                    "max_latency": round(s["max_latency"], 3),
+                    "avg_queue_wait": round(s["total_queue_wait"] / s["calls"], 3) if s["calls"] else None,
+                    "max_queue_wait": round(s["max_queue_wait"], 3),
+                    "prompt_tokens": s["prompt_tokens"],
+                    "output_tokens": s["output_tokens"],
+                }
+                for name, s in self._stats.items()
+            }
+        lanes = {}
+        with self._admission_lock:
+            inflight_prompts = len(self._inflight)
+            for name, lane in self.lanes.items():
+                lanes[name] = {
+                    "prompt_types": [t for t, spec in PROMPT_TYPES.items() if spec["lane"] == name],
+                    "outstanding": lane.outstanding,
+                    "coalesced": lane.coalesced,
+                    "max_queue": lane.max_queue,
+                    "shed": lane.shed,
+                    "estimated_wait": round(lane.estimated_wait(), 3),
+                    "avg_latency": round(lane.latency_ewma, 3) if lane.latency_ewma is not None else None,
+                    "avg_queue_wait": round(lane.total_queue_wait / lane.started, 3) if lane.started else None,
+                    "max_queue_wait": round(lane.max_queue_wait, 3),
+                }
+        for name, lane in self.lanes.items():
+            lanes[name].update(lane.limiter.snapshot())  # running / waiting / calls_last_minute など
+        return {"model": self.model_name, "inflight_prompts": inflight_prompts, "lanes": lanes, "prompt_types": per_type}
@@ -0,0 +1,306 @@
+# =============================================================================
+# 【気象庁データのローカル代替サーバー】
+# 負荷試験や通信できない環境での動作確認のために、気象庁（www.jma.go.jp/bosai）の代わりに
+# 保存しておいたデータを返すサーバーです
+#
+# 保存データのディレクトリ構成（気象庁の /bosai 以下と同じパス）:
+#   {保存先}/amedas/data/map/20250801143000.json   … アメダス全国データ（時刻順に再生）
+#   {保存先}/amedas/data/map/20250801144000.json
+#   {保存先}/forecast/data/forecast/130000.json    … 気象台ごとの予報（日付を今日に合わせて返す）
+#   {保存先}/その他のパス                           … そのまま返す
+#
+# - latest_time.txt は起動時の現在時刻（10分単位）から始めて、--interval 秒ごとに10分ずつ進める
+#   （保存データの時刻のままだと古すぎて使われないため、時刻だけ現在に合わせる）
+# - 進めるたびに、保存した全国データを時刻順に1つずつ返す（最後まで行ったら最初に戻る）
+# - 保存データが無い場合は、amedas_id.json の観測所について気象データ・予報を作って返す
+#
+# 使い方:
+#   cd functions
+#   python jma_standin.py --record recordings/ --count 6   # 気象庁から10分ごとに6回分を保存
+#   python jma_standin.py --record recordings/ --count 1 --offices 130000,270000  # 予報も保存
+#   python jma_standin.py --dir recordings/ --port 8081    # 保存データで代替サーバーを起動
+#   JMA_BASE_URL=http://127.0.0.1:8081 functions-framework --target heat_risk
+# =============================================================================
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.request
+import zlib
+from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+JST = timezone(timedelta(hours=9))
+JMA_BASE_URL = "https://www.jma.go.jp/bosai"
+STEP = timedelta(minutes=10)  # アメダスの更新間隔
+ISO_DATETIME = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[+-]\d{2}:\d{2}')
+DEFAULT_STATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public', 'data', 'amedas_id.json')
+
+
+def synthetic_map(stations, step):
+    """
+    観測所一覧から、それらしい全国データ（気象庁の map 形式）を作る
+    同じ step なら毎回同じ値になる
+    """
+    rng = random.Random(step)
+    data = {}
+    for station in stations:
+        base = 26 + zlib.crc32(station["id"].encode()) % 100 / 10  # 観測所ごとに 26〜36℃
+        data[station["id"]] = {
+            "temp": [round(base + rng.uniform(-1, 1), 1), 0],
+            "humidity": [rng.randint(45, 85), 0],
+            "wind": [round(rng.uniform(0.5, 5), 1), 0],
+            "sun1h": [round(rng.uniform(0, 1), 1), 0],
+        }
+    return data
+
+
+def synthetic_forecast(stations, now):
+    """
+    全観測所を気温の地点とした、それらしい予報（気象庁の府県予報＋週間予報の形式）を作る
+    """
+    report = now.replace(minute=0, second=0, microsecond=0)
+    days = [report.replace(hour=0) + timedelta(days=i) for i in range(7)]
+    base = {s["id"]: 26 + zlib.crc32(s["id"].encode()) % 100 / 10 for s in stations}
+    weather = ["100", "101", "200", "201", "100", "300", "100"]
+    short_term = {
+        "publishingOffice": "代替サーバー",
+        "reportDatetime": report.isoformat(),
+        "timeSeries": [
+            {
+                "timeDefines": [d.isoformat() for d in days[:3]],
+                "areas": [{"area": {"name": "代替地方", "code": "000010"}, "weatherCodes": weather[:3]}],
+            },
+            {
+                "timeDefines": [t.isoformat() for d in days[:2] for t in (d, d.replace(hour=9))],
+                "areas": [
+                    {"area": {"name": s["name"], "code": s["id"]},
+                     "temps": [str(round(base[s["id"]] + offset)) for _ in days[:2] for offset in (-6, 3)]}
+                    for s in stations
+                ],
+            },
+        ],
+    }
+    weekly = {
+        "publishingOffice": "代替サーバー",
+        "reportDatetime": report.isoformat(),
+        "timeSeries": [
+            {
+                "timeDefines": [d.isoformat() for d in days],
+                "areas": [{"area": {"name": "代替地方", "code": "000000"}, "weatherCodes": weather}],
+            },
+            {
+                "timeDefines": [d.isoformat() for d in days],
+                "areas": [
+                    {"area": {"name": s["name"], "code": s["id"]},
+                     "tempsMin": [str(round(base[s["id"]] - 6)) for _ in days],
+                     "tempsMax": [str(round(base[s["id"]] + 3)) for _ in days]}
+                    for s in stations
+                ],
+            },
+        ],
+    }
+    return [short_term, weekly]
+
+
+def shift_forecast_dates(body, today):
+    """
+    保存した予報の日時を、発表日が today になるように日単位でずらす
+    """
+    text = body.decode("utf-8")
+    reported = json.loads(text)[0]["reportDatetime"]
+    shift = today - datetime.fromisoformat(reported).date()
+    if not shift:
+        return body
+    return ISO_DATETIME.sub(lambda m: (datetime.fromisoformat(m.group()) + shift).isoformat(), text).encode("utf-8")
+
+
+class JmaStandIn:
+    """
+    気象庁の代わりに保存データを返すサーバー（別スレッドで動かす）
+    """
+
+    def __init__(self, recording_dir=None, host="127.0.0.1", port=0, interval=60,
+                 delay=0.0, stations_file=DEFAULT_STATIONS_FILE):
+        self.recording_dir = os.path.abspath(recording_dir) if recording_dir else None
+        self.interval = interval
+        self.delay = delay
+        self.maps = []
+        if self.recording_dir:
+            map_dir = os.path.join(self.recording_dir, "amedas", "data", "map")
+            if os.path.isdir(map_dir):
+                self.maps = [os.path.join(map_dir, name) for name in sorted(os.listdir(map_dir)) if name.endswith(".json")]
+        self._stations = None
+        self._stations_file = stations_file
+        now = datetime.now(JST)
+        self.base_time = now.replace(minute=now.minute - now.minute % 10, second=0, microsecond=0)
+        self.started = time.monotonic()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def step(self):
+        """
+        起動してから進めた回数
+        """
+        if not self.interval:
+            return 0
+        return int((time.monotonic() - self.started) // self.interval)
+
+    def latest_time(self, step=None):
+        return self.base_time + STEP * (self.step() if step is None else step)
+
+    def map_body(self, ts):
+        """
+        時刻 ts（YYYYMMDDHHMMSS）の全国データ。配信していない時刻なら None
+        """
+        try:
+            observed = datetime.strptime(ts, "%Y%m%d%H%M%S").replace(tzinfo=JST)
+        except ValueError:
+            return None
+        step, remainder = divmod(observed - self.base_time, STEP)
+        if remainder or step < 0 or step > self.step():
+            return None
+        if self.maps:
+            with open(self.maps[step % len(self.maps)], "rb") as f:
+                return f.read()
+        return json.dumps(synthetic_map(self.stations(), step)).encode("utf-8")
+
+    def forecast_body(self, path):
+        """
+        気象台の予報。保存データがあれば日付を今日に合わせ、無ければ作って返す
+        """
+        body = self.static_body(path)
+        if body is not None:
+            return shift_forecast_dates(body, datetime.now(JST).date())
+        return json.dumps(synthetic_forecast(self.stations(), datetime.now(JST)), ensure_ascii=False).encode("utf-8")
+
+    def stations(self):
+        if self._stations is None:
+            with open(self._stations_file, encoding="utf-8") as f:
+                self._stations = json.load(f)
+        return self._stations
+
+    def static_body(self, path):
+        """
+        保存データのディレクトリにあるファイル（ディレクトリの外は返さない）
+        """
+        if not self.recording_dir:
+            return None
+        full_path = os.path.realpath(os.path.join(self.recording_dir, path.lstrip("/")))
+        if not full_path.startswith(self.recording_dir + os.sep) or not os.path.isfile(full_path):
+            return None
+        with open(full_path, "rb") as f:
+            return f.read()
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with standin._lock:
+                    standin.requests += 1
+                if standin.delay:
+                    time.sleep(standin.delay)  # 気象庁との通信時間の代わり
+                path = self.path.split("?")[0]
+                if path == "/amedas/data/latest_time.txt":
+                    body, content_type = standin.latest_time().isoformat().encode("utf-8"), "text/plain"
+                elif path.startswith("/amedas/data/map/"):
+                    body, content_type = standin.map_body(path.rsplit("/", 1)[-1][:-len(".json")]), "application/json"
+                elif path.startswith("/forecast/data/forecast/"):
+                    body, content_type = standin.forecast_body(path), "application/json"
+                else:
+                    body, content_type = standin.static_body(path), "application/json"
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 1リクエストごとのログは出さない
+
+        return Handler
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def record(output_dir, count, offices=()):
+    """
+    気象庁から最新の全国データを count 回分（更新されるたびに）保存する
+    offices を指定した場合は、その気象台の予報も保存する
+    """
+    forecast_dir = os.path.join(output_dir, "forecast", "data", "forecast")
+    for office in offices:
+        os.makedirs(forecast_dir, exist_ok=True)
+        with urllib.request.urlopen(f"{JMA_BASE_URL}/forecast/data/forecast/{office}.json", timeout=10) as r:
+            body = r.read()
+        with open(os.path.join(forecast_dir, f"{office}.json"), "wb") as f:
+            f.write(body)
+        print(f"予報 {office}.json を保存しました")
+    map_dir = os.path.join(output_dir, "amedas", "data", "map")
+    os.makedirs(map_dir, exist_ok=True)
+    saved = set()
+    while len(saved) < count:
+        with urllib.request.urlopen(f"{JMA_BASE_URL}/amedas/data/latest_time.txt", timeout=10) as r:
+            latest = datetime.fromisoformat(r.read().decode("utf-8").strip())
+        ts = latest.strftime("%Y%m%d%H%M%S")
+        if ts not in saved:
+            with urllib.request.urlopen(f"{JMA_BASE_URL}/amedas/data/map/{ts}.json", timeout=10) as r:
+                body = r.read()
+            with open(os.path.join(map_dir, f"{ts}.json"), "wb") as f:
+                f.write(body)
+            saved.add(ts)
+            print(f"{ts}.json を保存しました（{len(saved)}/{count}）")
+        if len(saved) < count:
+            time.sleep(60)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="気象庁データのローカル代替サーバー")
+    parser.add_argument("--dir", help="保存データのディレクトリ（省略時は気象データを作って返す）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--interval", type=float, default=60, help="観測時刻を10分進める間隔（秒）。0 なら進めない")
+    parser.add_argument("--delay", type=float, default=0.0, help="1回の応答を遅らせる秒数")
+    parser.add_argument("--record", help="気象庁からデータを保存するディレクトリ（サーバーは起動しない）")
+    parser.add_argument("--count", type=int, default=6, help="--record で保存する回数")
+    parser.add_argument("--offices", default="", help="--record で予報も保存する気象台のコード（カンマ区切り）")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.count, [o for o in args.offices.split(",") if o])
+        return
+    standin = JmaStandIn(args.dir, args.host, args.port, args.interval, args.delay)
+    print(f"気象庁の代替サーバー: {standin.url}（JMA_BASE_URL に指定してください）")
+    try:
+        standin.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,477 @@
+# =============================================================================
+# 【負荷試験】
+# heat_risk・analyze_image・compare_images を、気象庁と Gemini を呼ばずに
+# 手元で負荷試験するためのスクリプト
+#
+# - 気象庁: jma_standin.py の代替サーバー（保存データの再生、または作ったデータ）
+# - Gemini: 応答時間の分布とエラー率を指定できる擬似 Gemini（google.generativeai の代わり）
+# - 関数: main.py の関数を HTTP サーバーで公開する（別プロセス。擬似 Gemini はこのプロセスの中で動く）
+#
+# 同時接続数を変えながら一定時間ずつリクエストを送り続け、エンドポイントごとに
+# 1秒あたりの処理件数・応答時間（p50/p95/p99）・エラー率・縮退率（AIの代わりに固定の内容を返した割合）を表示します
+# Gemini の同時実行数・回数制限は本番と同じ設定で動きます（GEMINI_RATE_LIMIT_PER_MINUTE などの環境変数で変更）
+#
+# 使い方:
+#   cd functions
+#   python loadtest.py run                                          # 同時接続 1,4,16 で15秒ずつ
+#   python loadtest.py run --concurrency 1,8,32,64 --duration 30 --jma-dir recordings/
+#   python loadtest.py run --ai-latency lognormal:0.8,0.5 --vision-latency uniform:2,6 --ai-error-rate 0.05
+#   python loadtest.py run --mix heat_risk=8,analyze_image=1,compare_images=1 --json result.json
+#   python loadtest.py serve --port 8080                            # 関数のサーバーだけ起動（別の負荷ツールから使う）
+#   python loadtest.py run --url http://127.0.0.1:8080              # 起動済みのサーバー（デプロイ先も可）に送る
+#
+# 応答時間の分布:
+#   fixed:0.8          … 常に0.8秒
+#   uniform:0.3,1.5    … 0.3〜1.5秒の一様分布
+#   lognormal:0.8,0.5  … 中央値0.8秒・ばらつき0.5の対数正規分布（実際の API に近い）
+#   exp:0.8            … 平均0.8秒の指数分布
+# =============================================================================
+import argparse
+import base64
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+ENDPOINTS = ["heat_risk", "analyze_image", "compare_images"]
+AGE_GROUPS = ["0-1", "2-3", "4-6"]
+# AIの代わりに固定の内容を返した時の status（縮退として数える）
+DEGRADED_PATTERN = re.compile(r'"status":\s*"(fallback|shed|rate_limited|timeout|circuit_open|ai_failed|error)"')
+
+# 擬似 Gemini が返す内容（main.py が読み取れる形）
+FAKE_RESPONSES = {
+    "advice": "〇水分補給\n・15分ごとにコップ1杯\n〇空調設定\n・26℃\n〇体調確認\n・顔色と汗の量\n〇行動制限\n・日陰で遊ぶ",
+    "recommendations": json.dumps({
+        "general": ["十分な水分補給を心がける", "こまめな休憩を取る"],
+        "age_specific": ["保護者による頻繁な確認", "短時間の外出に留める"],
+    }, ensure_ascii=False),
+    "vision": json.dumps({
+        "ai_analysis": "• 体調分析: 汗が多い\n\n• 水分補給: コップ2杯",
+        "environmental_factors": ["日差しが強い"],
+        "heat_risk_factors": ["汗が多い"],
+        "recommendations": ["日陰で休憩する"],
+        "ai_confidence": 0.8,
+    }, ensure_ascii=False),
+    "comparison": "• 疲労度: 中度\n\n• 水分補給: コップ3杯・15分間隔\n\n• 空調設定: 25℃\n\n• 体調確認: 顔色",
+}
+
+
+def parse_latency(spec):
+    """
+    応答時間の分布の指定（"lognormal:0.8,0.5" など）を、乱数生成器から秒数を返す関数に変換する
+    """
+    kind, _, params = spec.partition(":")
+    try:
+        values = [float(v) for v in params.split(",") if v]
+        if kind == "fixed" and len(values) == 1:
+            return lambda rng: values[0]
+        if kind == "uniform" and len(values) == 2:
+            return lambda rng: rng.uniform(values[0], values[1])
+        if kind == "lognormal" and len(values) == 2:
+            return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+        if kind == "exp" and len(values) == 1:
+            return lambda rng: rng.expovariate(1 / values[0])
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"応答時間の分布の指定が正しくありません: {spec}")
+
+
+def parse_mix(spec):
+    """
+    "heat_risk=8,analyze_image=1" → {"heat_risk": 8.0, "analyze_image": 1.0}
+    """
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"エンドポイントは {ENDPOINTS} のいずれかを指定してください: {name}")
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"割合は数値で指定してください: {part}")
+    return mix
+
+
+# =============================================================================
+# 【擬似 Gemini】
+# google.generativeai と同じ呼び出し方（configure / GenerativeModel / types.GenerationConfig）で、
+# 指定した分布の時間だけ待ってから決まった内容を返す
+# =============================================================================
+class FakeGemini:
+
+    def __init__(self, text_latency, vision_latency, error_rate=0.0, seed=None):
+        import gemini_client
+        self.prompt_types = gemini_client.PROMPT_TYPES
+        # 生成設定の出力上限から処理の種類を判定する（種類ごとに異なる値）
+        self._types_by_tokens = {spec["max_output_tokens"]: name for name, spec in self.prompt_types.items()}
+        self.text_latency = text_latency
+        self.vision_latency = vision_latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def install(self):
+        """
+        google.generativeai の代わりに読み込まれるようにする（main.py より先に呼ぶ）
+        """
+        fake = self
+        module = types.ModuleType("google.generativeai")
+        module.configure = lambda api_key=None, **kwargs: None
+        module.GenerativeModel = lambda model_name, **kwargs: types.SimpleNamespace(
+            generate_content=fake.generate_content
+        )
+        module.types = types.SimpleNamespace(GenerationConfig=lambda **kwargs: dict(kwargs))
+        try:
+            import google
+        except ImportError:
+            google = types.ModuleType("google")
+            google.__path__ = []
+            sys.modules["google"] = google
+        google.generativeai = module
+        sys.modules["google.generativeai"] = module
+
+    def generate_content(self, contents, generation_config=None):
+        prompt_type = self._types_by_tokens.get((generation_config or {}).get("max_output_tokens"), "advice")
+        vision = self.prompt_types[prompt_type]["lane"] == "vision"
+        with self._lock:
+            delay = max(0.0, (self.vision_latency if vision else self.text_latency)(self._rng))
+            failed = self._rng.random() < self.error_rate
+            self.calls += 1
+            self.errors += 1 if failed else 0
+        time.sleep(delay)
+        if failed:
+            raise RuntimeError("擬似 Gemini のエラー")
+        text = FAKE_RESPONSES[prompt_type]
+        return types.SimpleNamespace(
+            text=text,
+            usage_metadata=types.SimpleNamespace(prompt_token_count=400, candidates_token_count=len(text))
+        )
+
+
+# =============================================================================
+# 【関数のサーバー】
+# main.py の関数を、functions_framework と同じ形のリクエストで呼び出す
+# =============================================================================
+class QueryArgs(dict):
+    def get(self, key, default=None, type=None):
+        value = dict.get(self, key, default)
+        if type is not None and key in self:
+            try:
+                return type(value)
+            except (TypeError, ValueError):
+                return default
+        return value
+
+
+class FunctionRequest:
+    """
+    main.py の関数が使う部分（method・args・headers・get_json）だけを持つリクエスト
+    """
+
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = urlsplit(path).path
+        self.args = QueryArgs(parse_qsl(urlsplit(path).query))
+        self.headers = headers
+        self._body = body
+
+    def get_json(self, silent=False, force=False):
+        if not self._body:
+            return None
+        try:
+            return json.loads(self._body)
+        except ValueError:
+            if silent:
+                return None
+            raise
+
+
+def serve(args):
+    """
+    代替サーバーと擬似 Gemini を用意して、main.py の関数を HTTP で公開する
+    準備ができたら標準出力に "READY {URL}" を1行書く
+    """
+    from jma_standin import JmaStandIn
+
+    ready_stream = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")  # main.py のリクエストごとのログを出さない
+
+    standin = JmaStandIn(args.jma_dir, interval=args.jma_interval, delay=args.jma_delay).start()
+    os.environ["JMA_BASE_URL"] = standin.url
+    os.environ.setdefault("API_KEY", "loadtest")
+    fake = FakeGemini(args.ai_latency, args.vision_latency, args.ai_error_rate, args.seed)
+    fake.install()
+    import main
+
+    def server_stats():
+        return {
+            "gemini": main.GEMINI_CLIENT.stats(),
+            "fake_gemini": {"calls": fake.calls, "errors": fake.errors},
+            "circuit_breaker": main.AI_CIRCUIT_BREAKER.snapshot(),
+            "jma_requests": standin.requests,
+        }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def handle_function(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            request = FunctionRequest(self.command, self.path, self.headers, body)
+            name = request.path.strip("/")
+            if name == "__stats__":
+                result = (json.dumps(server_stats(), ensure_ascii=False), 200, {"Content-Type": "application/json"})
+            elif name in ENDPOINTS:
+                result = getattr(main, name)(request)
+            else:
+                result = ("", 404, {})
+            if not isinstance(result, tuple):
+                result = (result,)
+            data = result[0]
+            status = result[1] if len(result) > 1 else 200
+            headers = result[2] if len(result) > 2 else {}
+            data = data.encode("utf-8") if isinstance(data, str) else data
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_OPTIONS = handle_function
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    host, port = server.server_address[:2]
+    print(f"READY http://{host}:{port}", file=ready_stream, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.stop()
+
+
+def start_server_process(args):
+    """
+    関数のサーバーを別プロセスで起動し、(プロセス, URL) を返す
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__), "serve", "--port", "0",
+        "--ai-latency", args.ai_latency_spec, "--vision-latency", args.vision_latency_spec,
+        "--ai-error-rate", str(args.ai_error_rate),
+        "--jma-interval", str(args.jma_interval), "--jma-delay", str(args.jma_delay),
+    ]
+    if args.jma_dir:
+        command += ["--jma-dir", args.jma_dir]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    if not line.startswith("READY "):
+        process.kill()
+        raise RuntimeError("関数のサーバーを起動できませんでした")
+    return process, line.split(" ", 1)[1]
+
+
+# =============================================================================
+# 【負荷をかける側】
+# =============================================================================
+def percentile(sorted_values, p):
+    """
+    p パーセンタイル（最も近い順位の値）
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Driver:
+    """
+    指定した同時接続数で、一定時間リクエストを送り続けて結果を集める
+    """
+
+    def __init__(self, url, mix, advice_mode="ai", image_kb=200, timeout=30, seed=None):
+        self.url = url.rstrip("/")
+        self.endpoints = list(mix)
+        self.weights = [mix[name] for name in self.endpoints]
+        self.advice_mode = advice_mode
+        self.timeout = timeout
+        self.seed = seed
+        rng = random.Random(seed)
+        # 画像は毎回作ると負荷をかける側が重くなるため、数枚を使い回す
+        self.images = [base64.b64encode(rng.randbytes(image_kb * 1024)).decode("ascii") for _ in range(4)]
+        stations_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public', 'data', 'amedas_id.json')
+        with open(stations_file, encoding="utf-8") as f:
+            self.stations = [s["id"] for s in json.load(f)]
+
+    def payload(self, endpoint, rng):
+        age_group = rng.choice(AGE_GROUPS)
+        if endpoint == "heat_risk":
+            return {"age_group": age_group, "station_id": rng.choice(self.stations), "advice_mode": self.advice_mode}
+        if endpoint == "analyze_image":
+            return {"age_group": age_group, "image_data": rng.choice(self.images)}
+        before, after = rng.sample(self.images, 2)
+        return {"age_group": age_group, "before_image": before, "after_image": after, "time_difference_minutes": 30}
+
+    def send(self, endpoint, payload):
+        """
+        1件送って (応答時間（秒）, エラーかどうか, 縮退したかどうか) を返す
+        """
+        request = urllib.request.Request(
+            f"{self.url}/{endpoint}", data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"}, method="POST"
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = response.read().decode("utf-8", "replace")
+            return time.perf_counter() - started, False, bool(DEGRADED_PATTERN.search(body))
+        except (urllib.error.URLError, OSError):
+            return time.perf_counter() - started, True, False
+
+    def run(self, concurrency, duration):
+        results = {name: [] for name in self.endpoints}  # エンドポイント → [(応答時間, エラー, 縮退)]
+        lock = threading.Lock()
+        deadline = time.monotonic() + duration
+
+        def worker(index):
+            rng = random.Random(None if self.seed is None else self.seed * 1000 + index)
+            while time.monotonic() < deadline:
+                endpoint = rng.choices(self.endpoints, self.weights)[0]
+                outcome = self.send(endpoint, self.payload(endpoint, rng))
+                with lock:
+                    results[endpoint].append(outcome)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return {name: summarize(outcomes, elapsed) for name, outcomes in results.items()}
+
+    def server_stats(self):
+        try:
+            with urllib.request.urlopen(f"{self.url}/__stats__", timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except (urllib.error.URLError, OSError, ValueError):
+            return None  # 起動済みのサーバー（デプロイ先など）には無い
+
+
+def summarize(outcomes, elapsed):
+    latencies = sorted(latency for latency, _, _ in outcomes)
+    count = len(outcomes)
+    errors = sum(1 for _, error, _ in outcomes if error)
+    degraded = sum(1 for _, _, is_degraded in outcomes if is_degraded)
+    ms = lambda value: None if value is None else round(value * 1000, 1)
+    return {
+        "requests": count,
+        "throughput": round(count / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "error_rate": round(errors / count, 4) if count else 0.0,
+        "degraded_rate": round(degraded / count, 4) if count else 0.0,
+    }
+
+
+def print_level(concurrency, duration, summary):
+    print(f"\n同時接続 {concurrency}（{duration:g}秒）")
+    print(f"  {'エンドポイント':<16}{'件数':>7}{'件/秒':>9}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'エラー':>9}{'縮退':>9}")
+    for name, s in summary.items():
+        fmt = lambda value: "-" if value is None else f"{value:.0f}"
+        print(
+            f"  {name:<16}{s['requests']:>7}{s['throughput']:>9.1f}{fmt(s['p50_ms']):>10}{fmt(s['p95_ms']):>10}"
+            f"{fmt(s['p99_ms']):>10}{s['error_rate']:>9.1%}{s['degraded_rate']:>9.1%}"
+        )
+
+
+def run(args):
+    process = None
+    url = args.url
+    if not url:
+        process, url = start_server_process(args)
+        print(f"関数のサーバー: {url}（気象庁の代替サーバー・擬似 Gemini 付き）")
+    try:
+        driver = Driver(url, args.mix, args.advice_mode, args.image_kb, args.timeout, args.seed)
+        levels = []
+        for concurrency in args.concurrency:
+            summary = driver.run(concurrency, args.duration)
+            print_level(concurrency, args.duration, summary)
+            levels.append({"concurrency": concurrency, "duration": args.duration,
+                           "endpoints": summary, "server": driver.server_stats()})
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"url": url, "mix": args.mix, "advice_mode": args.advice_mode, "levels": levels},
+                          f, ensure_ascii=False, indent=2)
+            print(f"\n結果を {args.json} に保存しました")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="気象庁と Gemini の代わりを使って関数の負荷試験をします")
+    fakes = argparse.ArgumentParser(add_help=False)
+    fakes.add_argument("--jma-dir", help="気象庁の保存データのディレクトリ（jma_standin.py を参照）")
+    fakes.add_argument("--jma-interval", type=float, default=60, help="観測時刻を10分進める間隔（秒）")
+    fakes.add_argument("--jma-delay", type=float, default=0.05, help="気象庁の代替サーバーの応答時間（秒）")
+    fakes.add_argument("--ai-latency", default="lognormal:0.8,0.4", help="テキスト（アドバイス・推奨事項）の応答時間の分布")
+    fakes.add_argument("--vision-latency", default="lognormal:2.5,0.4", help="画像解析・画像比較の応答時間の分布")
+    fakes.add_argument("--ai-error-rate", type=float, default=0.0, help="擬似 Gemini がエラーを返す割合（0〜1）")
+    fakes.add_argument("--seed", type=int, help="乱数の種（同じ値なら同じ順序で試験する）")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", parents=[fakes], help="関数のサーバーだけを起動する")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--verbose", action="store_true", help="main.py のログを表示する")
+
+    run_parser = commands.add_parser("run", parents=[fakes], help="負荷試験を実行する")
+    run_parser.add_argument("--url", help="試験するサーバー（省略時は関数のサーバーを別プロセスで起動）")
+    run_parser.add_argument("--concurrency", type=lambda v: [int(c) for c in v.split(",")], default=[1, 4, 16],
+                            help="同時接続数（カンマ区切りで順に試す）")
+    run_parser.add_argument("--duration", type=float, default=15, help="同時接続数ごとの試験時間（秒）")
+    run_parser.add_argument("--mix", type=parse_mix, default=parse_mix("heat_risk=8,analyze_image=1,compare_images=1"),
+                            help="エンドポイントごとの割合")
+    run_parser.add_argument("--advice-mode", choices=["fast", "ai"], default="ai", help="heat_risk の advice_mode")
+    run_parser.add_argument("--image-kb", type=int, default=200, help="送る画像の大きさ（KB）")
+    run_parser.add_argument("--timeout", type=float, default=30, help="1件の待ち時間の上限（秒）")
+    run_parser.add_argument("--json", help="結果を保存するJSONファイル")
+    args = parser.parse_args()
+
+    args.ai_latency_spec, args.vision_latency_spec = args.ai_latency, args.vision_latency
+    try:
+        args.ai_latency, args.vision_latency = parse_latency(args.ai_latency), parse_latency(args.vision_latency)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if args.command == "serve":
+        serve(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main_cli()
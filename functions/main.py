@@ -1,19 +1,27 @@
 # =============================================================================
 # 【1. 必要なライブラリをインポート】
 # Webサービスや日時処理、AI機能に必要なツールを読み込みます
+# ※ requests と google.generativeai は読み込みに時間がかかるため、
+#   コールドスタートを速くする目的で「初めて使う時」に読み込みます（【3】参照）
 # =============================================================================
+import time               # 処理時間の測定用（起動時間の計測にも使うため最初に読み込む）
+_MODULE_IMPORT_STARTED = time.perf_counter()  # モジュール読み込み開始時刻
+
 import functions_framework  # Google Cloud Functionsで動かすために必要
-import requests             # 気象庁のデータを取得するために必要
 import math                # 数学計算用
+import bisect              # しきい値の判定（二分探索）用
 import json                # データ形式の変換用
 from datetime import datetime, timezone, timedelta  # 日時の処理用
-import random              # ランダムな値の生成用
 import os                  # 環境変数を読み取るために必要
-import google.generativeai as genai  # Google のAIを使うために必要
+import threading           # 重いライブラリの遅延読み込みを1回だけ行うために必要
+import tempfile            # 一時ファイル（保存データの書き込み）用
+import uuid                # 登録データのID生成用
+import hmac                # 管理用の合言葉の比較用
 import concurrent.futures  # AI処理を時間制限付きで実行するために必要
-import time               # 処理時間の測定用
-import base64             # 画像データの変換用
-import os
+from array import array    # 全国データをコンパクトに保持するための数値配列
+from collections import deque  # 時間帯ごとの最大値の計算（スライディングウィンドウ）用
+from gemini_client import GeminiClient, GeminiBusyError, GeminiShedError, GEMINI_MODEL_NAME  # Gemini共通クライアント
+from request_profiler import profile_request  # 指定したリクエストだけの処理時間の内訳（PROFILE_TOKEN 設定時のみ）
 
 '''
 【このプログラムの全体概要】
@@ -38,15 +46,378 @@ AI_ADVICE_TIMEOUT = 12          # アドバイス生成のタイムアウト
 AI_RECOMMENDATIONS_TIMEOUT = 12   # 推奨事項生成のタイムアウト
 AI_VISION_TIMEOUT = 15           # 画像解析のタイムアウト
 
+# アドバイスの作り方の既定値
+# "fast": 危険レベル別の指針から決まった手順ですぐに作る（AIを待たない）
+# "ai"  : Gemini AIで個別化したアドバイスを作る（失敗時は "fast" と同じ内容）
+ADVICE_MODE = os.environ.get('ADVICE_MODE', 'fast')
+VALID_ADVICE_MODES = ["fast", "ai"]
+
+# 起動直後にバックグラウンドで重いライブラリを読み込んでおくか（"1"で有効）
+# 最小インスタンス設定などで、最初のリクエストより前に準備を済ませたい場合に使う
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', '') == '1'
+
 # =============================================================================
-# 【3. Gemini AIの初期設定】
-# Google のAIサービスに接続するための準備を行います
+# 【3. Gemini AIの初期設定（遅延読み込み）】
+# Google のAIサービスに接続するための準備を、初めて使う時に行います
+# CORSのOPTIONSやフォールバックで済むリクエストでは読み込みを行いません
 # =============================================================================
 # 環境変数からAPIキーを取得（本番環境用）
 # 環境変数が無い場合はNoneとなる
 GEMINI_API_KEY = os.environ.get('API_KEY')
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)  # AIサービスの初期化
+
+# 全てのAI機能で共有するGeminiクライアント（モデルの使い回し・テキストと画像のレーンごとの同時実行数と回数の制限）
+GEMINI_CLIENT = GeminiClient(GEMINI_API_KEY)
+
+_requests_module = None   # 読み込み済みの requests
+_lazy_import_lock = threading.Lock()  # 同時リクエストで二重に読み込まないための鍵
+
+# 起動時間の内訳（秒）。レスポンスのメタデータに含めて確認できるようにする
+STARTUP_PROFILE = {
+    "module_import": None,    # main.py 自体の読み込み時間
+    "requests_import": None,  # requests の読み込み時間（初回使用時）
+    "genai_import": None,     # google.generativeai の読み込み＋モデル作成時間（初回使用時）
+    "warmup": None,           # ウォームアップにかかった時間
+}
+
+
+def get_requests():
+    """
+    requests を初めて使う時に読み込んで返す
+    """
+    global _requests_module
+    if _requests_module is None:
+        with _lazy_import_lock:
+            if _requests_module is None:
+                started = time.perf_counter()
+                import requests
+                _requests_module = requests
+                STARTUP_PROFILE["requests_import"] = round(time.perf_counter() - started, 4)
+    return _requests_module
+
+
+def get_genai():
+    """
+    google.generativeai を初めて使う時に読み込み、APIキーを設定して返す
+    （実際の読み込みは共通クライアント GEMINI_CLIENT が行う）
+    APIキーが無い場合は読み込まずに None を返す
+    """
+    if not GEMINI_API_KEY:
+        return None
+    genai = GEMINI_CLIENT.load()
+    STARTUP_PROFILE["genai_import"] = GEMINI_CLIENT.import_seconds
+    return genai
+
+
+def warmup():
+    """
+    重いライブラリの読み込みとGeminiモデルの作成を先に済ませておくウォームアップ処理
+    WARMUP_ON_START=1 の時は起動直後にバックグラウンドで実行される
+    """
+    started = time.perf_counter()
+    try:
+        get_requests()
+        get_genai()
+    except Exception as e:
+        print(f"ウォームアップ処理でエラー: {e}")
+    STARTUP_PROFILE["warmup"] = round(time.perf_counter() - started, 4)
+    return dict(STARTUP_PROFILE)
+
+
+# =============================================================================
+# 【3-2. AIサーキットブレーカー】
+# Geminiが遅い・失敗続きの時に、毎回タイムアウトまで待たずに
+# すぐ固定メッセージへ切り替えるための仕組み（全てのAI機能で共有）
+#
+#   closed    : 通常状態。AIを呼び出し、成功・失敗を記録する
+#   open      : 失敗率が高いので、クールダウン中はAIを呼ばずに即フォールバック
+#   half_open : クールダウン後、試しに1件だけAIを呼んで回復したか確認する
+# =============================================================================
+AI_BREAKER_WINDOW_SECONDS = 60     # 失敗率を計算する直近の時間幅（秒）
+AI_BREAKER_MIN_CALLS = 5           # 判定に必要な最低呼び出し回数
+AI_BREAKER_FAILURE_RATE = 0.5      # この割合以上が失敗・タイムアウトなら作動
+AI_BREAKER_COOLDOWN_SECONDS = 30   # 作動後にAIを呼ばない時間（秒）
+
+
+class AICircuitBreaker:
+    """
+    直近のAI呼び出し結果（成功/失敗/タイムアウト）を記録し、
+    AIを呼んでよいかを判定するサーキットブレーカー
+    """
+
+    def __init__(self, window_seconds=AI_BREAKER_WINDOW_SECONDS, min_calls=AI_BREAKER_MIN_CALLS,
+                 failure_rate=AI_BREAKER_FAILURE_RATE, cooldown_seconds=AI_BREAKER_COOLDOWN_SECONDS):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._events = []          # (時刻, 結果) の一覧。結果は "success" / "timeout" / "error"
+        self._state = "closed"
+        self._opened_at = None     # open になった時刻
+        self._probe_token = None   # half_open で試行中の呼び出しのトークン
+        self._trip_count = 0       # これまでに作動した回数
+
+    def _prune(self, now):
+        cutoff = now - self.window_seconds
+        while self._events and self._events[0][0] < cutoff:
+            self._events.pop(0)
+
+    def allow_request(self):
+        """
+        AIを呼び出してよいかを判定し、よければトークンを返す（だめなら None）
+        トークンは結果を記録する record / cancel にそのまま渡す
+        half_open の時は、同時に1件だけ試行（プローブ）を許可する
+        """
+        with self._lock:
+            now = time.time()
+            if self._state == "open":
+                if now - self._opened_at < self.cooldown_seconds:
+                    return None
+                self._state = "half_open"
+            token = object()
+            if self._state == "half_open":
+                if self._probe_token is not None:
+                    return None
+                self._probe_token = token
+            return token
+
+    def record(self, outcome, token):
+        """
+        AI呼び出しの結果を記録する
+        outcome: "success" / "timeout" / "error"
+        token  : allow_request が返したトークン（None の場合は記録しない）
+        half_open の時は、試行のトークンの結果だけで回復したかを判定する
+        （作動前に受け付けて遅れて終わった呼び出しの結果では判定しない）
+        """
+        if token is None:
+            return
+        with self._lock:
+            now = time.time()
+            if self._state == "half_open":
+                if token is not self._probe_token:
+                    return
+                self._probe_token = None
+                if outcome == "success":
+                    # 試行が成功したので通常状態に戻す
+                    self._state = "closed"
+                    self._events = []
+                else:
+                    # まだ回復していないので再びクールダウン
+                    self._state = "open"
+                    self._opened_at = now
+                    self._trip_count += 1
+                return
+
+            self._events.append((now, outcome))
+            self._prune(now)
+            if self._state == "closed" and len(self._events) >= self.min_calls:
+                failures = sum(1 for _, o in self._events if o != "success")
+                if failures / len(self._events) >= self.failure_rate:
+                    print(f"⚠️ AIサーキットブレーカー作動: 直近{len(self._events)}件中{failures}件が失敗")
+                    self._state = "open"
+                    self._opened_at = now
+                    self._trip_count += 1
+
+    def cancel(self, token):
+        """
+        allow_request で許可されたが、AIを呼び出さずに終わった場合に呼ぶ
+        （試行のトークンなら half_open の試行枠を返す。成功・失敗としては数えない）
+        """
+        with self._lock:
+            if token is not None and token is self._probe_token:
+                self._probe_token = None
+
+    def snapshot(self):
+        """
+        レスポンスのメタデータ用に現在の状態を返す
+        """
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            total = len(self._events)
+            timeouts = sum(1 for _, o in self._events if o == "timeout")
+            errors = sum(1 for _, o in self._events if o == "error")
+            state = self._state
+            if state == "open" and now - self._opened_at >= self.cooldown_seconds:
+                state = "half_open"
+            return {
+                "state": state,
+                "recent_calls": total,
+                "recent_timeout_rate": round(timeouts / total, 3) if total else 0.0,
+                "recent_error_rate": round(errors / total, 3) if total else 0.0,
+                "cooldown_remaining": round(max(0.0, self.cooldown_seconds - (now - self._opened_at)), 1) if state == "open" else 0.0,
+                "trip_count": self._trip_count,
+            }
+
+
+# 全てのAI機能で共有するサーキットブレーカー
+AI_CIRCUIT_BREAKER = AICircuitBreaker()
+
+
+# =============================================================================
+# 【4-0. 決まった手順で作るアドバイス（高速モード）】
+# 危険レベル別の指針と年齢別の注意点を組み合わせて、AIと同じ4つの観点
+# （水分補給・空調設定・体調確認・行動制限）のアドバイスをすぐに作ります
+# AIを待たないため、通常はこちらを使い、AIは必要な時だけ追加で使います
+# =============================================================================
+
+# 年齢グループ・危険レベルごとの一言まとめ（アドバイスの先頭に表示）
+ADVICE_SUMMARIES = {
+    "0-1": {
+        "ほぼ安全": "乳児も安心して過ごせます。15分間隔で様子観察が大切です。授乳による水分補給を心がけてください。",
+        "注意": "5-10分に一度は様子確認を。体温チェックが重要です。頻繁な水分補給を行いましょう。",
+        "警戒": "短時間の外出のみ推奨。保育者の継続的な観察が必須です。10分以内の活動に留めてください。",
+        "厳重警戒": "外出は最小限に。室内で涼しく過ごしましょう。5分以内の短時間活動を推奨します。",
+        "危険レベル1": "外出中止を強く推奨。室内で涼しい環境を保ちます。こまめな体調確認をしてください。",
+        "高危険レベル2": "完全屋内待機。エアコン必須で体温管理を徹底してください。医療機関への相談も検討しましょう。",
+        "非常に危険レベル3": "緊急レベル。完全屋内待機でエアコン稼働必須。少しでも異変があれば即座に医療機関へ。"
+    },
+    "2-3": {
+        "ほぼ安全": "安心して遊べます。本人の様子をよく観察します。15-30分間隔で水分補給を促しましょう。",
+        "注意": "15分に一度は水分補給の声かけを。体調変化を注意深く観察してください。日陰での休憩も大切です。",
+        "警戒": "こまめな水分補給と休憩を。体調の変化に敏感に対応します。20分以内の活動にしましょう。",
+        "厳重警戒": "短時間の外遊びのみ。帽子・日陰必須です。本人の訴えを注意深く聞きます。15分以内を推奨します。",
+        "危険レベル1": "外遊び中止を推奨。室内活動を優先します。異変があればすぐに対応してください。",
+        "高危険レベル2": "完全屋内活動。エアコンで涼しく保ち、水分補給を強化してください。体調変化に最大限注意を。",
+        "非常に危険レベル3": "緊急レベル。屋外活動完全禁止。エアコン稼働で体温管理を徹底し、医療機関への相談を検討してください。"
+    },
+    "4-6": {
+        "ほぼ安全": "元気に遊べます。のどが渇いたら言うように教えます。30分間隔で水分補給を促しましょう。",
+        "注意": "20-30分に一度は水分補給を。体調について聞いてあげます。適度な休憩を取りましょう。",
+        "警戒": "こまめな水分補給と休憩を。体調の変化を自分で伝えるよう促します。適切な対策を心がけてください。",
+        "厳重警戒": "外遊びは短時間に。体調不良の兆候を伝えるよう教えます。30分以内の活動を推奨します。",
+        "危険レベル1": "屋外での活動は中止。自分の体調変化を大人に伝える練習をします。室内で過ごしましょう。",
+        "高危険レベル2": "完全屋内活動。エアコンで涼しく保ち、体調の変化を積極的に伝えるよう指導してください。",
+        "非常に危険レベル3": "緊急レベル。屋外活動完全禁止。体調不良時の症状を教え、異変時は即座に大人に伝えるよう徹底してください。"
+    }
+}
+
+# 危険レベル別の指針（AIへの指示にも使う）
+RISK_LEVEL_GUIDANCE = {
+    "非常に危険レベル3": {
+        "water": "子ども用コップ（150-200ml）で4-5杯、10-15分間隔で強制的に摂取",
+        "aircon": "22-24℃に即座に調整し、エアコンをフル稼働",
+        "check": "顔色や元気さを3-5分ごとに厳重チェック",
+        "activity": "屋外活動は完全禁止。外出は移動も含めて最小限に",
+        "adult": "大人が40-45℃相当の極度の暑さを感じる非常に危険な状況"
+    },
+    "高危険レベル2": {
+        "water": "子ども用コップ（150-200ml）で3-4杯、15-20分間隔で積極的に摂取",
+        "aircon": "24-26℃に調整し、エアコンを強めに設定",
+        "check": "顔色や元気さを5-10分ごとに頻繁チェック",
+        "activity": "屋外活動は行わず、完全に屋内で過ごす",
+        "adult": "大人が35-40℃相当の強い暑さを感じる危険な状況"
+    },
+    "危険レベル1": {
+        "water": "子ども用コップ（150-200ml）で2-3杯、20-30分間隔で定期摂取",
+        "aircon": "26-27℃に調整し、エアコンを適切に設定",
+        "check": "顔色や元気さを10-15分ごとに定期チェック",
+        "activity": "外遊びは中止し、室内での活動を優先",
+        "adult": "大人が30-35℃相当の暑さを感じる注意が必要な状況"
+    },
+    "厳重警戒": {
+        "water": "子ども用コップ（150-200ml）で2-3杯、20分間隔で摂取",
+        "aircon": "26-27℃に設定し、室内を涼しく保つ",
+        "check": "顔色や元気さを10分ごとにチェック",
+        "activity": "外遊びは短時間に限る。10-14時の外出は避ける",
+        "adult": "大人が30-33℃相当の暑さを感じる状況"
+    },
+    "警戒": {
+        "water": "子ども用コップ（150-200ml）で2杯、20-30分間隔で摂取",
+        "aircon": "26-28℃に設定し、暑さを感じたらすぐに下げる",
+        "check": "顔色や元気さを15分ごとにチェック",
+        "activity": "外遊びは短時間にし、日向を避けて日陰で遊ぶ",
+        "adult": "大人が28-32℃相当の暑さを感じる状況"
+    },
+    "注意": {
+        "water": "子ども用コップ（150-200ml）で1-2杯、25-30分間隔で摂取",
+        "aircon": "27-28℃を目安に設定",
+        "check": "顔色や元気さを15-20分ごとにチェック",
+        "activity": "外遊びは1時間以内を目安に、30分ごとに日陰で休憩",
+        "adult": "大人が25-30℃相当の暑さを感じる状況"
+    },
+    "ほぼ安全": {
+        "water": "子ども用コップ（150-200ml）で1杯、30-40分間隔で摂取",
+        "aircon": "28℃前後を目安に、風通しを良くする",
+        "check": "顔色や元気さを20-30分ごとにチェック",
+        "activity": "通常の外遊びが可能。1時間ごとに日陰で休憩",
+        "adult": "大人が過ごしやすいと感じる状況"
+    }
+}
+
+# 年齢グループ・危険レベルごとの外遊びの時間の目安（ADVICE_SUMMARIES の時間と合わせる）
+# 危険レベル別の指針（RISK_LEVEL_GUIDANCE）は全年齢共通のため、時間はこちらにだけ書く
+AGE_ACTIVITY_TIME_LIMITS = {
+    "0-1": {"警戒": "活動は10分以内に留める", "厳重警戒": "活動は5分以内の短時間に留める"},
+    "2-3": {"警戒": "活動は20分以内にする", "厳重警戒": "外遊びは15分以内にする"},
+    "4-6": {"厳重警戒": "外遊びは30分以内にする"},
+}
+
+# 年齢グループ別の注意点（危険レベル別の指針に付け加える）
+AGE_GROUP_ADVICE_NOTES = {
+    "0-1": {
+        "water": "授乳・ミルクの回数も増やす",
+        "check": "体調を伝えられないため、泣き声やおむつの濡れ具合も確認",
+        "activity": "ベビーカーは地面の照り返しを強く受けるため特に注意"
+    },
+    "2-3": {
+        "water": "飲みたがらない時も声をかけて少しずつ飲ませる",
+        "check": "前兆に気づけないため、大人が汗のかき方や機嫌の変化を確認",
+        "activity": "遊びに夢中になりやすいので、大人が時間を決めて休憩させる"
+    },
+    "4-6": {
+        "water": "のどが渇いたら自分で伝えるよう教える",
+        "check": "「だるい」「頭が痛い」などを自分で伝えるよう声をかける",
+        "activity": "休憩のタイミングを一緒に決めて守る練習をする"
+    }
+}
+
+
+def render_deterministic_advice(age_group, risk_level):
+    """
+    【機能説明】
+    危険レベル別の指針と年齢別の注意点から、AIと同じ形式のアドバイスを作る
+    （AIを使わないため、1ミリ秒もかからない）
+
+    【出力データ】
+    〇水分補給 / 〇空調設定 / 〇体調確認 / 〇行動制限 の4項目のアドバイス文章
+    """
+    summary = ADVICE_SUMMARIES.get(age_group, ADVICE_SUMMARIES["2-3"]).get(risk_level, "適切な対策を心がけてください")
+    guidance = RISK_LEVEL_GUIDANCE.get(risk_level, RISK_LEVEL_GUIDANCE["危険レベル1"])
+    notes = AGE_GROUP_ADVICE_NOTES.get(age_group, AGE_GROUP_ADVICE_NOTES["2-3"])
+    time_limit = AGE_ACTIVITY_TIME_LIMITS.get(age_group, AGE_ACTIVITY_TIME_LIMITS["2-3"]).get(risk_level)
+    activity = f"{time_limit}\n{guidance['activity']}" if time_limit else guidance["activity"]
+    return f"""{summary}
+
+〇水分補給
+{guidance["water"]}
+{notes["water"]}
+
+〇空調設定
+{guidance["aircon"]}
+エアコンの風が直接当たらないよう向きを調整し、扇風機で空気を循環させる
+
+〇体調確認
+{guidance["check"]}
+{notes["check"]}
+
+〇行動制限
+{activity}
+{notes["activity"]}"""
+
+
+def generate_deterministic_advice(age_group, risk_level):
+    """
+    高速モードのアドバイス（generate_ai_advice と同じ形式の結果を返す）
+    """
+    start_time = time.time()
+    return {
+        "result": render_deterministic_advice(age_group, risk_level),
+        "ai_generated": False,
+        "processing_time": time.time() - start_time,
+        "status": "deterministic"
+    }
+
 
 # =============================================================================
 # 【4. AIアドバイス生成機能】
@@ -77,40 +448,10 @@ def generate_ai_advice(wbgt, age_group, temperature, humidity, risk_level, conte
     
     # =============================================================================
     # 【4-1. 緊急時用のメッセージを準備】
-    # AIが使えない時や時間がかかりすぎる時用の、予め用意されたアドバイス
+    # AIが使えない時や時間がかかりすぎる時は、決まった手順で作ったアドバイスを返す
     # =============================================================================
-    fallback_messages = {
-        "0-1": {
-            "ほぼ安全": "乳児も安心して過ごせます。15分間隔で様子観察が大切です。授乳による水分補給を心がけてください。",
-            "注意": "5-10分に一度は様子確認を。体温チェックが重要です。頻繁な水分補給を行いましょう。",
-            "警戒": "短時間の外出のみ推奨。保育者の継続的な観察が必須です。10分以内の活動に留めてください。",
-            "厳重警戒": "外出は最小限に。室内で涼しく過ごしましょう。5分以内の短時間活動を推奨します。",
-            "危険レベル1": "外出中止を強く推奨。室内で涼しい環境を保ちます。こまめな体調確認をしてください。",
-            "高危険レベル2": "完全屋内待機。エアコン必須で体温管理を徹底してください。医療機関への相談も検討しましょう。",
-            "非常に危険レベル3": "緊急レベル。完全屋内待機でエアコン稼働必須。少しでも異変があれば即座に医療機関へ。"
-        },
-        "2-3": {
-            "ほぼ安全": "安心して遊べます。本人の様子をよく観察します。15-30分間隔で水分補給を促しましょう。",
-            "注意": "15分に一度は水分補給の声かけを。体調変化を注意深く観察してください。日陰での休憩も大切です。",
-            "警戒": "こまめな水分補給と休憩を。体調の変化に敏感に対応します。20分以内の活動にしましょう。",
-            "厳重警戒": "短時間の外遊びのみ。帽子・日陰必須です。本人の訴えを注意深く聞きます。15分以内を推奨します。",
-            "危険レベル1": "外遊び中止を推奨。室内活動を優先します。異変があればすぐに対応してください。",
-            "高危険レベル2": "完全屋内活動。エアコンで涼しく保ち、水分補給を強化してください。体調変化に最大限注意を。",
-            "非常に危険レベル3": "緊急レベル。屋外活動完全禁止。エアコン稼働で体温管理を徹底し、医療機関への相談を検討してください。"
-        },
-        "4-6": {
-            "ほぼ安全": "元気に遊べます。のどが渇いたら言うように教えます。30分間隔で水分補給を促しましょう。",
-            "注意": "20-30分に一度は水分補給を。体調について聞いてあげます。適度な休憩を取りましょう。",
-            "警戒": "こまめな水分補給と休憩を。体調の変化を自分で伝えるよう促します。適切な対策を心がけてください。",
-            "厳重警戒": "外遊びは短時間に。体調不良の兆候を伝えるよう教えます。30分以内の活動を推奨します。",
-            "危険レベル1": "屋外での活動は中止。自分の体調変化を大人に伝える練習をします。室内で過ごしましょう。",
-            "高危険レベル2": "完全屋内活動。エアコンで涼しく保ち、体調の変化を積極的に伝えるよう指導してください。",
-            "非常に危険レベル3": "緊急レベル。屋外活動完全禁止。体調不良時の症状を教え、異変時は即座に大人に伝えるよう徹底してください。"
-        }
-    }
-    
-    # 年齢グループと危険レベルに応じたメッセージを選択
-    fallback_message = fallback_messages.get(age_group, fallback_messages["2-3"]).get(risk_level, "適切な対策を心がけてください")
+    # 年齢グループと危険レベルに応じたメッセージを作成
+    fallback_message = render_deterministic_advice(age_group, risk_level)
     
     # =============================================================================
     # 【4-2. AIが使えるかチェック】
@@ -123,59 +464,46 @@ def generate_ai_advice(wbgt, age_group, temperature, humidity, risk_level, conte
             "processing_time": time.time() - start_time,
             "status": "fallback_no_api_key"
         }
+
+    # AIが不調でブレーカーが作動中なら、待たずに固定メッセージを返す
+    breaker_token = AI_CIRCUIT_BREAKER.allow_request()
+    if breaker_token is None:
+        return {
+            "result": fallback_message,
+            "ai_generated": False,
+            "processing_time": time.time() - start_time,
+            "status": "circuit_open"
+        }
     
     # =============================================================================
     # 【4-3. AI処理の実行部分】
     # 実際にGemini AIにアドバイス生成を依頼する処理
+    # （プロンプトを先に作り、同じプロンプトの処理が実行中なら submit の時点で結果を共有する）
     # =============================================================================
-    def ai_advice_worker():
-        try:
-            # 年齢グループに応じた説明
-            age_descriptions = {
-                "0-1": "0-1歳の乳児（身長約0.6-0.8m、自身の体調について伝えることができない、最も地面に近く暑さの影響を強く受ける）",
-                "2-3": "2-3歳の幼児（身長約0.8-1.0m、言葉は覚えるが体調が悪くなりそうなど前兆がわからない、経験が乏しい）",
-                "4-6": "4-6歳の幼児・園児（身長約1.0-1.2m、ある程度自分のことを伝えられるようになる）"
-            }
-            
-            # 現在の時刻を取得
-            current_time = datetime.now(timezone.utc)
-            current_time = current_time.astimezone(timezone(timedelta(hours=9)))  # JSTに変換
-            time_context = ""
-            if 6 <= current_time.hour <= 10:
-                time_context = "朝の時間帯"
-            elif 10 <= current_time.hour <= 14:
-                time_context = "日中の最も暑い時間帯"
-            elif 14 <= current_time.hour <= 18:
-                time_context = "午後の時間帯"
-            else:
-                time_context = "夜間"
-
-            # 危険レベル別の詳細指示を含むプロンプト
-            risk_level_guidance = {
-                "非常に危険レベル3": {
-                    "water": "子ども用コップ（150-200ml）で4-5杯、10-15分間隔で強制的に摂取",
-                    "aircon": "22-24℃に即座に調整し、エアコンをフル稼働",
-                    "check": "顔色や元気さを3-5分ごとに厳重チェック",
-                    "adult": "大人が40-45℃相当の極度の暑さを感じる非常に危険な状況"
-                },
-                "高危険レベル2": {
-                    "water": "子ども用コップ（150-200ml）で3-4杯、15-20分間隔で積極的に摂取",
-                    "aircon": "24-26℃に調整し、エアコンを強めに設定",
-                    "check": "顔色や元気さを5-10分ごとに頻繁チェック",
-                    "adult": "大人が35-40℃相当の強い暑さを感じる危険な状況"
-                },
-                "危険レベル1": {
-                    "water": "子ども用コップ（150-200ml）で2-3杯、20-30分間隔で定期摂取",
-                    "aircon": "26-27℃に調整し、エアコンを適切に設定",
-                    "check": "顔色や元気さを10-15分ごとに定期チェック",
-                    "adult": "大人が30-35℃相当の暑さを感じる注意が必要な状況"
-                }
-            }
-            
-            # リスクレベルに応じた指示を取得
-            current_guidance = risk_level_guidance.get(risk_level, risk_level_guidance["危険レベル1"])
-            
-            prompt = f"""
+    # 年齢グループに応じた説明
+    age_descriptions = {
+        "0-1": "0-1歳の乳児（身長約0.6-0.8m、自身の体調について伝えることができない、最も地面に近く暑さの影響を強く受ける）",
+        "2-3": "2-3歳の幼児（身長約0.8-1.0m、言葉は覚えるが体調が悪くなりそうなど前兆がわからない、経験が乏しい）",
+        "4-6": "4-6歳の幼児・園児（身長約1.0-1.2m、ある程度自分のことを伝えられるようになる）"
+    }
+    
+    # 現在の時刻を取得
+    current_time = datetime.now(timezone.utc)
+    current_time = current_time.astimezone(timezone(timedelta(hours=9)))  # JSTに変換
+    time_context = ""
+    if 6 <= current_time.hour <= 10:
+        time_context = "朝の時間帯"
+    elif 10 <= current_time.hour <= 14:
+        time_context = "日中の最も暑い時間帯"
+    elif 14 <= current_time.hour <= 18:
+        time_context = "午後の時間帯"
+    else:
+        time_context = "夜間"
+
+    # 危険レベル別の詳細指示（RISK_LEVEL_GUIDANCE）を取得
+    current_guidance = RISK_LEVEL_GUIDANCE.get(risk_level, RISK_LEVEL_GUIDANCE["危険レベル1"])
+    
+    prompt = f"""
 子どもの熱中症予防専門家として、以下の状況に基づいて実用的なアドバイスを生成してください。
 
 【状況】
@@ -209,21 +537,18 @@ def generate_ai_advice(wbgt, age_group, temperature, humidity, risk_level, conte
 
 上記の形式で、現在の状況に最適なアドバイスを生成してください。挨拶や説明は不要です。"""
 
-            # Gemini APIを呼び出し（最も安価なモデルを使用）
-            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-            response = model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=250,  # 出力を増やして完全なアドバイスを取得
-                    temperature=0.7
-                )
-            )
+    def ai_advice_worker():
+        try:
+            # Gemini APIを呼び出し（共通クライアント経由、最も安価なモデルを使用）
+            response = GEMINI_CLIENT.generate("advice", prompt, deadline=deadline)
             
             if response.text:
                 return response.text.strip()
             else:
                 return None
                 
+        except GeminiBusyError:
+            raise  # 実行枠が取れなかった場合は呼び出し元で判定する
         except Exception as e:
             print(f"Gemini API呼び出しエラー: {e}")
             return None
@@ -233,39 +558,69 @@ def generate_ai_advice(wbgt, age_group, temperature, humidity, risk_level, conte
     # AIの応答が遅い場合は諦めて、固定メッセージを返す仕組み
     # =============================================================================
     try:
-        # AIの処理を別スレッドで実行（時間制限付き）
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(ai_advice_worker)  # AI処理を開始
-            try:
-                # 指定時間内にAIから結果を取得
-                ai_result = future.result(timeout=timeout)
-                
-                if ai_result:  # AIが正常に応答した場合
-                    return {
-                        "result": ai_result,
-                        "ai_generated": True,
-                        "processing_time": time.time() - start_time,
-                        "status": "success"
-                    }
-                else:  # AIが失敗した場合
-                    return {
-                        "result": fallback_message,
-                        "ai_generated": False,
-                        "processing_time": time.time() - start_time,
-                        "status": "ai_failed"
-                    }
-                    
-            except concurrent.futures.TimeoutError:  # 時間切れの場合
-                print(f"AI アドバイス生成がタイムアウトしました（{timeout}秒）")
+        # AIの処理を共有スレッドプールで実行（時間制限付き）
+        deadline = time.monotonic() + timeout  # この時刻までにAIの実行枠が取れなければ諦める
+        try:
+            # AI処理を開始（混雑していて時間内に終わらない見込みなら、受け付けずに固定メッセージにする）
+            future = GEMINI_CLIENT.submit("advice", ai_advice_worker, timeout,
+                                          key=GEMINI_CLIENT.flight_key("advice", prompt))
+            if not GEMINI_CLIENT.owns(future, ai_advice_worker):
+                # 実行中の同じ呼び出しの結果を共有するだけなので、ブレーカーへの記録は受け付けた呼び出し元に任せる
+                AI_CIRCUIT_BREAKER.cancel(breaker_token)
+                breaker_token = None
+            # 指定時間内にAIから結果を取得
+            ai_result = future.result(timeout=timeout)
+            
+            if ai_result:  # AIが正常に応答した場合
+                AI_CIRCUIT_BREAKER.record("success", breaker_token)
+                return {
+                    "result": ai_result,
+                    "ai_generated": True,
+                    "processing_time": time.time() - start_time,
+                    "status": "success"
+                }
+            else:  # AIが失敗した場合
+                AI_CIRCUIT_BREAKER.record("error", breaker_token)
                 return {
                     "result": fallback_message,
                     "ai_generated": False,
-                    "processing_time": timeout,
-                    "status": "timeout"
+                    "processing_time": time.time() - start_time,
+                    "status": "ai_failed"
                 }
-            
+                
+        except concurrent.futures.TimeoutError:  # 時間切れの場合
+            print(f"AI アドバイス生成がタイムアウトしました（{timeout}秒）")
+            AI_CIRCUIT_BREAKER.record("timeout", breaker_token)
+            return {
+                "result": fallback_message,
+                "ai_generated": False,
+                "processing_time": timeout,
+                "status": "timeout"
+            }
+
+        except GeminiShedError as e:  # 混雑のため受け付けなかった場合
+            print(f"AI アドバイス生成を見送りました: {e}")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            return {
+                "result": fallback_message,
+                "ai_generated": False,
+                "processing_time": time.time() - start_time,
+                "status": "shed"
+            }
+
+        except GeminiBusyError:  # 同時実行数・回数制限で実行できなかった場合
+            print("AI アドバイス生成の実行枠が確保できませんでした")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            return {
+                "result": fallback_message,
+                "ai_generated": False,
+                "processing_time": time.time() - start_time,
+                "status": "rate_limited"
+            }
+        
     except Exception as e:  # その他のエラーが発生した場合
         print(f"AI アドバイス生成で予期しないエラー: {e}")
+        AI_CIRCUIT_BREAKER.record("error", breaker_token)
         return {
             "result": fallback_message,
             "ai_generated": False,
@@ -277,11 +632,12 @@ def generate_ai_advice(wbgt, age_group, temperature, humidity, risk_level, conte
 # 【5. 詳細推奨事項生成機能】
 # 基本的なアドバイスに加えて、より詳しい推奨事項をAIが自動生成します
 # =============================================================================
-def generate_detailed_recommendations(wbgt, age_group, temperature, humidity, risk_level, weather_data, timeout=AI_RECOMMENDATIONS_TIMEOUT):
+def generate_detailed_recommendations(wbgt, age_group, temperature, humidity, risk_level, weather_data, timeout=AI_RECOMMENDATIONS_TIMEOUT, use_ai=True):
     """
     【機能説明】
     基本的なアドバイスに加えて、より詳しい推奨事項を
     AIが年齢と気象状況に合わせて自動生成する機能
+    （use_ai=False の場合はAIを使わず、固定の推奨事項をすぐに返す）
     """
     start_time = time.time()
     
@@ -306,15 +662,23 @@ def generate_detailed_recommendations(wbgt, age_group, temperature, humidity, ri
         "processing_time": time.time() - start_time,
         "status": "fallback"
     }
+
+    if not use_ai:  # 高速モード
+        fallback_result["status"] = "deterministic"
+        return fallback_result
     
     if not GEMINI_API_KEY:
         fallback_result["status"] = "fallback_no_api_key"
         return fallback_result
+
+    # AIが不調でブレーカーが作動中なら、待たずにフォールバックを返す
+    breaker_token = AI_CIRCUIT_BREAKER.allow_request()
+    if breaker_token is None:
+        fallback_result["status"] = "circuit_open"
+        return fallback_result
     
-    def recommendations_worker():
-        try:
-            # 改善されたプロンプト（JSONのみ出力）
-            prompt = f"""
+    # 改善されたプロンプト（JSONのみ出力）
+    prompt = f"""
 {{
     "general": ["十分な水分補給を心がける", "こまめな休憩を取る", "涼しい服装を選ぶ", "日陰を利用する"],
     "age_specific": ["保護者による頻繁な確認", "短時間の外出に留める", "室内での活動を優先"]
@@ -322,14 +686,9 @@ def generate_detailed_recommendations(wbgt, age_group, temperature, humidity, ri
 
 上記の形式で、WBGT{wbgt}℃、リスク{risk_level}、年齢{age_group}歳の状況に応じた推奨事項をJSONで出力してください。説明文は不要です。"""
 
-            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-            response = model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=300,  # 出力を制限
-                    temperature=0.5
-                )
-            )
+    def recommendations_worker():
+        try:
+            response = GEMINI_CLIENT.generate("recommendations", prompt, deadline=deadline)
             
             if response.text:
                 try:
@@ -344,35 +703,63 @@ def generate_detailed_recommendations(wbgt, age_group, temperature, humidity, ri
             
             return None
             
+        except GeminiBusyError:
+            raise  # 実行枠が取れなかった場合は呼び出し元で判定する
         except Exception as e:
             print(f"詳細推奨事項生成エラー: {e}")
             return None
     
     try:
-        # タイムアウト付きでAI処理を実行
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(recommendations_worker)
-            try:
-                ai_result = future.result(timeout=timeout)
-                if ai_result and isinstance(ai_result, dict) and "general" in ai_result:
-                    ai_result.update({
-                        "ai_generated": True,
-                        "processing_time": time.time() - start_time,
-                        "status": "success"
-                    })
-                    return ai_result
-                else:
-                    fallback_result["status"] = "ai_failed"
-                    return fallback_result
-                    
-            except concurrent.futures.TimeoutError:
-                print(f"AI 推奨事項生成がタイムアウトしました（{timeout}秒）")
-                fallback_result["status"] = "timeout"
-                fallback_result["processing_time"] = timeout
+        # タイムアウト付きでAI処理を実行（共有スレッドプール）
+        deadline = time.monotonic() + timeout  # この時刻までにAIの実行枠が取れなければ諦める
+        try:
+            # 混雑していて時間内に終わらない見込みなら、受け付けずに固定メッセージにする
+            future = GEMINI_CLIENT.submit("recommendations", recommendations_worker, timeout,
+                                          key=GEMINI_CLIENT.flight_key("recommendations", prompt))
+            if not GEMINI_CLIENT.owns(future, recommendations_worker):
+                # 実行中の同じ呼び出しの結果を共有するだけなので、ブレーカーへの記録は受け付けた呼び出し元に任せる
+                AI_CIRCUIT_BREAKER.cancel(breaker_token)
+                breaker_token = None
+            ai_result = future.result(timeout=timeout)
+            if ai_result and isinstance(ai_result, dict) and "general" in ai_result:
+                # 同じプロンプトの呼び出し同士で結果を共有しているため、コピーに書き加える
+                ai_result = {
+                    **ai_result,
+                    "ai_generated": True,
+                    "processing_time": time.time() - start_time,
+                    "status": "success"
+                }
+                AI_CIRCUIT_BREAKER.record("success", breaker_token)
+                return ai_result
+            else:
+                AI_CIRCUIT_BREAKER.record("error", breaker_token)
+                fallback_result["status"] = "ai_failed"
                 return fallback_result
                 
+        except concurrent.futures.TimeoutError:
+            print(f"AI 推奨事項生成がタイムアウトしました（{timeout}秒）")
+            AI_CIRCUIT_BREAKER.record("timeout", breaker_token)
+            fallback_result["status"] = "timeout"
+            fallback_result["processing_time"] = timeout
+            return fallback_result
+
+        except GeminiShedError as e:
+            print(f"AI 推奨事項生成を見送りました: {e}")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            fallback_result["status"] = "shed"
+            fallback_result["processing_time"] = time.time() - start_time
+            return fallback_result
+
+        except GeminiBusyError:
+            print("AI 推奨事項生成の実行枠が確保できませんでした")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            fallback_result["status"] = "rate_limited"
+            fallback_result["processing_time"] = time.time() - start_time
+            return fallback_result
+            
     except Exception as e:
         print(f"AI 推奨事項生成で予期しないエラー: {e}")
+        AI_CIRCUIT_BREAKER.record("error", breaker_token)
         fallback_result["status"] = "error"
         fallback_result["processing_time"] = time.time() - start_time
         return fallback_result
@@ -454,7 +841,50 @@ def calculate_wbgt(temp, humidity, wind_speed=None, solar_radiation=None):
 # 【7. 熱中症リスクレベル判定機能】
 # 子供の年齢に応じて、暑さ指数から熱中症の危険度を判定します
 # =============================================================================
-def get_heat_risk_level(wbgt, age_group="2-3", temperature=None, humidity=None):
+# 年齢別危険度しきい値（WBGT ℃）
+# 子供は大人より地面に近く、より暑い環境にいるため基準を厳しく設定
+# 体調を伝えられない年齢ほど、より厳しい基準を適用
+HEAT_RISK_THRESHOLDS = {
+    # 0-1歳（乳児）：体調を伝えられないため最も厳しい基準
+    "0-1": {"注意": 16, "警戒": 19, "厳重警戒": 22, "危険レベル1": 25, "高危険レベル2": 28, "非常に危険レベル3": 31},
+    # 2-3歳（幼児）：経験が乏しく前兆がわからないため厳しい基準
+    "2-3": {"注意": 17, "警戒": 20, "厳重警戒": 23, "危険レベル1": 26, "高危険レベル2": 29, "非常に危険レベル3": 32},
+    # 4-6歳（園児）：ある程度伝えられるが地面に近いため注意が必要
+    "4-6": {"注意": 18, "警戒": 21, "厳重警戒": 24, "危険レベル1": 27, "高危険レベル2": 30, "非常に危険レベル3": 33},
+}
+
+# 危険レベルの順番（低い → 高い）
+RISK_LEVELS = ["ほぼ安全", "注意", "警戒", "厳重警戒", "危険レベル1", "高危険レベル2", "非常に危険レベル3"]
+
+# アプリの画面で表示する色
+RISK_COLORS = {"ほぼ安全": "blue", "注意": "yellow", "警戒": "orange", "厳重警戒": "red", "危険レベル1": "#FF3300", "高危険レベル2": "#D31919", "非常に危険レベル3": "#740303"}
+
+# 年齢グループごとのしきい値を昇順に並べたもの（一括判定用）
+_THRESHOLD_BOUNDS = {
+    group: [th[level] for level in RISK_LEVELS[1:]] for group, th in HEAT_RISK_THRESHOLDS.items()
+}
+
+
+def classify_wbgt(wbgt, age_group="2-3"):
+    """
+    暑さ指数(WBGT)を年齢別のしきい値と比較して危険レベル名を返す
+    （指定が無い・不明な年齢グループは2-3歳の基準）
+    """
+    bounds = _THRESHOLD_BOUNDS.get(age_group, _THRESHOLD_BOUNDS["2-3"])
+    return RISK_LEVELS[bisect.bisect_right(bounds, wbgt)]
+
+
+def classify_wbgt_batch(wbgts, age_group="2-3"):
+    """
+    複数の暑さ指数(WBGT)をまとめて判定し、危険レベルの番号（RISK_LEVELSの位置）の一覧を返す
+    WBGTが None の要素は None になる
+    """
+    bounds = _THRESHOLD_BOUNDS.get(age_group, _THRESHOLD_BOUNDS["2-3"])
+    bisect_right = bisect.bisect_right
+    return [None if w is None else bisect_right(bounds, w) for w in wbgts]
+
+
+def get_heat_risk_level(wbgt, age_group="2-3", temperature=None, humidity=None, timeout=AI_ADVICE_TIMEOUT, advice_mode=None):
     """
     【機能説明】
     計算された暑さ指数(WBGT)を元に、子供の年齢に応じた
@@ -472,60 +902,24 @@ def get_heat_risk_level(wbgt, age_group="2-3", temperature=None, humidity=None):
         return {"level": "不明", "color": "gray", "message": "データ不足", "ai_advice": "データが不足しているため、適切なアドバイスを提供できません。", "ai_generated": False}
 
     # =============================================================================
-    # 【7-2. 年齢別危険度しきい値の設定】
-    # 子供は大人より地面に近く、より暑い環境にいるため基準を厳しく設定
-    # 体調を伝えられない年齢ほど、より厳しい基準を適用
+    # 【7-2. 年齢に応じた危険レベルの判定】
+    # 年齢別のしきい値（HEAT_RISK_THRESHOLDS）と比較して危険レベルを決定
     # =============================================================================
-    thresholds = {
-        # 0-1歳（乳児）：体調を伝えられないため最も厳しい基準
-        "0-1": {"注意": 16, "警戒": 19, "厳重警戒": 22, "危険レベル1": 25, "高危険レベル2": 28, "非常に危険レベル3": 31},
-        # 2-3歳（幼児）：経験が乏しく前兆がわからないため厳しい基準
-        "2-3": {"注意": 17, "警戒": 20, "厳重警戒": 23, "危険レベル1": 26, "高危険レベル2": 29, "非常に危険レベル3": 32},
-        # 4-6歳（園児）：ある程度伝えられるが地面に近いため注意が必要
-        "4-6": {"注意": 18, "警戒": 21, "厳重警戒": 24, "危険レベル1": 27, "高危険レベル2": 30, "非常に危険レベル3": 33},
-    }
+    key = classify_wbgt(wbgt, age_group)
     
-        
     # =============================================================================
-    # 【7-3. 年齢に応じたしきい値を選択】
-    # 指定された年齢グループのしきい値を取得（デフォルトは2-3歳）
+    # 【7-3. アドバイス生成】
+    # 高速モードでは危険レベル別の指針から決まった手順で作り、
+    # AIモードでは判定された危険レベルと気象状況を元に、個別化されたアドバイスをAIが生成
     # =============================================================================
-    th = thresholds.get(age_group, thresholds["2-3"])
-
-    # =============================================================================
-    # 【7-4. 暑さ指数による危険レベルの判定】
-    # 計算されたWBGT値をしきい値と比較して危険レベルを決定
-    # =============================================================================
-    if wbgt < th["注意"]:
-        key = "ほぼ安全"
-    elif wbgt < th["警戒"]:
-        key = "注意"
-    elif wbgt < th["厳重警戒"]:  
-        key = "警戒"
-    elif wbgt < th["危険レベル1"]:
-        key = "厳重警戒"
-    elif wbgt < th["高危険レベル2"]:
-        key = "危険レベル1"
-    elif wbgt < th["非常に危険レベル3"]:
-        key = "高危険レベル2"
+    if (advice_mode or ADVICE_MODE) == "ai":
+        ai_advice_result = generate_ai_advice(wbgt, age_group, temperature, humidity, key, timeout=timeout)
     else:
-        key = "非常に危険レベル3"
-
-    # =============================================================================
-    # 【7-5. 危険レベルに応じた色の設定】
-    # アプリの画面で表示する色を危険レベルに応じて設定
-    # =============================================================================
-    colors = {"ほぼ安全": "blue", "注意": "yellow", "警戒": "orange", "厳重警戒": "red", "危険レベル1": "#FF3300", "高危険レベル2": "#D31919", "非常に危険レベル3": "#740303"}
-    
-    # =============================================================================
-    # 【7-6. AIによる個別アドバイス生成】
-    # 判定された危険レベルと気象状況を元に、個別化されたアドバイスをAIが生成
-    # =============================================================================
-    ai_advice_result = generate_ai_advice(wbgt, age_group, temperature, humidity, key)
+        ai_advice_result = generate_deterministic_advice(age_group, key)
     
     return {
         "level": key, 
-        "color": colors[key], 
+        "color": RISK_COLORS[key], 
         "message": ai_advice_result["result"],
         "ai_advice": ai_advice_result["result"],
         "ai_generated": ai_advice_result["ai_generated"],
@@ -572,80 +966,876 @@ def calculate_child_temperatures(temp, age_group="2-3"):
 
 
 # =============================================================================
-# 【9. 気象庁データ取得機能】
-# 気象庁のアメダス（観測網）から最新の気象データを取得します
+# 【9-0. 気象庁データのキャッシュ（stale-while-revalidate）】
+# 気象庁のデータは10分ごとの更新なので、取得できた最新データを保存して使い回す
+# - 一定時間内なら保存したデータをそのまま使う
+# - 古くなったら保存データを返しつつ、裏で新しいデータを取りに行く
+# - 気象庁に繋がらない時も、最大許容時間までは前回のデータを使う
+# - 取得に失敗した直後は、しばらく再取得を控える（毎リクエストで失敗を繰り返さない）
 # =============================================================================
-def get_amedas_data(station_id=None, station_name=None):
+# 気象庁のデータの配信元（負荷試験などでは jma_standin.py の代替サーバーのURLを指定する）
+JMA_BASE_URL = os.environ.get('JMA_BASE_URL', 'https://www.jma.go.jp/bosai').rstrip('/')
+AMEDAS_LATEST_TIME_URL = f"{JMA_BASE_URL}/amedas/data/latest_time.txt"
+AMEDAS_MAP_URL = JMA_BASE_URL + "/amedas/data/map/{ts}.json"
+AMEDAS_REQUEST_TIMEOUT = 10        # 気象庁への1回の通信の待ち時間（秒）
+AMEDAS_REFRESH_SECONDS = 60        # この秒数を過ぎたら新しいデータが無いか確認する
+AMEDAS_MAX_STALE_SECONDS = 3 * 60 * 60  # 観測時刻からこの秒数を超えたデータは使わない
+AMEDAS_RETRY_BACKOFF_SECONDS = 30  # 取得失敗後、再取得を控える秒数
+
+_amedas_snapshot = None            # {"latest": 観測時刻, "data": 全観測所データ, "fetched_at": 取得時刻}
+_amedas_lock = threading.Lock()
+_amedas_refreshing = False         # 裏で更新中かどうか
+_amedas_last_failure = 0.0         # 最後に取得に失敗した時刻
+
+
+_snapshot_listeners = []           # 新しい観測時刻のデータが届いた時に呼ぶ関数の一覧
+_snapshot_sync_listeners = []      # 同上（軽い処理のため、取得したその場で呼ぶもの）
+
+
+def on_new_snapshot(listener=None, synchronous=False):
     """
-    【機能説明】
-    気象庁のアメダス（全国の気象観測網）から最新の気象データを取得する機能
-    暑さ指数の計算に必要な気温、湿度、風速、日射量を取得
-    
-    【入力データ】
-    station_id : 観測所のID番号（例：練馬は"44071"）
-    station_name : 観測所の名前（例：「練馬」）
+    新しい観測時刻のデータが届いた時に呼ばれる関数を登録する
+    listener(snapshot) の snapshot は {"latest": 観測時刻, "data": 全観測所データ}
+    synchronous=True の関数は、データを使うリクエストより先に必ず実行される
+    """
+    def register(fn):
+        (_snapshot_sync_listeners if synchronous else _snapshot_listeners).append(fn)
+        return fn
+    return register(listener) if listener is not None else register
+
+
+def notify_new_snapshot(snapshot):
+    """
+    登録された関数を呼び出す
+    synchronous の関数はその場で、それ以外は別スレッドで順番に呼ぶ（リクエストの応答を待たせない）
+    """
+    for listener in list(_snapshot_sync_listeners):
+        try:
+            listener(snapshot)
+        except Exception as e:
+            print(f"スナップショット処理でエラー（{getattr(listener, '__name__', listener)}）: {e}")
+
+    if not _snapshot_listeners:
+        return None
+
+    def run_listeners():
+        for listener in list(_snapshot_listeners):
+            try:
+                listener(snapshot)
+            except Exception as e:
+                print(f"スナップショット処理でエラー（{getattr(listener, '__name__', listener)}）: {e}")
+
+    thread = threading.Thread(target=run_listeners, daemon=True)
+    thread.start()
+    return thread
+
+
+# =============================================================================
+# 【9-0-1. 全国データのコンパクトな保持】
+# 気象庁の全国データ（約1,300観測所 × 約20項目の [値, 品質] リスト）をそのまま保持すると
+# Pythonのオブジェクトだけで数MBになるため、暑さ指数の計算に使う4項目だけを
+# 項目ごとの数値配列（float32）と品質フラグ（1バイト）の列に変換して保持します
+# 観測所IDから位置への索引を持つため、1観測所の取り出しは O(1) です
+# =============================================================================
+# 保持する項目と、取り出す時に丸める小数点以下の桁数（気象庁の値の精度。0 は整数）
+COMPACT_AMEDAS_FIELDS = {"temp": 1, "humidity": 0, "wind": 1, "sun1h": 1}
+COMPACT_MISSING_FLAG = 255  # 項目が無い観測所の品質フラグ
+
+
+class CompactAmedasSnapshot:
+    """
+    全国データを項目ごとの配列で保持する（読み取り専用）
+
+    これまでの辞書と同じように使える:
+      station_id in data / data[station_id] / data.get(station_id) / data.keys() / data.items() / len(data)
+    data[station_id] は {"temp": [値, 品質], ...} の形（4項目のうち観測しているもの）で返す
+    """
+
+    __slots__ = ("_index", "_values", "_flags")
+
+    def __init__(self, raw):
+        self._index = {station_id: position for position, station_id in enumerate(raw)}
+        self._values = {}
+        self._flags = {}
+        for field in COMPACT_AMEDAS_FIELDS:
+            values = array('f')
+            flags = bytearray()
+            for station_data in raw.values():
+                pair = station_data.get(field)
+                if not pair:
+                    values.append(math.nan)
+                    flags.append(COMPACT_MISSING_FLAG)
+                    continue
+                value = pair[0]
+                flag = pair[1] if len(pair) > 1 and isinstance(pair[1], int) else 0
+                values.append(math.nan if value is None else value)
+                flags.append(min(max(flag, 0), COMPACT_MISSING_FLAG - 1))
+            self._values[field] = values
+            self._flags[field] = flags
+
+    def value(self, station_id, field):
+        """
+        1観測所・1項目の値（無い場合は None）
+        """
+        position = self._index.get(station_id)
+        if position is None:
+            return None
+        value = self._values[field][position]
+        if value != value:  # NaN（欠測）
+            return None
+        decimals = COMPACT_AMEDAS_FIELDS[field]
+        return int(round(value)) if decimals == 0 else round(value, decimals)
+
+    def _station(self, position, station_id):
+        station_data = {}
+        for field in COMPACT_AMEDAS_FIELDS:
+            flag = self._flags[field][position]
+            if flag != COMPACT_MISSING_FLAG:
+                station_data[field] = [self.value(station_id, field), flag]
+        return station_data
+
+    def __contains__(self, station_id):
+        return station_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __getitem__(self, station_id):
+        return self._station(self._index[station_id], station_id)
+
+    def get(self, station_id, default=None):
+        position = self._index.get(station_id)
+        return default if position is None else self._station(position, station_id)
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        for station_id, position in self._index.items():
+            yield station_id, self._station(position, station_id)
+
+    def nbytes(self):
+        """
+        数値配列と品質フラグが使うバイト数（索引の辞書を除く）
+        """
+        return sum(v.itemsize * len(v) for v in self._values.values()) + sum(len(f) for f in self._flags.values())
+
+
+def fetch_amedas_snapshot():
+    """
+    気象庁から最新のアメダス全国データを取得する（キャッシュを使わない）
     
-    【出力データ（辞書形式）】
-    - station: 観測地点名
-    - station_id: 観測地点ID
-    - time: 観測日時
-    - temperature: 気温 [℃]
-    - humidity: 相対湿度 [%]
-    - wind_speed: 平均風速 [m/s]
-    - solar_radiation: 全天日射量 [MJ/m²] ※WBGT計算用
-    - sunshine: 表示用（互換性のため）
+    【出力データ】
+    {"latest": 観測時刻(datetime), "data": 全観測所データ(CompactAmedasSnapshot)}
+    失敗した場合は例外を送出する
     """
-    # =============================================================================
-    # 【9-1. 処理開始のデバッグ情報出力】
-    # どの観測所のデータを取得しようとしているかを記録
-    # =============================================================================
-    print(f"🔍 [DEBUG] get_amedas_data関数呼び出し:")
-    print(f"   - 受け取ったstation_id: {station_id} (type: {type(station_id)})")
-    print(f"   - 受け取ったstation_name: {station_name} (type: {type(station_name)})")
-    print(f"   - STATION_ID（デフォルト値）: {STATION_ID}")
-    print(f"   - STATION_NAME（デフォルト値）: {STATION_NAME}")
+    requests = get_requests()
     
-    # =============================================================================
-    # 【9-2. 使用する観測所の決定】
-    # 1. リクエストから送信されたstation_idを優先
-    # 2. なければデフォルト値（練馬）を使用
-    # =============================================================================
-    current_station_id = station_id or STATION_ID
-    current_station_name = station_name or STATION_NAME
+    # ステップ1: 最新のデータ時刻を取得
+    r = requests.get(AMEDAS_LATEST_TIME_URL, timeout=AMEDAS_REQUEST_TIMEOUT)
+    r.raise_for_status()
+    tstr = r.text.strip()
     
-    print(f"🔍 [DEBUG] 最終的な観測所ID選択:")
-    print(f"   - current_station_id: {current_station_id}")
-    print(f"   - current_station_name: {current_station_name}")
-    print(f"   - station_idがNoneまたは空: {not station_id}")
+    # 取得した時刻データを日時オブジェクトに変換
+    try:
+        latest = datetime.fromisoformat(tstr.replace('Z', '+00:00'))
+    except ValueError:
+        latest = datetime.fromtimestamp(int(tstr), tz=timezone.utc)
+
+    # 前回と同じ時刻なら、全国データを取り直す必要はない
+    current = _amedas_snapshot
+    if current is not None and current["latest"] == latest:
+        return {"latest": latest, "data": current["data"]}
+
+    # ステップ2: 最新データのURLを作成して気象データを取得
+    ts = latest.strftime("%Y%m%d%H%M%S")
+    r2 = requests.get(AMEDAS_MAP_URL.format(ts=ts), timeout=AMEDAS_REQUEST_TIMEOUT)
+    if r2.status_code != 200:
+        raise RuntimeError(f"気象庁APIエラー: {r2.status_code}")
+    
+    # JSON形式のデータを、暑さ指数の計算に必要な項目だけのコンパクトな形に変換
+    return {"latest": latest, "data": CompactAmedasSnapshot(r2.json())}
+
+
+def refresh_amedas_snapshot():
+    """
+    気象庁からデータを取り直してキャッシュを更新する
+    成功したら True、失敗したら False を返す
+    """
+    global _amedas_snapshot, _amedas_last_failure
+    try:
+        fetched = fetch_amedas_snapshot()
+    except Exception as e:
+        print(f"❌ [DEBUG] アメダスデータ取得エラー: {e}")
+        _amedas_last_failure = time.time()
+        return False
+    fetched["fetched_at"] = time.time()
+    previous = _amedas_snapshot
+    _amedas_snapshot = fetched
+    if previous is None or previous["latest"] != fetched["latest"]:
+        notify_new_snapshot(fetched)
+    return True
+
+
+def _refresh_amedas_in_background():
+    global _amedas_refreshing
+    try:
+        refresh_amedas_snapshot()
+    finally:
+        _amedas_refreshing = False
+
+
+def _snapshot_age_seconds(snapshot):
+    """
+    観測時刻から現在までの経過秒数
+    """
+    return max(0, int((datetime.now(timezone.utc) - snapshot["latest"]).total_seconds()))
+
+
+def get_amedas_snapshot():
+    """
+    キャッシュを考慮してアメダス全国データを返す
+    
+    【出力データ】
+    {"latest": 観測時刻, "data": 全観測所データ, "status": "fresh"/"stale", "age_seconds": 経過秒数}
+    使えるデータが無い場合は None
+    """
+    global _amedas_refreshing
+    now = time.time()
+    snapshot = _amedas_snapshot
+    
+    # 保存データが新しい、または古いが許容範囲内 → すぐ返す（古い場合は裏で更新）
+    if snapshot is not None and _snapshot_age_seconds(snapshot) <= AMEDAS_MAX_STALE_SECONDS:
+        if now - snapshot["fetched_at"] >= AMEDAS_REFRESH_SECONDS and now - _amedas_last_failure >= AMEDAS_RETRY_BACKOFF_SECONDS:
+            with _amedas_lock:
+                if not _amedas_refreshing:
+                    _amedas_refreshing = True
+                    threading.Thread(target=_refresh_amedas_in_background, daemon=True).start()
+    else:
+        # 使えるデータが無い → その場で取得（失敗直後は控える）
+        if now - _amedas_last_failure >= AMEDAS_RETRY_BACKOFF_SECONDS:
+            with _amedas_lock:
+                if _amedas_snapshot is snapshot:  # 他のリクエストが取得済みでなければ取得
+                    refresh_amedas_snapshot()
+        snapshot = _amedas_snapshot
+        if snapshot is None or _snapshot_age_seconds(snapshot) > AMEDAS_MAX_STALE_SECONDS:
+            return None
+
+    age = _snapshot_age_seconds(snapshot)
+    return {
+        "latest": snapshot["latest"],
+        "data": snapshot["data"],
+        "status": "fresh" if now - snapshot["fetched_at"] < AMEDAS_REFRESH_SECONDS else "stale",
+        "age_seconds": age,
+    }
+
+
+# =============================================================================
+# 【9-0-2. 観測値の取り出しと最寄り観測所の検索】
+# 全国データから1観測所分の値を取り出す処理と、緯度経度から観測所を探す処理
+# =============================================================================
+def format_jst(dt):
+    """
+    日時を日本時間（JST）の表示用文字列に変換する
+    """
+    return dt.astimezone(timezone(timedelta(hours=9))).strftime("%Y-%m-%d %H:%M:%S JST")
+
+
+def observation_from_station_data(sd):
+    """
+    アメダス全国データの1観測所分（{"temp": [値, 品質], ...}）から
+    暑さ指数の計算に必要な値を取り出す
+    """
+    # 全天日射量データの取得（環境省の暑さ指数(WBGT)計算用）
+    # 気象庁APIでは "sun1h" が1時間の日射量 [MJ/m²]
+    solar_radiation = (sd.get("sun1h") or [None])[0]
+    return {
+        "temperature": (sd.get("temp") or [None])[0],
+        "humidity": (sd.get("humidity") or [None])[0],
+        "wind_speed": (sd.get("wind") or [None])[0],
+        "solar_radiation": solar_radiation,  # 環境省の暑さ指数(WBGT)計算用
+        "sunshine": solar_radiation,  # 表示用（互換性のため残す）
+    }
+
+
+# 観測所一覧（ID・名前・緯度経度）。フロントエンドと同じ amedas_id.json を使う
+AMEDAS_STATIONS_FILE = os.environ.get(
+    'AMEDAS_STATIONS_FILE',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public', 'data', 'amedas_id.json')
+)
+_amedas_stations = None
+_amedas_station_names = None
+
+
+def load_amedas_stations():
+    """
+    観測所一覧を読み込んで返す（初回のみファイルを読む。無ければ空の一覧）
+    """
+    global _amedas_stations
+    if _amedas_stations is None:
+        try:
+            with open(AMEDAS_STATIONS_FILE, encoding='utf-8') as f:
+                _amedas_stations = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"観測所一覧の読み込みに失敗: {e}")
+            _amedas_stations = []
+    return _amedas_stations
+
+
+def load_amedas_station_names():
+    """
+    観測所ID → 観測所名 の対応を返す（初回のみ観測所一覧から作る）
+    """
+    global _amedas_station_names
+    if _amedas_station_names is None:
+        _amedas_station_names = {st["id"]: st["name"] for st in load_amedas_stations()}
+    return _amedas_station_names
+
+
+def calculate_distance(lat1, lng1, lat2, lng2):
+    """
+    2地点間の距離（km）をハーバサイン公式で計算する（script.js の calculateDistance と同じ）
+    """
+    r = 6371
+    d_lat = math.radians(lat2 - lat1)
+    d_lng = math.radians(lng2 - lng1)
+    a = (math.sin(d_lat / 2) ** 2 +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lng / 2) ** 2)
+    return r * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def find_nearest_station(lat, lng, available_ids=None):
+    """
+    緯度経度から最寄りの観測所を返す（available_ids があればその中から選ぶ）
+    """
+    nearest = None
+    nearest_distance = None
+    for station in load_amedas_stations():
+        if available_ids is not None and station["id"] not in available_ids:
+            continue
+        distance = calculate_distance(lat, lng, station["lat"], station["lng"])
+        if nearest_distance is None or distance < nearest_distance:
+            nearest, nearest_distance = station, distance
+    if nearest is None:
+        return None
+    return {**nearest, "distance_km": round(nearest_distance, 2)}
+
+
+# =============================================================================
+# 【9-0-3. 観測所ごとの1日の暑さの蓄積】
+# その時点の危険レベルだけでなく、1日にどれだけ暑さにさらされたかも大切なため、
+# スナップショットが届くたびに観測所ごとの集計値を少しずつ更新します
+# （過去のデータを読み直さず、観測所ごとに決まった大きさの値だけを保持）
+# =============================================================================
+EXPOSURE_MAX_GAP_SECONDS = 30 * 60   # 前回から時間が空いた場合に、1回分として数える最大の時間（秒）
+EXPOSURE_AGE_GROUPS = ["0-1", "2-3", "4-6"]
+EXPOSURE_REFERENCE_LEVEL = "厳重警戒"  # 「度・分」を数える基準のレベル
+
+
+class DailyExposureTracker:
+    """
+    観測所ごとの1日（日本時間）の暑さの蓄積を管理する
+    
+    観測所ごとの状態:
+    {"date": 日付, "last": 前回の観測時刻(epoch秒), "since": 集計開始時刻, "samples": 回数,
+     "observed_minutes": 集計した分数, "wbgt_max": 最高WBGT, "wbgt_max_time": その時刻,
+     "degree_minutes": [年齢別の厳重警戒しきい値を超えた度・分],
+     "band_minutes": [年齢別の各危険レベルにいた分数（RISK_LEVELS順）]}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stations = {}
+        self._reference = [HEAT_RISK_THRESHOLDS[g][EXPOSURE_REFERENCE_LEVEL] for g in EXPOSURE_AGE_GROUPS]
+
+    def update(self, snapshot):
+        """
+        新しいスナップショットで全観測所の集計を更新する（観測所数に比例する処理）
+        """
+        latest = snapshot["latest"]
+        epoch = latest.timestamp()
+        day = latest.astimezone(timezone(timedelta(hours=9))).date().isoformat()
+        time_label = format_jst(latest)
+        with self._lock:
+            for station_id, sd in snapshot["data"].items():
+                temp = sd.get("temp", [None])[0]
+                humidity = sd.get("humidity", [None])[0]
+                if temp is None or humidity is None:
+                    continue
+                wbgt = calculate_wbgt(temp, humidity, sd.get("wind", [None])[0], sd.get("sun1h", [None])[0])
+
+                state = self._stations.get(station_id)
+                if state is None or state["date"] != day:
+                    state = {
+                        "date": day, "last": None, "since": time_label, "samples": 0,
+                        "observed_minutes": 0.0, "wbgt_max": None, "wbgt_max_time": None,
+                        "degree_minutes": [0.0] * len(EXPOSURE_AGE_GROUPS),
+                        "band_minutes": [[0.0] * len(RISK_LEVELS) for _ in EXPOSURE_AGE_GROUPS],
+                    }
+                    self._stations[station_id] = state
+                elif state["last"] is not None and epoch <= state["last"]:
+                    continue  # 同じ（または古い）観測時刻は二重に数えない
+
+                # 前回からの経過時間をこの観測値の時間として数える（初回は10分）
+                if state["last"] is None:
+                    seconds = AMEDAS_INTERVAL_SECONDS
+                else:
+                    seconds = min(epoch - state["last"], EXPOSURE_MAX_GAP_SECONDS)
+                minutes = seconds / 60.0
+
+                state["last"] = epoch
+                state["samples"] += 1
+                state["observed_minutes"] += minutes
+                if state["wbgt_max"] is None or wbgt > state["wbgt_max"]:
+                    state["wbgt_max"] = wbgt
+                    state["wbgt_max_time"] = time_label
+                for i, group in enumerate(EXPOSURE_AGE_GROUPS):
+                    excess = wbgt - self._reference[i]
+                    if excess > 0:
+                        state["degree_minutes"][i] += excess * minutes
+                    state["band_minutes"][i][bisect.bisect_right(_THRESHOLD_BOUNDS[group], wbgt)] += minutes
+
+    def summary(self, station_id, age_group=None):
+        """
+        観測所の今日の集計値を返す（age_group 指定時はその年齢グループのみ）
+        まだ集計が無ければ None
+        """
+        with self._lock:
+            state = self._stations.get(str(station_id))
+            if state is None:
+                return None
+            groups = {}
+            for i, group in enumerate(EXPOSURE_AGE_GROUPS):
+                if age_group is not None and group != age_group:
+                    continue
+                groups[group] = {
+                    "degree_minutes_above_threshold": round(state["degree_minutes"][i], 1),
+                    "threshold_level": EXPOSURE_REFERENCE_LEVEL,
+                    "threshold_wbgt": self._reference[i],
+                    "band_minutes": {
+                        level: round(m) for level, m in zip(RISK_LEVELS, state["band_minutes"][i]) if m > 0
+                    },
+                }
+            return {
+                "date": state["date"],
+                "since": state["since"],
+                "samples": state["samples"],
+                "observed_minutes": round(state["observed_minutes"]),
+                "wbgt_max": state["wbgt_max"],
+                "wbgt_max_time": state["wbgt_max_time"],
+                "age_groups": groups,
+            }
+
+
+DAILY_EXPOSURE = DailyExposureTracker()
+
+
+@on_new_snapshot(synchronous=True)
+def update_daily_exposure(snapshot):
+    """
+    新しいアメダスデータが届いたら1日の暑さの蓄積を更新する
+    """
+    DAILY_EXPOSURE.update(snapshot)
+
+
+# =============================================================================
+# 【9-0-4. 予報データから1時間ごとの暑さ指数の予測】
+# アメダスの観測値は「今」の値のため、今日の午後や明日が危険になるかは分からない
+# 気象庁の府県予報（最高・最低気温と天気）から1時間ごとの気温・湿度・日射量を推定し、
+# 暑さ指数と年齢グループごとの危険レベルの予測（タイムライン）を作ります
+# - 予報は気象台ごとに、発表（5時・11時・17時）のたびに1回だけ取得して保存する
+# - 観測所の都道府県（amedas_id.json）から予報を出す気象台を決め、
+#   予報の気温の地点（アメダス観測所）のうち最も近い地点の気温を使う
+# - 気温は最低気温（5時頃）と最高気温（14時頃）の間を滑らかにつないで推定する
+# - 湿度は今の観測値の水蒸気量が変わらないものとして、日射量は天気と時刻から推定する
+# - 今の観測値と予報の差は、数時間かけて予報の値に近づける
+# =============================================================================
+FORECAST_URL = JMA_BASE_URL + "/forecast/data/forecast/{office}.json"
+FORECAST_ISSUE_HOURS = (5, 11, 17)   # 予報の定時発表時刻（日本時間）
+FORECAST_RETRY_SECONDS = 300         # 発表時刻を過ぎても新しい予報が無い・取得に失敗した時、取り直すまでの秒数
+FORECAST_HOURS = 24                  # 既定で予測する時間数
+FORECAST_MAX_HOURS = 48              # 予測できる時間数の上限
+FORECAST_MIN_TEMP_HOUR = 5           # 最低気温になる時刻の目安
+FORECAST_MAX_TEMP_HOUR = 14          # 最高気温になる時刻の目安
+FORECAST_DEFAULT_TEMP_RANGE = 8.0    # 最高・最低気温の片方しか無い時に使う1日の気温差（℃）
+FORECAST_BLEND_HOURS = 6             # 今の観測値との差を予報の値に近づける時間
+FORECAST_TIMELINE_CACHE_SIZE = 512   # 保存しておくタイムラインの数
+
+# 都道府県 → 予報を発表する気象台のコード（北海道・鹿児島・沖縄は地方ごとに分かれる）
+PREFECTURE_FORECAST_OFFICES = {
+    "hokkaido": ["011000", "012000", "013000", "014030", "014100", "015000", "016000", "017000"],
+    "aomori": ["020000"], "iwate": ["030000"], "miyagi": ["040000"], "akita": ["050000"],
+    "yamagata": ["060000"], "fukushima": ["070000"], "ibaraki": ["080000"], "tochigi": ["090000"],
+    "gunma": ["100000"], "saitama": ["110000"], "chiba": ["120000"], "tokyo": ["130000"],
+    "kanagawa": ["140000"], "niigata": ["150000"], "toyama": ["160000"], "ishikawa": ["170000"],
+    "fukui": ["180000"], "yamanashi": ["190000"], "nagano": ["200000"], "gifu": ["210000"],
+    "shizuoka": ["220000"], "aichi": ["230000"], "mie": ["240000"], "shiga": ["250000"],
+    "kyoto": ["260000"], "osaka": ["270000"], "hyogo": ["280000"], "nara": ["290000"],
+    "wakayama": ["300000"], "tottori": ["310000"], "shimane": ["320000"], "okayama": ["330000"],
+    "hiroshima": ["340000"], "yamaguchi": ["350000"], "tokushima": ["360000"], "kagawa": ["370000"],
+    "ehime": ["380000"], "kochi": ["390000"], "fukuoka": ["400000"], "saga": ["410000"],
+    "nagasaki": ["420000"], "kumamoto": ["430000"], "oita": ["440000"], "miyazaki": ["450000"],
+    "kagoshima": ["460100", "460040"],
+    "okinawa": ["471000", "472000", "473000", "474000"],
+}
+
+_forecast_cache = {}            # 気象台コード → {"report_time", "points", "fetched_at"}
+_forecast_last_failure = {}     # 気象台コード → 最後に取得に失敗した時刻
+_forecast_lock = threading.Lock()
+_forecast_timelines = {}        # (観測所ID, 予報の発表時刻, 観測時刻, 時間数) → タイムライン（古い順）
+_forecast_timelines_lock = threading.Lock()
+
+
+def next_forecast_issue(report_time):
+    """
+    report_time の次の定時発表時刻
+    """
+    jst = timezone(timedelta(hours=9))
+    reported = report_time.astimezone(jst)
+    for days in (0, 1):
+        day = reported.date() + timedelta(days=days)
+        for hour in FORECAST_ISSUE_HOURS:
+            issue = datetime(day.year, day.month, day.day, hour, tzinfo=jst)
+            if issue > reported:
+                return issue
+
+
+def parse_office_forecast(data):
+    """
+    【機能説明】
+    気象台の予報JSON（府県予報＋週間予報）から、気温の地点ごとの日別の最低・最高気温と天気コードを取り出す
+    （同じ日の値は府県予報を優先し、無い日を週間予報で補う）
+
+    【出力データ】
+    {地点コード（アメダス観測所ID）: {"name": 地点名, "min": {日付: ℃}, "max": {日付: ℃}, "weather": {日付: 天気コード}}}
+    """
+    points = {}
+
+    def point(area):
+        return points.setdefault(area["code"], {"name": area.get("name"), "min": {}, "max": {}, "weather": {}})
+
+    for report in data:
+        temp_areas, weather_series = [], None
+        for series in report.get("timeSeries", []):
+            areas = series.get("areas", [])
+            if not areas:
+                continue
+            times = [datetime.fromisoformat(t) for t in series.get("timeDefines", [])]
+            if "weatherCodes" in areas[0]:
+                weather_series = (times, areas)
+            elif "temps" in areas[0]:
+                # 府県予報の気温: 0時の値が朝の最低気温、9時の値が日中の最高気温
+                for area in areas:
+                    target = point(area["area"])
+                    temp_areas.append(target)
+                    for t, value in zip(times, area["temps"]):
+                        key = "min" if t.hour == 0 else "max"
+                        if value != "":
+                            target[key].setdefault(t.date().isoformat(), float(value))
+            elif "tempsMin" in areas[0]:
+                for area in areas:
+                    target = point(area["area"])
+                    temp_areas.append(target)
+                    for t, low, high in zip(times, area["tempsMin"], area["tempsMax"]):
+                        if low != "":
+                            target["min"].setdefault(t.date().isoformat(), float(low))
+                        if high != "":
+                            target["max"].setdefault(t.date().isoformat(), float(high))
+        if weather_series is None:
+            continue
+        # 天気の地域と気温の地点は同じ順番で並ぶ（数が違う場合は最初の地域の天気を使う）
+        times, weather_areas = weather_series
+        for index, target in enumerate(temp_areas):
+            area = weather_areas[index] if len(weather_areas) == len(temp_areas) else weather_areas[0]
+            for t, code in zip(times, area["weatherCodes"]):
+                if code:
+                    target["weather"].setdefault(t.date().isoformat(), code)
+    return points
+
+
+def fetch_office_forecast(office):
+    """
+    気象庁から気象台の予報を取得する（キャッシュを使わない）。失敗した場合は例外を送出する
+    """
+    requests = get_requests()
+    r = requests.get(FORECAST_URL.format(office=office), timeout=AMEDAS_REQUEST_TIMEOUT)
+    r.raise_for_status()
+    data = r.json()
+    return {
+        "report_time": datetime.fromisoformat(data[0]["reportDatetime"]),
+        "points": parse_office_forecast(data),
+        "fetched_at": time.time(),
+    }
+
+
+def get_office_forecast(office):
+    """
+    気象台の予報を返す（次の発表時刻までは保存した予報を使う）。使える予報が無ければ None
+    """
+    now = time.time()
+    cached = _forecast_cache.get(office)
+    if cached is not None and (now < next_forecast_issue(cached["report_time"]).timestamp()
+                               or now - cached["fetched_at"] < FORECAST_RETRY_SECONDS):
+        return cached
+    if now - _forecast_last_failure.get(office, 0.0) < FORECAST_RETRY_SECONDS:
+        return cached
+
+    with _forecast_lock:
+        current = _forecast_cache.get(office)
+        if current is not cached:  # 待っている間に他のリクエストが取得済み
+            return current
+        try:
+            fetched = fetch_office_forecast(office)
+        except Exception as e:
+            print(f"予報の取得に失敗（{office}）: {e}")
+            _forecast_last_failure[office] = now
+            return cached
+        _forecast_cache[office] = fetched
+        return fetched
+
+
+def find_forecast_point(station_id):
+    """
+    観測所の予報に使う気温の地点を決める（観測所の都道府県の気象台の地点のうち最も近い地点）
+
+    【出力データ】
+    {"id", "name", "office", "distance_km", "report_time", "forecast": 日別の気温・天気} または None
+    """
+    stations = {s["id"]: s for s in load_amedas_stations()}
+    station = stations.get(station_id)
+    if station is None:
+        return None
+    best = None
+    for office in PREFECTURE_FORECAST_OFFICES.get(station.get("prefecture"), []):
+        forecast = get_office_forecast(office)
+        if forecast is None:
+            continue
+        for code, point in forecast["points"].items():
+            located = stations.get(code)
+            if located is None:
+                continue
+            distance = calculate_distance(station["lat"], station["lng"], located["lat"], located["lng"])
+            if best is None or distance < best["distance_km"]:
+                best = {
+                    "id": code, "name": point["name"] or located["name"], "office": office,
+                    "distance_km": round(distance, 2), "report_time": forecast["report_time"], "forecast": point,
+                }
+    return best
+
+
+def saturation_vapor_pressure(temp):
+    """
+    飽和水蒸気圧 [hPa]（Tetens の式）
+    """
+    return 6.1078 * 10 ** (7.5 * temp / (temp + 237.3))
+
+
+def forecast_temperature(moment, daily_min, daily_max):
+    """
+    日別の最低・最高気温から、日時 moment（日本時間）の気温を推定する
+    最低気温の時刻 → 最高気温の時刻 → 翌日の最低気温の時刻 を余弦曲線でつなぐ
+    """
+    def bounds(day):
+        key = day.isoformat()
+        low, high = daily_min.get(key), daily_max.get(key)
+        if low is None and high is None:
+            return None
+        if low is None:
+            low = high - FORECAST_DEFAULT_TEMP_RANGE
+        if high is None:
+            high = low + FORECAST_DEFAULT_TEMP_RANGE
+        return low, high
+
+    def ease(start, end, x):
+        return start + (end - start) * (1 - math.cos(math.pi * x)) / 2
+
+    hour = moment.hour + moment.minute / 60
+    today = bounds(moment.date())
+    if today is None:
+        return None
+    low, high = today
+    if FORECAST_MIN_TEMP_HOUR <= hour < FORECAST_MAX_TEMP_HOUR:
+        return ease(low, high, (hour - FORECAST_MIN_TEMP_HOUR) / (FORECAST_MAX_TEMP_HOUR - FORECAST_MIN_TEMP_HOUR))
+    night = 24 - FORECAST_MAX_TEMP_HOUR + FORECAST_MIN_TEMP_HOUR  # 最高気温から翌朝の最低気温までの時間
+    if hour >= FORECAST_MAX_TEMP_HOUR:
+        following = bounds(moment.date() + timedelta(days=1)) or today
+        return ease(high, following[0], (hour - FORECAST_MAX_TEMP_HOUR) / night)
+    previous = bounds(moment.date() - timedelta(days=1)) or today
+    return ease(previous[1], low, (hour + 24 - FORECAST_MAX_TEMP_HOUR) / night)
+
+
+def forecast_solar_radiation(moment, weather_code):
+    """
+    時刻と天気コードから、その1時間の日射量を推定する（観測値 sun1h と同じ尺度。晴れた正午で約1）
+    天気コードは 1xx が晴れ、2xx が曇り、3xx 以降が雨・雪
+    """
+    hour = moment.hour + 0.5  # その1時間の中ほど
+    daylight = math.sin(math.pi * (hour - 5) / 14) if 5 < hour < 19 else 0.0
+    if not weather_code:
+        clearness = 0.5
+    elif weather_code == "100":
+        clearness = 1.0
+    else:
+        clearness = {"1": 0.7, "2": 0.3}.get(weather_code[0], 0.0)
+    return round(daylight * clearness, 2)
+
+
+def build_forecast_timeline(station_id, snapshot, hours=FORECAST_HOURS):
+    """
+    【機能説明】
+    観測所の今の観測値と予報から、1時間ごとの暑さ指数と年齢グループごとの危険レベルの予測を作る
+    （観測所・予報の発表時刻・観測時刻が同じなら、保存したタイムラインを返す）
+
+    【入力データ】
+    station_id : 観測所ID
+    snapshot : get_amedas_snapshot() の結果
+    hours : 予測する時間数（予報の無い時間は含まれない）
+
+    【出力データ】
+    {"station_id", "station", "forecast_point", "report_time", "observation_time",
+     "hours": [{"time", "timestamp", "source"（"observation"/"forecast"）, "temperature", "humidity", "wind_speed",
+                "solar_radiation", "wbgt", "risk_level": {年齢: レベル}, "risk_level_index": {年齢: 番号}}, ...]}
+    予報を取得できない場合は None
+    """
+    point = find_forecast_point(station_id)
+    if point is None:
+        return None
+    cache_key = (station_id, point["report_time"], snapshot["latest"], hours)
+    cached = _forecast_timelines.get(cache_key)
+    if cached is not None:
+        return cached
+
+    jst = timezone(timedelta(hours=9))
+    observed_at = snapshot["latest"].astimezone(jst)
+    station_data = snapshot["data"].get(station_id)
+    observation = observation_from_station_data(station_data) if station_data else None
+    forecast = point["forecast"]
+
+    # ステップ1: 1時間ごとの気温（今の観測値との差は FORECAST_BLEND_HOURS かけて予報に近づける）
+    first = observed_at.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    moments = [first + timedelta(hours=i) for i in range(hours)]
+    temps = [forecast_temperature(m, forecast["min"], forecast["max"]) for m in moments]
+    if None in temps:
+        moments, temps = moments[:temps.index(None)], temps[:temps.index(None)]
+    obs_temp = observation["temperature"] if observation else None
+    expected_now = forecast_temperature(observed_at, forecast["min"], forecast["max"])
+    if obs_temp is not None and expected_now is not None:
+        offset = obs_temp - expected_now
+        temps = [
+            t + offset * max(0.0, 1 - (m - observed_at).total_seconds() / 3600 / FORECAST_BLEND_HOURS)
+            for m, t in zip(moments, temps)
+        ]
+
+    # ステップ2: 湿度（水蒸気量が今と同じと仮定）・風速（今と同じ）・日射量（天気と時刻から）
+    obs_humidity = observation["humidity"] if observation else None
+    if obs_temp is not None and obs_humidity is not None:
+        vapor = obs_humidity / 100 * saturation_vapor_pressure(obs_temp)
+        humidities = [min(100.0, max(5.0, 100 * vapor / saturation_vapor_pressure(t))) for t in temps]
+    else:
+        humidities = [60.0] * len(temps)  # 観測値が無い場合は平均的な湿度
+    wind = observation["wind_speed"] if observation else None
+    solars = [forecast_solar_radiation(m, forecast["weather"].get(m.date().isoformat())) for m in moments]
+
+    # ステップ3: 暑さ指数と危険レベルをまとめて計算（先頭は今の観測値）
+    rows = []
+    if observation is not None:
+        rows.append((observed_at, "observation", obs_temp, obs_humidity, wind, observation["solar_radiation"]))
+    rows += [
+        (m, "forecast", round(t, 1), round(h), wind, s)
+        for m, t, h, s in zip(moments, temps, humidities, solars)
+    ]
+    wbgts = [calculate_wbgt(t, h, w, s) for _, _, t, h, w, s in rows]
+    levels = {group: classify_wbgt_batch(wbgts, group) for group in EXPOSURE_AGE_GROUPS}
+
+    timeline = {
+        "station_id": station_id,
+        "station": next((s["name"] for s in load_amedas_stations() if s["id"] == station_id), station_id),
+        "forecast_point": {k: point[k] for k in ("id", "name", "office", "distance_km")},
+        "report_time": format_jst(point["report_time"]),
+        "observation_time": format_jst(snapshot["latest"]),
+        "hours": [
+            {
+                "time": format_jst(moment),
+                "timestamp": moment.isoformat(),
+                "source": source,
+                "temperature": temp,
+                "humidity": humidity,
+                "wind_speed": wind_speed,
+                "solar_radiation": solar,
+                "wbgt": wbgt,
+                "risk_level": {g: None if levels[g][i] is None else RISK_LEVELS[levels[g][i]] for g in EXPOSURE_AGE_GROUPS},
+                "risk_level_index": {g: levels[g][i] for g in EXPOSURE_AGE_GROUPS},
+            }
+            for i, ((moment, source, temp, humidity, wind_speed, solar), wbgt) in enumerate(zip(rows, wbgts))
+        ],
+    }
+    with _forecast_timelines_lock:
+        _forecast_timelines[cache_key] = timeline
+        while len(_forecast_timelines) > FORECAST_TIMELINE_CACHE_SIZE:
+            del _forecast_timelines[next(iter(_forecast_timelines))]
+    return timeline
+
+
+# =============================================================================
+# 【9. 気象庁データ取得機能】
+# 気象庁のアメダス（観測網）から最新の気象データを取得します
+# =============================================================================
+def get_amedas_data(station_id=None, station_name=None):
+    """
+    【機能説明】
+    気象庁のアメダス（全国の気象観測網）から最新の気象データを取得する機能
+    暑さ指数の計算に必要な気温、湿度、風速、日射量を取得
+    
+    【入力データ】
+    station_id : 観測所のID番号（例：練馬は"44071"）
+    station_name : 観測所の名前（例：「練馬」）
+    
+    【出力データ（辞書形式）】
+    - station: 観測地点名
+    - station_id: 観測地点ID
+    - time: 観測日時
+    - temperature: 気温 [℃]
+    - humidity: 相対湿度 [%]
+    - wind_speed: 平均風速 [m/s]
+    - solar_radiation: 全天日射量 [MJ/m²] ※WBGT計算用
+    - sunshine: 表示用（互換性のため）
+    """
+    # =============================================================================
+    # 【9-1. 処理開始のデバッグ情報出力】
+    # どの観測所のデータを取得しようとしているかを記録
+    # =============================================================================
+    print(f"🔍 [DEBUG] get_amedas_data関数呼び出し:")
+    print(f"   - 受け取ったstation_id: {station_id} (type: {type(station_id)})")
+    print(f"   - 受け取ったstation_name: {station_name} (type: {type(station_name)})")
+    print(f"   - STATION_ID（デフォルト値）: {STATION_ID}")
+    print(f"   - STATION_NAME（デフォルト値）: {STATION_NAME}")
+    
+    # =============================================================================
+    # 【9-2. 使用する観測所の決定】
+    # 1. リクエストから送信されたstation_idを優先
+    # 2. なければデフォルト値（練馬）を使用
+    # =============================================================================
+    current_station_id = station_id or STATION_ID
+    current_station_name = station_name or STATION_NAME
+    
+    print(f"🔍 [DEBUG] 最終的な観測所ID選択:")
+    print(f"   - current_station_id: {current_station_id}")
+    print(f"   - current_station_name: {current_station_name}")
+    print(f"   - station_idがNoneまたは空: {not station_id}")
     
     # =============================================================================
-    # 【9-3. 気象庁APIからデータ取得】
-    # インターネット経由で気象庁の最新データを取得
+    # 【9-3. 気象庁データ（スナップショット）の取得】
+    # 直近に取得できたデータを使い回し、古くなったら裏で更新する（【9-0】参照）
     # =============================================================================
     try:
-        # ステップ1: 最新のデータ時刻を取得
-        latest_time_url = "https://www.jma.go.jp/bosai/amedas/data/latest_time.txt"
-        r = requests.get(latest_time_url, timeout=10)
-        tstr = r.text.strip()
-        
-        # 取得した時刻データを日時オブジェクトに変換
-        try:
-            latest = datetime.fromisoformat(tstr.replace('Z', '+00:00'))
-        except ValueError:
-            latest = datetime.fromtimestamp(int(tstr))
-
-        # ステップ2: 最新データのURLを作成して気象データを取得
-        ts = latest.strftime("%Y%m%d%H%M%S")
-        data_url = f"https://www.jma.go.jp/bosai/amedas/data/map/{ts}.json"
-        r2 = requests.get(data_url, timeout=10)
-        
-        # データ取得が失敗した場合はエラーを返す
-        if r2.status_code != 200:
-            print(f"❌ [DEBUG] 気象庁APIエラー: {r2.status_code}")
+        snapshot = get_amedas_snapshot()
+        if snapshot is None:
             return None
-            
-        # JSON形式のデータを辞書に変換
-        all_data = r2.json()
+        latest = snapshot["latest"]
+        all_data = snapshot["data"]
         
         # デバッグ情報を追加
         print(f"🔍 [DEBUG] 気象庁APIからのデータ取得:")
@@ -697,23 +1887,13 @@ def get_amedas_data(station_id=None, station_name=None):
                     print(f"❌ [DEBUG] 利用可能な観測所が見つかりません。")
                     return None
         
-        # 全天日射量データの取得（環境省の暑さ指数(WBGT)計算用）
-        # 気象庁APIでは "sun1h" が1時間の日射量 [MJ/m²]
-        solar_radiation = sd.get("sun1h", [None])[0]
-        
-        # UTC時刻を日本時間（JST）に変換
-        jst = timezone(timedelta(hours=9))
-        latest_jst = latest.astimezone(jst)
-        
         result = {
             "station": current_station_name,
             "station_id": current_station_id,
-            "time": latest_jst.strftime("%Y-%m-%d %H:%M:%S JST"),
-            "temperature": sd.get("temp", [None])[0],
-            "humidity": sd.get("humidity", [None])[0],
-            "wind_speed": sd.get("wind", [None])[0],
-            "solar_radiation": solar_radiation,  # 環境省の暑さ指数(WBGT)計算用
-            "sunshine": sd.get("sun1h", [None])[0],  # 表示用（互換性のため残す）
+            "time": format_jst(latest),
+            **observation_from_station_data(sd),
+            "data_status": snapshot["status"],  # "fresh"（最新）または "stale"（前回取得分）
+            "data_age_seconds": snapshot["age_seconds"],  # 観測時刻からの経過秒数
         }
         
         print(f"🔍 [DEBUG] 最終的な観測所データ:")
@@ -863,6 +2043,12 @@ def analyze_image_with_ai(image_data, age_group, context_data=None, timeout=AI_V
     if not GEMINI_API_KEY:
         fallback_result["status"] = "fallback_no_api_key"
         return fallback_result
+
+    # AIが不調でブレーカーが作動中なら、待たずにフォールバックを返す
+    breaker_token = AI_CIRCUIT_BREAKER.allow_request()
+    if breaker_token is None:
+        fallback_result["status"] = "circuit_open"
+        return fallback_result
     
     def vision_analysis_worker():
         try:
@@ -892,22 +2078,14 @@ def analyze_image_with_ai(image_data, age_group, context_data=None, timeout=AI_V
 各項目の間には必ず空行を入れてください。
 """
 
-            # Gemini Vision APIを呼び出し
-            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-            
             # 画像データを準備
             image_part = {
                 "mime_type": "image/jpeg",
                 "data": image_data
             }
             
-            response = model.generate_content(
-                [prompt, image_part],
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=500,
-                    temperature=0.7
-                )
-            )
+            # Gemini Vision APIを呼び出し（共通クライアント経由）
+            response = GEMINI_CLIENT.generate("vision", [prompt, image_part], deadline=deadline)
             
             if response.text:
                 try:
@@ -941,35 +2119,56 @@ def analyze_image_with_ai(image_data, age_group, context_data=None, timeout=AI_V
             
             return None
             
+        except GeminiBusyError:
+            raise  # 実行枠が取れなかった場合は呼び出し元で判定する
         except Exception as e:
             print(f"Gemini Vision API呼び出しエラー: {e}")
             return None
     
     try:
-        # タイムアウト付きでAI処理を実行
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(vision_analysis_worker)
-            try:
-                ai_result = future.result(timeout=timeout)
-                if ai_result:
-                    ai_result.update({
-                        "ai_generated": True,
-                        "processing_time": time.time() - start_time,
-                        "status": "success"
-                    })
-                    return ai_result
-                else:
-                    fallback_result["status"] = "ai_failed"
-                    return fallback_result
-                    
-            except concurrent.futures.TimeoutError:
-                print(f"AI 画像解析がタイムアウトしました（{timeout}秒）")
-                fallback_result["status"] = "timeout"
-                fallback_result["processing_time"] = timeout
+        # タイムアウト付きでAI処理を実行（共有スレッドプール）
+        deadline = time.monotonic() + timeout  # この時刻までにAIの実行枠が取れなければ諦める
+        try:
+            # 混雑していて時間内に終わらない見込みなら、受け付けずに固定メッセージにする
+            future = GEMINI_CLIENT.submit("vision", vision_analysis_worker, timeout)
+            ai_result = future.result(timeout=timeout)
+            if ai_result:
+                ai_result.update({
+                    "ai_generated": True,
+                    "processing_time": time.time() - start_time,
+                    "status": "success"
+                })
+                AI_CIRCUIT_BREAKER.record("success", breaker_token)
+                return ai_result
+            else:
+                AI_CIRCUIT_BREAKER.record("error", breaker_token)
+                fallback_result["status"] = "ai_failed"
                 return fallback_result
                 
+        except concurrent.futures.TimeoutError:
+            print(f"AI 画像解析がタイムアウトしました（{timeout}秒）")
+            AI_CIRCUIT_BREAKER.record("timeout", breaker_token)
+            fallback_result["status"] = "timeout"
+            fallback_result["processing_time"] = timeout
+            return fallback_result
+
+        except GeminiShedError as e:
+            print(f"AI 画像解析を見送りました: {e}")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            fallback_result["status"] = "shed"
+            fallback_result["processing_time"] = time.time() - start_time
+            return fallback_result
+
+        except GeminiBusyError:
+            print("AI 画像解析の実行枠が確保できませんでした")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            fallback_result["status"] = "rate_limited"
+            fallback_result["processing_time"] = time.time() - start_time
+            return fallback_result
+            
     except Exception as e:
         print(f"AI 画像解析で予期しないエラー: {e}")
+        AI_CIRCUIT_BREAKER.record("error", breaker_token)
         fallback_result["status"] = "error"
         fallback_result["processing_time"] = time.time() - start_time
         return fallback_result
@@ -1020,6 +2219,12 @@ def analyze_images_comparison(before_image_data, after_image_data, age_group, ti
     if not GEMINI_API_KEY:
         fallback_result["status"] = "fallback_no_api_key"
         return fallback_result
+
+    # AIが不調でブレーカーが作動中なら、待たずにフォールバックを返す
+    breaker_token = AI_CIRCUIT_BREAKER.allow_request()
+    if breaker_token is None:
+        fallback_result["status"] = "circuit_open"
+        return fallback_result
     
     def comparison_analysis_worker():
         try:
@@ -1063,9 +2268,6 @@ def analyze_images_comparison(before_image_data, after_image_data, age_group, ti
 外出前後の画像の変化（顔色、服装の汚れ、表情、疲労の兆候など）と{time_info}を考慮して、適切なレベルの帰宅後ケアを提案してください。
 各項目の間には必ず空行を入れて、読みやすくしてください。"""
 
-            # Gemini Vision APIを呼び出し
-            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-            
             # 画像データを準備
             before_image_part = {
                 "mime_type": "image/jpeg",
@@ -1077,13 +2279,8 @@ def analyze_images_comparison(before_image_data, after_image_data, age_group, ti
                 "data": after_image_data
             }
             
-            response = model.generate_content(
-                [prompt, before_image_part, after_image_part],
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=700,
-                    temperature=0.7
-                )
-            )
+            # Gemini Vision APIを呼び出し（共通クライアント経由）
+            response = GEMINI_CLIENT.generate("comparison", [prompt, before_image_part, after_image_part], deadline=deadline)
             
             if response.text:
                 # 直接テキストを返す（箇条書き形式）
@@ -1097,35 +2294,56 @@ def analyze_images_comparison(before_image_data, after_image_data, age_group, ti
             
             return None
             
+        except GeminiBusyError:
+            raise  # 実行枠が取れなかった場合は呼び出し元で判定する
         except Exception as e:
             print(f"Gemini Vision API差分分析エラー: {e}")
             return None
     
     try:
-        # タイムアウト付きでAI処理を実行
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(comparison_analysis_worker)
-            try:
-                ai_result = future.result(timeout=timeout)
-                if ai_result:
-                    ai_result.update({
-                        "ai_generated": True,
-                        "processing_time": time.time() - start_time,
-                        "status": "success"
-                    })
-                    return ai_result
-                else:
-                    fallback_result["status"] = "ai_failed"
-                    return fallback_result
-                    
-            except concurrent.futures.TimeoutError:
-                print(f"AI 差分分析がタイムアウトしました（{timeout}秒）")
-                fallback_result["status"] = "timeout"
-                fallback_result["processing_time"] = timeout
+        # タイムアウト付きでAI処理を実行（共有スレッドプール）
+        deadline = time.monotonic() + timeout  # この時刻までにAIの実行枠が取れなければ諦める
+        try:
+            # 混雑していて時間内に終わらない見込みなら、受け付けずに固定メッセージにする
+            future = GEMINI_CLIENT.submit("comparison", comparison_analysis_worker, timeout)
+            ai_result = future.result(timeout=timeout)
+            if ai_result:
+                ai_result.update({
+                    "ai_generated": True,
+                    "processing_time": time.time() - start_time,
+                    "status": "success"
+                })
+                AI_CIRCUIT_BREAKER.record("success", breaker_token)
+                return ai_result
+            else:
+                AI_CIRCUIT_BREAKER.record("error", breaker_token)
+                fallback_result["status"] = "ai_failed"
                 return fallback_result
                 
+        except concurrent.futures.TimeoutError:
+            print(f"AI 差分分析がタイムアウトしました（{timeout}秒）")
+            AI_CIRCUIT_BREAKER.record("timeout", breaker_token)
+            fallback_result["status"] = "timeout"
+            fallback_result["processing_time"] = timeout
+            return fallback_result
+
+        except GeminiShedError as e:
+            print(f"AI 差分分析を見送りました: {e}")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            fallback_result["status"] = "shed"
+            fallback_result["processing_time"] = time.time() - start_time
+            return fallback_result
+
+        except GeminiBusyError:
+            print("AI 差分分析の実行枠が確保できませんでした")
+            AI_CIRCUIT_BREAKER.cancel(breaker_token)
+            fallback_result["status"] = "rate_limited"
+            fallback_result["processing_time"] = time.time() - start_time
+            return fallback_result
+            
     except Exception as e:
         print(f"AI 差分分析で予期しないエラー: {e}")
+        AI_CIRCUIT_BREAKER.record("error", breaker_token)
         fallback_result["status"] = "error"
         fallback_result["processing_time"] = time.time() - start_time
         return fallback_result
@@ -1205,9 +2423,10 @@ def compare_images(request):
             "comparison_analysis": comparison_result,
             "ai_features": {
                 "vision_enabled": GEMINI_API_KEY is not None,
-                "vision_model": "gemini-2.0-flash-lite" if GEMINI_API_KEY else None,
+                "vision_model": GEMINI_MODEL_NAME if GEMINI_API_KEY else None,
                 "processing_time": comparison_result.get("processing_time", 0),
-                "timeout_setting": AI_VISION_TIMEOUT
+                "timeout_setting": AI_VISION_TIMEOUT,
+                "circuit_breaker": AI_CIRCUIT_BREAKER.snapshot()
             },
             "metadata": {
                 "api_version": "4.2",
@@ -1220,7 +2439,7 @@ def compare_images(request):
             }
         }
         
-        return (json.dumps(response_payload, ensure_ascii=False), 200, headers)
+        return send_json(request, json.dumps(response_payload, ensure_ascii=False), 200, headers)
         
     except Exception as e:
         error_resp = {
@@ -1299,9 +2518,10 @@ def analyze_image(request):
             "image_analysis": analysis_result,
             "ai_features": {
                 "vision_enabled": GEMINI_API_KEY is not None,
-                "vision_model": "gemini-2.0-flash-lite" if GEMINI_API_KEY else None,
+                "vision_model": GEMINI_MODEL_NAME if GEMINI_API_KEY else None,
                 "processing_time": analysis_result.get("processing_time", 0),
-                "timeout_setting": AI_VISION_TIMEOUT
+                "timeout_setting": AI_VISION_TIMEOUT,
+                "circuit_breaker": AI_CIRCUIT_BREAKER.snapshot()
             },
             "metadata": {
                 "api_version": "4.1",
@@ -1311,7 +2531,7 @@ def analyze_image(request):
             }
         }
         
-        return (json.dumps(response_payload, ensure_ascii=False), 200, headers)
+        return send_json(request, json.dumps(response_payload, ensure_ascii=False), 200, headers)
         
     except Exception as e:
         error_resp = {
@@ -1323,24 +2543,493 @@ def analyze_image(request):
         return (json.dumps(error_resp, ensure_ascii=False), 500, headers)
 
 # =============================================================================
-# 【12. メインAPIエンドポイント】
-# Webアプリから呼び出される、熱中症リスク判定のメイン機能です
+# 【11-2. レスポンスの圧縮（gzip / brotli）】
+# 日本語の多いJSONは UTF-8 で1文字3バイトになるため、ブラウザが対応していれば
+# Accept-Encoding に応じて圧縮して返す。キャッシュ済みのレスポンスは圧縮結果も保存する
 # =============================================================================
-@functions_framework.http
-def heat_risk(request):
+COMPRESSION_MIN_BYTES = 1024     # これより小さいレスポンスは圧縮しない
+GZIP_LEVEL_DYNAMIC = 6           # その場で圧縮する時の gzip レベル
+GZIP_LEVEL_MEMOIZED = 9          # 保存して使い回す時の gzip レベル
+BROTLI_QUALITY_DYNAMIC = 5       # その場で圧縮する時の brotli 品質
+BROTLI_QUALITY_MEMOIZED = 11     # 保存して使い回す時の brotli 品質
+
+_brotli_module = None
+_brotli_checked = False
+
+
+def get_brotli():
     """
-    【機能説明】
-    このアプリのメイン機能。Webアプリから呼び出されて、
-    気象データを取得し、暑さ指数を計算し、AIアドバイスを生成して返す
-    
-    【処理の流れ】
-    1. リクエストパラメータの解析
+    brotli を初めて使う時に読み込んで返す（インストールされていなければ None）
+    """
+    global _brotli_module, _brotli_checked
+    if not _brotli_checked:
+        try:
+            import brotli
+            _brotli_module = brotli
+        except ImportError:
+            _brotli_module = None
+        _brotli_checked = True
+    return _brotli_module
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Accept-Encoding ヘッダーから使う圧縮形式を選ぶ（"br" / "gzip" / None）
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    wildcard = accepted.get('*', 0.0)
+    if accepted.get('br', wildcard) > 0 and get_brotli() is not None:
+        return 'br'
+    if accepted.get('gzip', wildcard) > 0:
+        return 'gzip'
+    return None
+
+
+def compress_body(data, encoding, memoized=False):
+    """
+    bytes を指定の形式で圧縮する
+    """
+    if encoding == 'br':
+        quality = BROTLI_QUALITY_MEMOIZED if memoized else BROTLI_QUALITY_DYNAMIC
+        return get_brotli().compress(data, quality=quality)
+    import gzip
+    level = GZIP_LEVEL_MEMOIZED if memoized else GZIP_LEVEL_DYNAMIC
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def etag_for_encoding(etag, encoding):
+    """
+    圧縮形式ごとに異なるETagにする（例: "abc" → "abc-br"、W/"abc" → W/"abc-br"）
+    """
+    if not etag or not encoding:
+        return etag
+    return etag[:-1] + '-' + encoding + '"'
+
+
+def send_json(request, body, status, headers, etag=None, memo=None):
+    """
+    JSONレスポンスを Accept-Encoding に応じて圧縮して返す
+    
+    【入力データ】
+    body : JSON文字列
+    etag : キャッシュ可能なレスポンスのETag（If-None-Match が一致すれば 304）
+    memo : 圧縮結果を保存する辞書（キャッシュ済みレスポンスで使い回す）
+    """
+    headers = {**headers, 'Vary': 'Accept-Encoding'}
+    data = body.encode('utf-8') if isinstance(body, str) else body
+    encoding = None
+    if len(data) >= COMPRESSION_MIN_BYTES:
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+
+    if etag:
+        headers['ETag'] = etag_for_encoding(etag, encoding)
+        if etag_matches(request.headers.get('If-None-Match'), etag):
+            return ('', 304, headers)
+
+    if encoding is None:
+        return (data, status, headers)
+    if memo is not None:
+        if encoding not in memo:
+            memo[encoding] = compress_body(data, encoding, memoized=True)
+        compressed = memo[encoding]
+    else:
+        compressed = compress_body(data, encoding)
+    headers['Content-Encoding'] = encoding
+    return (compressed, status, headers)
+
+
+# =============================================================================
+# 【12-0. HTTPキャッシュ（ETag / Cache-Control）】
+# heat_risk の結果は「観測時刻・観測所・年齢グループ・生成済みアドバイス」で決まるため、
+# 同じ組み合わせのレスポンスを保存して使い回し、ブラウザやCDNにもキャッシュさせる
+# =============================================================================
+AMEDAS_INTERVAL_SECONDS = 600        # アメダスの更新間隔（10分）
+AMEDAS_PUBLISH_DELAY_SECONDS = 60    # 観測時刻から気象庁がデータを公開するまでの目安
+HTTP_CACHE_MIN_MAX_AGE = 30          # Cache-Control max-age の最小値（秒）
+HTTP_CACHE_STALE_MAX_AGE = 60        # 前回取得分（stale）のデータを返す時の max-age（秒）
+RESPONSE_CACHE_MAX_ENTRIES = 512     # 保存するレスポンスの最大件数
+
+# AIの結果をキャッシュしてよい状態（タイムアウト等の時は次のリクエストで再挑戦させる）
+CACHEABLE_AI_STATUSES = ("success", "fallback_no_api_key", "deterministic")
+
+_response_cache = {}                 # キャッシュキー → {"body", "etag", "expires"}
+_response_cache_lock = threading.Lock()
+
+
+def make_etag(cache_key, advice, recommendations, weak=True):
+    """
+    レスポンスを決める入力（観測時刻・観測所・年齢グループ・アドバイス）からETagを作る
+    
+    レスポンスには計算時刻・処理時間・ブレーカーの状態など、インスタンスやリクエストごとに変わる
+    項目も含まれ、同じ入力でもバイト列は同じにならないため、通常は弱いETag（W/"..."）にする
+    内容が毎回同じバイト列になる場合（?resource=static）だけ weak=False で強いETagにする
+    """
+    import hashlib
+    source = json.dumps([list(cache_key), advice, recommendations], ensure_ascii=False, sort_keys=True)
+    tag = '"' + hashlib.sha256(source.encode('utf-8')).hexdigest()[:32] + '"'
+    return 'W/' + tag if weak else tag
+
+
+def etag_matches(if_none_match, etag):
+    """
+    If-None-Match ヘッダーに etag が含まれているかを判定する
+    （If-None-Match は弱い比較のため、W/ の有無は区別しない）
+    """
+    if not if_none_match or not etag:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    if '*' in candidates:
+        return True
+    candidates = [c[2:] if c.startswith('W/') else c for c in candidates]
+    etag = etag[2:] if etag.startswith('W/') else etag
+    # 圧縮形式ごとのETag（"abc-br" など）も元のETagと同じものとして扱う
+    base = etag[:-1]
+    return any(c == etag or (c.startswith(base + '-') and c.endswith('"')) for c in candidates)
+
+
+def cache_max_age(data):
+    """
+    次の観測データが公開されるまでの秒数を max-age として返す
+    """
+    if data.get("data_status") != "fresh" or data.get("data_age_seconds") is None:
+        return HTTP_CACHE_STALE_MAX_AGE
+    remaining = AMEDAS_INTERVAL_SECONDS + AMEDAS_PUBLISH_DELAY_SECONDS - data["data_age_seconds"]
+    return max(HTTP_CACHE_MIN_MAX_AGE, min(AMEDAS_INTERVAL_SECONDS, remaining))
+
+
+def cache_headers(etag, max_age):
+    """
+    キャッシュ可能なレスポンスに付けるHTTPヘッダー
+    """
+    return {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={max_age}, s-maxage={max_age}',
+        'Access-Control-Expose-Headers': 'ETag',
+    }
+
+
+def get_cached_response(cache_key):
+    """
+    保存済みのレスポンスを返す（期限切れや未保存なら None）
+    """
+    with _response_cache_lock:
+        entry = _response_cache.get(cache_key)
+        if entry and entry["expires"] > time.time():
+            return entry
+        _response_cache.pop(cache_key, None)
+        return None
+
+
+def store_cached_response(cache_key, body, etag, max_age):
+    """
+    レスポンスを保存する。件数が上限を超えたら期限切れ・古いものから削除
+    "encoded" には圧縮済みのレスポンスを圧縮形式ごとに保存する
+    """
+    now = time.time()
+    with _response_cache_lock:
+        if len(_response_cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+            for key in [k for k, v in _response_cache.items() if v["expires"] <= now]:
+                del _response_cache[key]
+            while len(_response_cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+                del _response_cache[next(iter(_response_cache))]
+        entry = {"body": body, "etag": etag, "expires": now + max_age, "encoded": {}}
+        _response_cache[cache_key] = entry
+        return entry
+
+
+# =============================================================================
+# 【12-0-2. レスポンスの軽量化（profile=slim / fields=）】
+# 計算式・判定基準表などの毎回同じ内容は、別の長期キャッシュ可能なリソース
+# （?resource=static）で1回だけ送り、通常のレスポンスからは省けるようにする
+# =============================================================================
+HEAT_RISK_STATIC_CONTENT = {
+    "wbgt_analysis": {
+        "calculation_method": "環境省公式の暑さ指数(WBGT)計算式（小野ら2014回帰式）",
+        "formula": "暑さ指数(WBGT) = 0.735 * Ta + 0.0374 * RH + 0.00292 * Ta * RH + 7.619 * SR - 4.557 * (SR^2) - 0.0572 * WS - 4.064",
+        "data_source": "気象庁AMeDAS（全天日射量含む）",
+        "reference": "https://www.wbgt.env.go.jp/wbgt_detail.php"
+    },
+    "age_group_analysis": {
+        "methodology": "子どもは大人より地面に近く、より暑い環境にいるため基準を厳しく設定",
+        "thresholds": {
+            "0-1": {"注意": 16, "警戒": 19, "厳重警戒": 22, "危険": 25, "説明": "乳児：体調を伝えられないため最も厳しい基準"},
+            "2-3": {"注意": 17, "警戒": 20, "厳重警戒": 23, "危険": 26, "説明": "幼児：経験が乏しく前兆がわからないため厳しい基準"},
+            "4-6": {"注意": 18, "警戒": 21, "厳重警戒": 24, "危険": 27, "説明": "幼児・園児：ある程度伝えられるが地面に近いため注意"},
+            "adult": {"注意": 22, "警戒": 25, "厳重警戒": 28, "危険": 31, "説明": "大人の基準（気象庁の測定と同じ高さ）"}
+        }
+    },
+    "metadata": {
+        "data_source": "気象庁アメダス（全天日射量含む）",
+        "wbgt_method": "環境省公式 小野ら(2014)回帰式による暑さ指数(WBGT)",
+        "units": {
+            "temperature": "℃",
+            "humidity": "%",
+            "wind_speed": "m/s",
+            "solar_radiation": "MJ/m²",
+            "wbgt": "℃（暑さ指数）"
+        }
+    }
+}
+
+# profile=slim の時に省く項目（ドット区切りのパス）
+SLIM_EXCLUDED_FIELDS = [
+    "wbgt_analysis.calculation_method",
+    "wbgt_analysis.formula",
+    "wbgt_analysis.data_source",
+    "wbgt_analysis.reference",
+    "age_group_analysis.methodology",
+    "age_group_analysis.thresholds",
+    "child_temperature_analysis.ground_temperatures.difference_from_air",
+    "child_temperature_analysis.height_factor.average_height",
+    "child_temperature_analysis.height_factor.explanation",
+    "ai_features.timeout_settings",
+    "ai_features.capabilities",
+    "metadata.data_source",
+    "metadata.wbgt_method",
+    "metadata.ai_integration",
+    "metadata.age_groups_supported",
+    "metadata.improvements",
+    "metadata.startup_profile",
+    "metadata.units",
+]
+STATIC_RESOURCE_MAX_AGE = 24 * 60 * 60  # ?resource=static のキャッシュ時間（秒）
+_static_resource_encoded = {}  # ?resource=static の圧縮済みレスポンス
+VALID_PROFILES = ["full", "slim"]
+
+
+def parse_fields(value):
+    """
+    fields パラメータ（"observation,wbgt_analysis.wbgt" のようなカンマ区切り）を
+    パスのタプルに変換する。指定が無ければ None
+    """
+    if not value:
+        return None
+    if isinstance(value, (list, tuple)):
+        value = ",".join(str(v) for v in value)
+    fields = tuple(sorted({f.strip() for f in str(value).split(",") if f.strip()}))
+    return fields or None
+
+
+def drop_fields(payload, paths):
+    """
+    ドット区切りのパスで指定された項目を取り除く（payload を直接変更する）
+    """
+    for path in paths:
+        *parents, last = path.split(".")
+        node = payload
+        for key in parents:
+            node = node.get(key) if isinstance(node, dict) else None
+            if node is None:
+                break
+        if isinstance(node, dict):
+            node.pop(last, None)
+    return payload
+
+
+def project_fields(payload, paths):
+    """
+    ドット区切りのパスで指定された項目だけを残した新しい辞書を返す
+    """
+    projected = {}
+    for path in paths:
+        keys = path.split(".")
+        node = payload
+        for key in keys:
+            if not isinstance(node, dict) or key not in node:
+                break
+            node = node[key]
+        else:
+            target = projected
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = node
+    return projected
+
+
+def apply_response_profile(payload, profile="full", fields=None):
+    """
+    profile と fields に従ってレスポンスを軽量化する
+    """
+    if profile == "slim":
+        drop_fields(payload, SLIM_EXCLUDED_FIELDS)
+        payload.setdefault("metadata", {})["static_resource"] = "?resource=static"
+    if fields:
+        payload = project_fields(payload, fields)
+    return payload
+
+
+# =============================================================================
+# 【12-0-3. AI処理の非同期ジョブ】
+# async_ai=true の場合、観測データ・暑さ指数・危険レベルをすぐに返し、
+# AIのアドバイス・推奨事項・画像解析はバックグラウンドで実行します
+# 結果は ?job_id=... で取得でき、一定時間（AI_JOB_TTL_SECONDS）を過ぎると破棄します
+# （結果はインスタンスのメモリに保存するため、同じインスタンスへの問い合わせが前提）
+# =============================================================================
+AI_JOB_TTL_SECONDS = 10 * 60   # ジョブの結果を保存しておく時間（秒）
+AI_JOB_MAX_ENTRIES = 1000      # 保存するジョブの最大件数（超えたら古い順に破棄）
+AI_JOB_WORKERS = 4             # ジョブを実行するスレッドの数
+# 実行待ち・実行中のジョブの上限（ジョブは画像データを抱えたまま待つため、超えたら受け付けない）
+AI_JOB_MAX_PENDING = int(os.environ.get('AI_JOB_MAX_PENDING', '32'))
+AI_JOB_RETRY_AFTER_SECONDS = 10  # 受け付けなかった時に再試行を勧めるまでの秒数
+
+
+class AIJobStore:
+    """
+    期限付きでAI処理のジョブと結果を保存する
+    """
+
+    def __init__(self, ttl_seconds=AI_JOB_TTL_SECONDS, max_entries=AI_JOB_MAX_ENTRIES, workers=AI_JOB_WORKERS,
+                 max_pending=AI_JOB_MAX_PENDING):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_pending = max_pending
+        self._jobs = {}  # ジョブID → {"status", "created", "finished", "result", "error"}（作成順）
+        self._pending = 0  # 実行待ち・実行中のジョブの数
+        self.rejected = 0  # 上限のため受け付けなかったジョブの数
+        self._lock = threading.Lock()
+        # AI処理自体は GEMINI_CLIENT のスレッドプールで動くため、ジョブは別のスレッドプールで待つ
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ai-job')
+
+    def _purge(self, now):
+        """
+        期限切れのジョブと、件数の上限を超えた古いジョブを破棄する（ロックを持った状態で呼ぶ）
+        """
+        for job_id in [j for j, job in self._jobs.items() if now - job["created"] >= self.ttl_seconds]:
+            del self._jobs[job_id]
+        while len(self._jobs) >= self.max_entries:
+            del self._jobs[next(iter(self._jobs))]
+
+    def submit(self, fn):
+        """
+        fn をバックグラウンドで実行し、ジョブIDを返す
+        実行待ち・実行中のジョブが max_pending 件に達している場合は受け付けずに None を返す
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                return None
+            self._pending += 1
+            self._purge(time.time())
+            self._jobs[job_id] = {"status": "pending", "created": time.time(), "finished": None, "result": None, "error": None}
+        self._executor.submit(self._run, job_id, fn)
+        return job_id
+
+    def _run(self, job_id, fn):
+        try:
+            result, status, error = fn(), "done", None
+        except Exception as e:
+            print(f"AIジョブ {job_id} でエラー: {e}")
+            result, status, error = None, "error", str(e)
+        with self._lock:
+            self._pending -= 1
+            job = self._jobs.get(job_id)
+            if job is not None:  # 実行中に期限切れで破棄された場合は何もしない
+                job.update({"status": status, "finished": time.time(), "result": result, "error": error})
+
+    def get(self, job_id):
+        """
+        ジョブの状態と結果（期限切れ・不明なジョブは None）
+        """
+        with self._lock:
+            self._purge(time.time())
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        """
+        実行待ち・実行中のジョブの数と、保存しているジョブの数
+        """
+        with self._lock:
+            return {"pending": self._pending, "max_pending": self.max_pending,
+                    "stored": len(self._jobs), "rejected": self.rejected}
+
+
+AI_JOBS = AIJobStore()
+
+
+def recommendations_block(detailed_recommendations):
+    """
+    レスポンスの safety_recommendations 部分（generate_detailed_recommendations の結果から作成）
+    """
+    return {
+        "general": detailed_recommendations["general"],
+        "age_specific": detailed_recommendations["age_specific"],
+        "ai_generated": detailed_recommendations.get("ai_generated", False),
+        "ai_processing_time": detailed_recommendations.get("processing_time", 0),
+        "ai_status": detailed_recommendations.get("status", "unknown"),
+        "generation_method": "Gemini AI による動的生成" if detailed_recommendations.get("ai_generated") else "固定テンプレート"
+    }
+
+
+def ai_job_response(job_id, job):
+    """
+    ?job_id=... の問い合わせに返す内容
+    """
+    now = time.time()
+    response = {
+        "job_id": job_id,
+        "status": job["status"],  # pending / done / error
+        "age_seconds": round(now - job["created"], 3),
+        "expires_in": max(0, int(job["created"] + AI_JOB_TTL_SECONDS - now)),
+    }
+    if job["finished"] is not None:
+        response["processing_time"] = round(job["finished"] - job["created"], 3)
+    if job["status"] == "done":
+        response["result"] = job["result"]
+    elif job["status"] == "error":
+        response["error"] = job["error"]
+    return response
+
+
+# =============================================================================
+# 【12. メインAPIエンドポイント】
+# Webアプリから呼び出される、熱中症リスク判定のメイン機能です
+# =============================================================================
+def remaining_ai_budget(start_time, stage_timeout):
+    """
+    リクエスト全体の上限（AI_TIMEOUT_SECONDS）のうち、この段階のAI処理に使える残り秒数
+    （混雑時はこの時間内に終わらない見込みのAI処理を受け付けずに固定メッセージにする）
+    """
+    return max(0.0, min(stage_timeout, AI_TIMEOUT_SECONDS - (time.time() - start_time)))
+
+
+@functions_framework.http
+@profile_request
+def heat_risk(request):
+    """
+    【機能説明】
+    このアプリのメイン機能。Webアプリから呼び出されて、
+    気象データを取得し、暑さ指数を計算し、AIアドバイスを生成して返す
+    
+    【処理の流れ】
+    1. リクエストパラメータの解析
     2. 気象庁からデータ取得
     3. 暑さ指数(WBGT)計算
     4. 年齢別リスクレベル判定
     5. AIアドバイス生成
     6. 画像解析（画像がある場合）
     7. 結果をJSON形式で返送
+    
+    【非同期ジョブ（async_ai=true）の注意】
+    - ジョブの結果は処理したインスタンスのメモリにだけ保存されるため、
+      ?job_id=... の問い合わせが別のインスタンスに届くと 404 になる
+      （複数インスタンスで使う場合はセッションアフィニティを有効にするか、最大インスタンス数を1にする）
+    - ジョブにするのは advice_mode=ai か、画像解析・比較を依頼された場合だけ
+      （advice_mode=fast で画像も無い場合は async_ai を無視して、その場で結果を返す）
+    - 実行待ち・実行中のジョブが AI_JOB_MAX_PENDING 件に達している間は、503（Retry-After 付き）を返す
     """
     start_time = time.time()  # 処理時間測定開始
     
@@ -1352,7 +3041,7 @@ def heat_risk(request):
         headers = {
             'Access-Control-Allow-Origin': '*',  # 全てのドメインからのアクセス許可
             'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',  # 許可するHTTPメソッド
-            'Access-Control-Allow-Headers': 'Content-Type',  # 許可するヘッダー
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match, X-Profile',  # 許可するヘッダー（X-Profile はプロファイルの指定）
             'Access-Control-Max-Age': '3600'  # プリフライトリクエストのキャッシュ時間
         }
         return ('', 204, headers)
@@ -1367,11 +3056,48 @@ def heat_risk(request):
     # Webアプリやモバイルアプリから送信されたデータを解析
     # =============================================================================
     try:
+        # 静的な内容（計算式・判定基準表など）だけを返す長期キャッシュ用リソース
+        if request.method == 'GET' and request.args.get('resource') == 'static':
+            static_body = json.dumps(HEAT_RISK_STATIC_CONTENT, ensure_ascii=False)
+            etag = make_etag(("static",), static_body, None, weak=False)  # 毎回同じバイト列のため強いETag
+            response_headers = {**headers, **cache_headers(etag, STATIC_RESOURCE_MAX_AGE)}
+            return send_json(request, static_body, 200, response_headers, etag=etag, memo=_static_resource_encoded)
+
+        # 運用確認用の診断情報（AIのレーン・待ち行列・処理の種類ごとの応答時間とトークン使用量）
+        # 毎回変わる内容のため、通常のレスポンスには含めず、キャッシュもさせない
+        if request.method == 'GET' and request.args.get('resource') == 'diagnostics':
+            diagnostics = {
+                "circuit_breaker": AI_CIRCUIT_BREAKER.snapshot(),
+                "client_stats": GEMINI_CLIENT.stats(),
+                "ai_jobs": AI_JOBS.stats(),
+                "startup_profile": dict(STARTUP_PROFILE),
+                "timestamp": format_jst(datetime.now(timezone.utc))
+            }
+            return send_json(request, json.dumps(diagnostics, ensure_ascii=False), 200, {**headers, 'Cache-Control': 'no-store'})
+
+        # 非同期ジョブ（async_ai=true）の結果の問い合わせ
+        if request.method == 'GET' and request.args.get('job_id'):
+            job_id = request.args.get('job_id')
+            job = AI_JOBS.get(job_id)
+            if job is None:
+                error_resp = {
+                    "error": "ジョブが見つかりません",
+                    "message": f"job_idが不明か、保存期間（{AI_JOB_TTL_SECONDS}秒）を過ぎています",
+                    "provided": job_id
+                }
+                return (json.dumps(error_resp, ensure_ascii=False), 404, {**headers, 'Cache-Control': 'no-store'})
+            status_code = 202 if job["status"] == "pending" else 200
+            return send_json(request, json.dumps(ai_job_response(job_id, job), ensure_ascii=False), status_code, {**headers, 'Cache-Control': 'no-store'})
+
         # リクエストパラメータの取得
         if request.method == 'POST':
             request_json = request.get_json() or {}
             age_group = request_json.get('age_group') or request.args.get('age_group', '2-3')
             detailed = str(request_json.get('detailed', request.args.get('detailed', 'false'))).lower() == 'true'
+            profile = request_json.get('profile') or request.args.get('profile', 'full')
+            fields = parse_fields(request_json.get('fields') or request.args.get('fields'))
+            advice_mode = request_json.get('advice_mode') or request.args.get('advice_mode', ADVICE_MODE)
+            async_ai = str(request_json.get('async_ai', request.args.get('async_ai', 'false'))).lower() == 'true'
             
             # 観測所情報（GPS機能連携）
             station_id = request_json.get('station_id')
@@ -1397,6 +3123,10 @@ def heat_risk(request):
         else:
             age_group = request.args.get('age_group', '2-3')
             detailed = request.args.get('detailed', 'false').lower() == 'true'
+            profile = request.args.get('profile', 'full')
+            fields = parse_fields(request.args.get('fields'))
+            advice_mode = request.args.get('advice_mode', ADVICE_MODE)
+            async_ai = request.args.get('async_ai', 'false').lower() == 'true'
             station_id = request.args.get('station_id')
             station_name = request.args.get('station_name')
             
@@ -1424,9 +3154,29 @@ def heat_risk(request):
             }
             return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
         
+        # レスポンス形式の検証
+        if profile not in VALID_PROFILES:
+            error_resp = {
+                "error": "無効なprofile",
+                "message": f"profileは {VALID_PROFILES} のいずれかを指定してください",
+                "provided": profile
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        # アドバイスの作り方の検証
+        if advice_mode not in VALID_ADVICE_MODES:
+            error_resp = {
+                "error": "無効なadvice_mode",
+                "message": f"advice_modeは {VALID_ADVICE_MODES} のいずれかを指定してください",
+                "provided": advice_mode
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        use_ai = advice_mode == "ai" and not async_ai  # 非同期ジョブの場合、AIはバックグラウンドで実行
+        
         data = get_amedas_data(station_id, station_name)
         if not data:
-            # フォールバックデータを使用（テスト用の現実的なデータ）
+            # 気象庁データも保存データも使えない場合の最終手段（季節・時間帯の代表値）
+            # 毎回結果が変わらないよう、ランダムな変動は加えない
             now = datetime.now(timezone.utc).astimezone(timezone(timedelta(hours=9)))  # JSTに変換
             month = now.month
             hour = now.hour
@@ -1456,15 +3206,9 @@ def heat_risk(request):
                 temp_adjustment = -5
                 solar_radiation = 0.0
             
-            # ランダムな変動を加える
-            temperature = base_temp + temp_adjustment + random.uniform(-3, 3)
-            humidity = humidity_base + random.uniform(-15, 15)
-            wind_speed = random.uniform(0.5, 3.0)
-            
-            # 範囲チェック
-            temperature = max(-10, min(45, temperature))
-            humidity = max(20, min(100, humidity))
-            wind_speed = max(0, min(10, wind_speed))
+            temperature = base_temp + temp_adjustment
+            humidity = humidity_base
+            wind_speed = 1.5  # 平均的な風速
             
             data = {
                 "station": f"{STATION_NAME} (フォールバックデータ)",
@@ -1475,32 +3219,102 @@ def heat_risk(request):
                 "wind_speed": round(wind_speed, 1),
                 "solar_radiation": round(solar_radiation, 1),
                 "sunshine": round(solar_radiation, 1),
+                "data_status": "synthetic",  # 実測ではない推定値
+                "data_age_seconds": None,
             }
 
+        # =============================================================================
+        # 【12-3. キャッシュ済みレスポンスの確認】
+        # 画像解析を含まず実測データの場合は、同じ観測時刻・観測所・年齢グループの
+        # レスポンスを使い回す。ブラウザが同じETagを持っていれば 304 を返す
+        # =============================================================================
+        cache_key = None
+        wants_image_analysis = bool(image_data and include_image_analysis)
+        wants_comparison = bool(before_image and after_image and include_comparison_analysis)
+        if async_ai and advice_mode != "ai" and not wants_image_analysis and not wants_comparison:
+            # AIを使う処理が無い（advice_mode=fast で画像も無い）ので、ジョブにせずその場で返す
+            async_ai = False
+        if data.get("data_status") != "synthetic" and not wants_image_analysis and not wants_comparison and not async_ai:
+            cache_key = (data["time"], data["station_id"], data["station"], age_group, profile, fields, advice_mode)
+            cached = get_cached_response(cache_key)
+            if cached:
+                max_age = max(1, int(cached["expires"] - time.time()))
+                response_headers = {**headers, **cache_headers(cached["etag"], max_age)}
+                return send_json(request, cached["body"], 200, response_headers, etag=cached["etag"], memo=cached["encoded"])
+
         wbgt = calculate_wbgt(data['temperature'], data['humidity'], data['wind_speed'], data['solar_radiation'])
-        risk = get_heat_risk_level(wbgt, age_group, data['temperature'], data['humidity'])
+        # 各AI処理にはリクエスト全体の残り時間を渡す（間に合わない見込みなら shed で固定メッセージ）
+        risk = get_heat_risk_level(wbgt, age_group, data['temperature'], data['humidity'],
+                                   timeout=remaining_ai_budget(start_time, AI_ADVICE_TIMEOUT),
+                                   advice_mode="ai" if use_ai else "fast")
         
         # 年齢別体感気温計算（常に実行）
         child_temp_min, child_temp_max, ground_temp_normal, ground_temp_asphalt, correction_range = calculate_child_temperatures(data['temperature'], age_group)
 
         # AI生成の詳細推奨事項（タイムアウト対応）
         detailed_recommendations = generate_detailed_recommendations(
-            wbgt, age_group, data['temperature'], data['humidity'], risk['level'], data
+            wbgt, age_group, data['temperature'], data['humidity'], risk['level'], data,
+            timeout=remaining_ai_budget(start_time, AI_RECOMMENDATIONS_TIMEOUT),
+            use_ai=use_ai
         )
 
         # 画像解析（画像データがある場合のみ）
         image_analysis_result = None
-        if image_data and include_image_analysis:
-            image_analysis_result = analyze_image_with_ai(image_data, age_group)
+        if wants_image_analysis and not async_ai:
+            image_analysis_result = analyze_image_with_ai(
+                image_data, age_group, timeout=remaining_ai_budget(start_time, AI_VISION_TIMEOUT)
+            )
         
         # 差分画像解析（2枚の画像がある場合のみ）
         comparison_analysis_result = None
-        if before_image and after_image and include_comparison_analysis:
+        if wants_comparison and not async_ai:
             comparison_analysis_result = analyze_images_comparison(
                 before_image, after_image, age_group, 
-                time_difference_minutes, before_timestamp, after_timestamp
+                time_difference_minutes, before_timestamp, after_timestamp,
+                timeout=remaining_ai_budget(start_time, AI_VISION_TIMEOUT)
             )
 
+        # 非同期ジョブ: AIのアドバイス・推奨事項・画像解析はバックグラウンドで実行し、
+        # ここでは決まった手順で作った内容をすぐに返す（結果は ?job_id=... で取得）
+        ai_job_id = None
+        if async_ai:
+            risk_level = risk["level"]
+
+            def ai_job():
+                result = {}
+                if advice_mode == "ai":  # advice_mode=fast ではアドバイスはその場で返した内容のまま
+                    advice = generate_ai_advice(wbgt, age_group, data['temperature'], data['humidity'], risk_level)
+                    recommendations = generate_detailed_recommendations(
+                        wbgt, age_group, data['temperature'], data['humidity'], risk_level, data
+                    )
+                    result["age_group_analysis"] = {
+                        "advice_message": advice["result"],
+                        "ai_generated": advice["ai_generated"],
+                        "ai_advice": advice["result"],
+                        "ai_processing_time": advice["processing_time"],
+                        "ai_status": advice["status"]
+                    }
+                    result["safety_recommendations"] = recommendations_block(recommendations)
+                if wants_image_analysis:
+                    result["image_analysis"] = analyze_image_with_ai(image_data, age_group)
+                if wants_comparison:
+                    result["comparison_analysis"] = analyze_images_comparison(
+                        before_image, after_image, age_group,
+                        time_difference_minutes, before_timestamp, after_timestamp
+                    )
+                return result
+
+            ai_job_id = AI_JOBS.submit(ai_job)
+            if ai_job_id is None:
+                # 実行待ちのジョブが上限に達している（画像データを抱えたジョブを増やし続けない）
+                error_resp = {
+                    "error": "混雑しています",
+                    "message": f"AI処理の受付が上限（{AI_JOB_MAX_PENDING}件）に達しています。{AI_JOB_RETRY_AFTER_SECONDS}秒ほど待ってから再度お試しください",
+                    "provided": {"async_ai": True}
+                }
+                return (json.dumps(error_resp, ensure_ascii=False), 503,
+                        {**headers, 'Retry-After': str(AI_JOB_RETRY_AFTER_SECONDS), 'Cache-Control': 'no-store'})
+
         # 詳細なペイロード作成
         payload = {
             # 基本観測データ
@@ -1512,22 +3326,25 @@ def heat_risk(request):
                 "humidity": data["humidity"],
                 "wind_speed": data["wind_speed"],
                 "solar_radiation": data["solar_radiation"],
-                "sunshine": data["sunshine"]
+                "sunshine": data["sunshine"],
+                "data_status": data["data_status"],  # fresh / stale / synthetic
+                "data_age_seconds": data["data_age_seconds"],  # 観測時刻からの経過秒数
+                "max_stale_seconds": AMEDAS_MAX_STALE_SECONDS
             },
             
             # 暑さ指数(WBGT)計算結果
             "wbgt_analysis": {
                 "wbgt": wbgt,
-                "calculation_method": "環境省公式の暑さ指数(WBGT)計算式（小野ら2014回帰式）",
-                "formula": "暑さ指数(WBGT) = 0.735 * Ta + 0.0374 * RH + 0.00292 * Ta * RH + 7.619 * SR - 4.557 * (SR^2) - 0.0572 * WS - 4.064",
+                "calculation_method": HEAT_RISK_STATIC_CONTENT["wbgt_analysis"]["calculation_method"],
+                "formula": HEAT_RISK_STATIC_CONTENT["wbgt_analysis"]["formula"],
                 "parameters_used": {
                     "Ta": data["temperature"],  # 気温 [℃]
                     "RH": data["humidity"],     # 相対湿度 [%]
                     "SR": data["solar_radiation"] * 0.278 if data["solar_radiation"] else 0.6,  # 日射強度 [kW/m²]
                     "WS": data["wind_speed"] if data["wind_speed"] else 1.0  # 風速 [m/s]
                 },
-                "data_source": "気象庁AMeDAS（全天日射量含む）",
-                "reference": "https://www.wbgt.env.go.jp/wbgt_detail.php"
+                "data_source": HEAT_RISK_STATIC_CONTENT["wbgt_analysis"]["data_source"],
+                "reference": HEAT_RISK_STATIC_CONTENT["wbgt_analysis"]["reference"]
             },
             
             # 年齢グループ別分析（AI強化、タイムアウト対応）
@@ -1540,13 +3357,8 @@ def heat_risk(request):
                 "ai_advice": risk.get("ai_advice", risk["message"]),
                 "ai_processing_time": risk.get("ai_processing_time", 0),
                 "ai_status": risk.get("ai_status", "unknown"),
-                "methodology": "子どもは大人より地面に近く、より暑い環境にいるため基準を厳しく設定",
-                "thresholds": {
-                    "0-1": {"注意": 16, "警戒": 19, "厳重警戒": 22, "危険": 25, "説明": "乳児：体調を伝えられないため最も厳しい基準"},
-                    "2-3": {"注意": 17, "警戒": 20, "厳重警戒": 23, "危険": 26, "説明": "幼児：経験が乏しく前兆がわからないため厳しい基準"},
-                    "4-6": {"注意": 18, "警戒": 21, "厳重警戒": 24, "危険": 27, "説明": "幼児・園児：ある程度伝えられるが地面に近いため注意"},
-                    "adult": {"注意": 22, "警戒": 25, "厳重警戒": 28, "危険": 31, "説明": "大人の基準（気象庁の測定と同じ高さ）"}
-                }
+                "methodology": HEAT_RISK_STATIC_CONTENT["age_group_analysis"]["methodology"],
+                "thresholds": HEAT_RISK_STATIC_CONTENT["age_group_analysis"]["thresholds"]
             },
             
             # 子ども向け体感気温分析
@@ -1579,16 +3391,13 @@ def heat_risk(request):
             },
             
             # AI強化されたほぼ安全対策の提案（タイムアウト対応）
-            "safety_recommendations": {
-                "general": detailed_recommendations["general"],
-                "age_specific": detailed_recommendations["age_specific"],
-                "ai_generated": detailed_recommendations.get("ai_generated", False),
-                "ai_processing_time": detailed_recommendations.get("processing_time", 0),
-                "ai_status": detailed_recommendations.get("status", "unknown"),
-                "generation_method": "Gemini AI による動的生成" if detailed_recommendations.get("ai_generated") else "固定テンプレート"
-            }
+            "safety_recommendations": recommendations_block(detailed_recommendations)
         }
 
+        # 今日の暑さの蓄積（実測データの場合のみ）
+        if data.get("data_status") != "synthetic":
+            payload["daily_exposure"] = DAILY_EXPOSURE.summary(data["station_id"], age_group)
+
         # 画像解析結果を追加（画像がある場合のみ）
         if image_analysis_result:
             payload["image_analysis"] = image_analysis_result
@@ -1600,8 +3409,9 @@ def heat_risk(request):
         # AI機能の情報（タイムアウト対応強化）
         payload["ai_features"] = {
             "enabled": GEMINI_API_KEY is not None,
-            "model": "gemini-2.0-flash-lite" if GEMINI_API_KEY else None,
+            "model": GEMINI_MODEL_NAME if GEMINI_API_KEY else None,
             "vision_enabled": GEMINI_API_KEY is not None and image_data is not None,
+            "advice_mode": advice_mode,  # fast: 決まった手順で作成 / ai: Gemini AI で作成
             "timeout_settings": {
                 "ai_advice_timeout": AI_ADVICE_TIMEOUT,
                 "ai_recommendations_timeout": AI_RECOMMENDATIONS_TIMEOUT,
@@ -1617,6 +3427,7 @@ def heat_risk(request):
                 "画像解析による環境評価" if GEMINI_API_KEY else None
             ] if GEMINI_API_KEY else ["固定テンプレートによる基本的なアドバイス"],
             "fallback_mode": not bool(GEMINI_API_KEY),
+            "circuit_breaker": AI_CIRCUIT_BREAKER.snapshot(),  # AIサーキットブレーカーの状態
             "performance": {
                 "ai_advice_time": risk.get("ai_processing_time", 0),
                 "ai_recommendations_time": detailed_recommendations.get("processing_time", 0),
@@ -1630,8 +3441,8 @@ def heat_risk(request):
         payload["metadata"] = {
             "api_version": "4.3",  # 差分画像解析機能追加によりバージョンアップ
             "calculation_timestamp": datetime.now(timezone.utc).astimezone(timezone(timedelta(hours=9))).strftime("%Y-%m-%d %H:%M:%S JST"),
-            "data_source": "気象庁アメダス（全天日射量含む）",
-            "wbgt_method": "環境省公式 小野ら(2014)回帰式による暑さ指数(WBGT)",
+            "data_source": HEAT_RISK_STATIC_CONTENT["metadata"]["data_source"],
+            "wbgt_method": HEAT_RISK_STATIC_CONTENT["metadata"]["wbgt_method"],
             "ai_integration": "Gemini AI による動的アドバイス生成（タイムアウト対応）+ Vision解析",
             "age_groups_supported": ["0-1", "2-3", "4-6"],
             "image_analysis_included": bool(image_analysis_result),
@@ -1646,18 +3457,38 @@ def heat_risk(request):
                 "フォールバック機能の強化",
                 "日本時間（JST）への時刻変換対応",
                 "Gemini Vision AIによる画像解析機能",
-                "2枚の画像による差分分析機能（外出前後の変化検出）"
+                "2枚の画像による差分分析機能（外出前後の変化検出）",
+                "重いライブラリの遅延読み込みによるコールドスタート短縮"
             ],
-            "units": {
-                "temperature": "℃",
-                "humidity": "%",
-                "wind_speed": "m/s",
-                "solar_radiation": "MJ/m²",
-                "wbgt": "℃（暑さ指数）"
-            }
+            "startup_profile": dict(STARTUP_PROFILE),  # 起動時間の内訳（秒）
+            "units": HEAT_RISK_STATIC_CONTENT["metadata"]["units"]
         }
 
-        return (json.dumps(payload, ensure_ascii=False), 200, headers)
+        # profile=slim / fields= による軽量化
+        payload = apply_response_profile(payload, profile, fields)
+
+        # 非同期ジョブの情報（fields= の指定に関わらず必ず含める）
+        if ai_job_id:
+            payload["ai_job"] = {
+                "job_id": ai_job_id,
+                "status": "pending",
+                "poll": f"?job_id={ai_job_id}",
+                "expires_in": AI_JOB_TTL_SECONDS
+            }
+
+        body = json.dumps(payload, ensure_ascii=False)
+
+        # AIの結果が安定している場合のみ保存し、ETagとCache-Controlを付ける
+        if (cache_key is not None
+                and risk.get("ai_status") in CACHEABLE_AI_STATUSES
+                and detailed_recommendations.get("status") in CACHEABLE_AI_STATUSES):
+            etag = make_etag(cache_key, risk.get("ai_advice"), [detailed_recommendations["general"], detailed_recommendations["age_specific"]])
+            max_age = cache_max_age(data)
+            entry = store_cached_response(cache_key, body, etag, max_age)
+            response_headers = {**headers, **cache_headers(etag, max_age)}
+            return send_json(request, body, 200, response_headers, etag=etag, memo=entry["encoded"])
+
+        return send_json(request, body, 200, {**headers, 'Cache-Control': 'no-store'})
         
     except Exception as e:
         error_resp = {
@@ -1671,7 +3502,1271 @@ def heat_risk(request):
 
 
 # =============================================================================
-# 【13. ローカルテスト用のコード】
+# 【13. 施設名簿の一括判定API】
+# 保育園など複数の施設・年齢グループの子どもを、1回のリクエストでまとめて判定します
+# 同じ気象データ（スナップショット）を使い、アドバイスは危険レベルごとに1回だけ作ります
+# =============================================================================
+ROSTER_MAX_FACILITIES = 200   # 1回のリクエストで判定できる施設数の上限
+ROSTER_ADVICE_WORKERS = 4     # アドバイスを同時に生成する数
+
+
+def resolve_facility_station(facility, all_data):
+    """
+    施設の観測所を決める（station_id を優先し、無ければ緯度経度から最寄りを探す）
+    
+    【出力データ】
+    {"id", "name", "distance_km"（緯度経度で探した場合）} または None
+    """
+    station_names = load_amedas_station_names()
+    station_id = facility.get("station_id")
+    if station_id:
+        station_id = str(station_id)
+        if station_id in all_data:
+            return {"id": station_id, "name": station_names.get(station_id, station_id)}
+        alternative = find_alternative_station(station_id, all_data)
+        if alternative:
+            return {"id": alternative["id"], "name": alternative["name"]}
+    lat, lng = facility.get("lat"), facility.get("lng")
+    if lat is not None and lng is not None:
+        nearest = find_nearest_station(float(lat), float(lng), available_ids=all_data)
+        if nearest:
+            return {"id": nearest["id"], "name": nearest["name"], "distance_km": nearest["distance_km"]}
+    return None
+
+
+def validate_facility(facility):
+    """
+    施設情報の形式（施設がオブジェクトか、headcounts の年齢グループと人数、緯度経度）を確認する
+    
+    【出力データ】
+    (年齢グループ → 人数（1人以上のみ）, エラーメッセージ)  正しい形式ならエラーメッセージは None
+    """
+    valid_age_groups = ["0-1", "2-3", "4-6"]
+    if not isinstance(facility, dict):
+        return None, "施設情報は {\"id\", \"station_id\" または \"lat\"/\"lng\", \"headcounts\"} の形式で指定してください"
+    headcounts = facility.get("headcounts")
+    if not isinstance(headcounts, dict):
+        return None, "headcountsは {年齢グループ: 人数} の形式で指定してください"
+    invalid = [g for g in headcounts if g not in valid_age_groups]
+    if invalid:
+        return None, f"無効な年齢グループ: {invalid}"
+    counts = {}
+    for group, count in headcounts.items():
+        # 真偽値・小数・負の数・数字以外の文字列は受け付けない
+        if isinstance(count, bool) or not isinstance(count, (int, str)) or not str(count).strip().isdigit():
+            return None, "headcountsの人数は0以上の整数で指定してください"
+        if int(count) > 0:
+            counts[group] = int(count)
+    if not counts:
+        return None, "headcountsに1人以上の年齢グループが必要です"
+    for key in ("lat", "lng"):
+        if facility.get(key) is not None:
+            try:
+                float(facility[key])
+            except (TypeError, ValueError):
+                return None, f"{key}は数値で指定してください"
+    return counts, None
+
+
+def score_roster(facilities, all_data, include_advice=True, advice_mode=None):
+    """
+    【機能説明】
+    施設の一覧を1つのスナップショットでまとめて判定する
+    
+    【入力データ】
+    facilities : [{"id", "name", "station_id" または "lat"/"lng", "headcounts": {"0-1": 人数, ...}}, ...]
+    all_data : アメダス全国データ（観測所ID → 観測値）
+    include_advice : 危険レベルごとのアドバイスを生成するか
+    advice_mode : "fast"（決まった手順で作成）/ "ai"（Gemini AI で作成）。省略時は ADVICE_MODE
+    
+    【出力データ】
+    {"facilities": 施設ごとの判定結果, "advice": 危険レベルごとのアドバイス}
+    """
+    valid_age_groups = ["0-1", "2-3", "4-6"]
+    results = []
+    station_cache = {}     # 観測所ID → 観測値と暑さ指数（同じ観測所は1回だけ計算）
+    pending = {group: [] for group in valid_age_groups}  # 年齢グループ → 判定待ちの (結果の位置, WBGT)
+
+    # ステップ1: 施設ごとに観測所と暑さ指数を決める
+    for index, facility in enumerate(facilities):
+        headcounts, error = validate_facility(facility)
+        if not isinstance(facility, dict):
+            facility = {}
+        entry = {"facility_id": facility.get("id", index), "name": facility.get("name")}
+        results.append(entry)
+        if error:
+            entry["error"] = error
+            continue
+
+        station = resolve_facility_station(facility, all_data)
+        if station is None:
+            entry["error"] = "観測所が見つかりません（station_id または lat/lng を指定してください）"
+            continue
+
+        if station["id"] not in station_cache:
+            observation = observation_from_station_data(all_data[station["id"]])
+            wbgt = calculate_wbgt(observation["temperature"], observation["humidity"],
+                                  observation["wind_speed"], observation["solar_radiation"])
+            station_cache[station["id"]] = (observation, wbgt)
+        observation, wbgt = station_cache[station["id"]]
+
+        entry.update({
+            "station": station,
+            "observation": observation,
+            "wbgt": wbgt,
+            "daily_exposure": DAILY_EXPOSURE.summary(station["id"]),
+            "total_headcount": sum(headcounts.values()),
+            "age_groups": {g: {"headcount": n} for g, n in headcounts.items()},
+        })
+        for group in headcounts:
+            pending[group].append((index, wbgt))
+
+    # ステップ2: 年齢グループごとにまとめて危険レベルを判定
+    advice_inputs = {}  # アドバイスのキー → 代表の条件（最もWBGTが高い施設）
+    for group, items in pending.items():
+        levels = classify_wbgt_batch([w for _, w in items], group)
+        for (index, wbgt), level_index in zip(items, levels):
+            group_entry = results[index]["age_groups"][group]
+            if level_index is None:
+                group_entry.update({"risk_level": "不明", "risk_color": "gray", "advice_key": None})
+                continue
+            level = RISK_LEVELS[level_index]
+            advice_key = f"{group}|{level}"
+            group_entry.update({
+                "risk_level": level,
+                "risk_color": RISK_COLORS[level],
+                "level_index": level_index,
+                "advice_key": advice_key,
+            })
+            current = advice_inputs.get(advice_key)
+            if current is None or wbgt > current[0]:
+                advice_inputs[advice_key] = (wbgt, group, level, results[index]["observation"])
+
+    # ステップ3: 施設ごとに最も危険な年齢グループを選ぶ（同じレベルなら年齢の低い方）
+    for entry in results:
+        groups = entry.get("age_groups")
+        if not groups:
+            continue
+        scored = [(g, v) for g, v in groups.items() if v.get("level_index") is not None]
+        if not scored:
+            entry["strictest"] = None
+            continue
+        group, value = max(scored, key=lambda item: (item[1]["level_index"], -valid_age_groups.index(item[0])))
+        entry["strictest"] = {"age_group": group, **value}
+
+    # ステップ4: 危険レベルごとに1回だけアドバイスを生成
+    advice = {}
+    if include_advice and advice_inputs and (advice_mode or ADVICE_MODE) != "ai":
+        # 高速モード: AIを待たずにその場で作る
+        for key, (wbgt, group, level, observation) in advice_inputs.items():
+            advice[key] = {
+                "age_group": group,
+                "risk_level": level,
+                "text": render_deterministic_advice(group, level),
+                "ai_generated": False,
+                "ai_status": "deterministic",
+            }
+    elif include_advice and advice_inputs:
+        def advice_worker(item):
+            key, (wbgt, group, level, observation) = item
+            result = generate_ai_advice(wbgt, group, observation["temperature"], observation["humidity"], level)
+            return key, {
+                "age_group": group,
+                "risk_level": level,
+                "text": result["result"],
+                "ai_generated": result["ai_generated"],
+                "ai_status": result["status"],
+            }
+
+        workers = min(ROSTER_ADVICE_WORKERS, len(advice_inputs))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            advice = dict(executor.map(advice_worker, advice_inputs.items()))
+
+    return {"facilities": results, "advice": advice}
+
+
+@functions_framework.http
+def roster_risk(request):
+    """
+    施設名簿の一括判定用のHTTPエンドポイント
+    
+    【リクエスト例（POST）】
+    {
+        "facilities": [
+            {"id": "A園", "station_id": "44132", "headcounts": {"0-1": 3, "2-3": 8}},
+            {"id": "B園", "lat": 35.68, "lng": 139.76, "headcounts": {"4-6": 20}}
+        ],
+        "include_advice": true
+    }
+    """
+    start_time = time.time()
+    
+    # CORS対応
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+    
+    if request.method != 'POST':
+        error_resp = {
+            "error": "無効なHTTPメソッド",
+            "message": "POSTメソッドを使用してください",
+            "method": request.method
+        }
+        return (json.dumps(error_resp, ensure_ascii=False), 405, headers)
+    
+    try:
+        request_json = request.get_json(silent=True)
+        facilities = request_json.get('facilities') if isinstance(request_json, dict) else None
+        if not isinstance(facilities, list) or not facilities:
+            error_resp = {
+                "error": "無効なリクエスト",
+                "message": "facilities（施設の一覧）が必要です"
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        
+        if len(facilities) > ROSTER_MAX_FACILITIES:
+            error_resp = {
+                "error": "施設数が多すぎます",
+                "message": f"1回のリクエストで判定できる施設は{ROSTER_MAX_FACILITIES}件までです",
+                "provided": len(facilities)
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        
+        # 施設ごとの形式の検証（どの施設が正しくないかを返す）
+        for index, facility in enumerate(facilities):
+            _, error = validate_facility(facility)
+            if error:
+                error_resp = {
+                    "error": "無効な施設情報",
+                    "message": error,
+                    "provided": {
+                        "index": index,
+                        "facility_id": facility.get("id") if isinstance(facility, dict) else None,
+                        "facility": facility
+                    }
+                }
+                return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        
+        snapshot = get_amedas_snapshot()
+        if snapshot is None:
+            error_resp = {
+                "error": "気象データを取得できません",
+                "message": "しばらくしてから再度お試しください"
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 503, headers)
+        
+        include_advice = str(request_json.get('include_advice', True)).lower() != 'false'
+        advice_mode = request_json.get('advice_mode', ADVICE_MODE)
+        if advice_mode not in VALID_ADVICE_MODES:
+            error_resp = {
+                "error": "無効なadvice_mode",
+                "message": f"advice_modeは {VALID_ADVICE_MODES} のいずれかを指定してください",
+                "provided": advice_mode
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        scored = score_roster(facilities, snapshot["data"], include_advice=include_advice, advice_mode=advice_mode)
+        
+        response_payload = {
+            "facilities": scored["facilities"],
+            "advice": scored["advice"],
+            "snapshot": {
+                "time": format_jst(snapshot["latest"]),
+                "data_status": snapshot["status"],
+                "data_age_seconds": snapshot["age_seconds"]
+            },
+            "metadata": {
+                "api_version": "4.3",
+                "timestamp": format_jst(datetime.now(timezone.utc)),
+                "facility_count": len(facilities),
+                "advice_count": len(scored["advice"]),
+                "circuit_breaker": AI_CIRCUIT_BREAKER.snapshot(),
+                "total_processing_time": time.time() - start_time
+            }
+        }
+        
+        return send_json(request, json.dumps(response_payload, ensure_ascii=False), 200, headers)
+        
+    except Exception as e:
+        error_resp = {
+            "error": "内部エラー",
+            "message": str(e),
+            "timestamp": format_jst(datetime.now(timezone.utc)),
+            "processing_time": time.time() - start_time
+        }
+        return (json.dumps(error_resp, ensure_ascii=False), 500, headers)
+
+
+# =============================================================================
+# 【14. 登録施設の定期判定（スケジューラー）】
+# 施設を登録しておくと、新しいアメダスデータが届くたびに全施設をまとめて判定し、
+# 結果を保存します。利用者は保存済みの結果を読むだけで済みます
+# =============================================================================
+# 登録施設と判定結果の保存先
+# 既定は一時ディレクトリで、Cloud Functions ではインスタンスごとのメモリ上にあるため、
+# 他のインスタンスからは見えず、インスタンスが入れ替わると登録は消える
+# （複数インスタンスで使う場合は、Cloud Storage FUSE などの共有ストレージのパスを指定する）
+FACILITY_STORE_PATH = os.environ.get(
+    'FACILITY_STORE_PATH',
+    os.path.join(tempfile.gettempdir(), 'kids-heat-risk', 'facilities.json')
+)
+
+# 登録できる施設数の上限（スナップショットごとの再判定を roster_risk の1回分の施設数に収める）
+FACILITY_MAX_REGISTERED = int(os.environ.get('FACILITY_MAX_REGISTERED', str(ROSTER_MAX_FACILITIES)))
+
+# 施設の登録・解除と再判定（POST / DELETE）に必要な管理用の合言葉
+# 同じ値を FACILITY_ADMIN_HEADER ヘッダーで送ったリクエストだけを受け付ける（未設定なら受け付けない）
+FACILITY_ADMIN_TOKEN = os.environ.get('FACILITY_ADMIN_TOKEN')
+FACILITY_ADMIN_HEADER = 'X-Admin-Token'
+
+
+def facility_admin_authorized(request):
+    """
+    施設の登録・解除をしてよいリクエストか（管理用の合言葉のヘッダーが一致するか）
+    """
+    if not FACILITY_ADMIN_TOKEN:
+        return False
+    provided = request.headers.get(FACILITY_ADMIN_HEADER)
+    return bool(provided) and hmac.compare_digest(provided, FACILITY_ADMIN_TOKEN)
+
+
+def write_json_atomic(path, data):
+    """
+    JSONファイルを一時ファイル経由で書き込み、途中の状態が読まれないようにする
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FacilityScheduler:
+    """
+    登録施設を保存し、スナップショットごとに一括で判定し直すスケジューラー
+    
+    保存ファイルの形式:
+    {
+        "facilities": {施設ID: 施設情報},
+        "results": {"snapshot_latest": 観測時刻(ISO), "snapshot_time": 表示用時刻,
+                    "evaluated_at": 判定時刻, "facilities": {施設ID: 判定結果}, "advice": {...}}
+    }
+    """
+
+    def __init__(self, store_path=FACILITY_STORE_PATH, max_facilities=FACILITY_MAX_REGISTERED):
+        self.store_path = store_path
+        self.max_facilities = max_facilities
+        self._lock = threading.RLock()
+        self._evaluate_lock = threading.Lock()  # 同じスナップショットを二重に判定しないため
+        self._state = None
+        self._mtime = None   # 読み込んだ保存ファイルの更新時刻
+
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.store_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        # 共有ストレージで他のインスタンスが書き換えた場合も読み直す
+        mtime = self._stat_mtime()
+        if self._state is None or mtime != self._mtime:
+            try:
+                with open(self.store_path, encoding='utf-8') as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                if self._state is None:
+                    self._state = {"facilities": {}, "results": None}
+            self._mtime = mtime
+        return self._state
+
+    def _save(self):
+        write_json_atomic(self.store_path, self._state)
+        self._mtime = self._stat_mtime()
+
+    def register(self, facility):
+        """
+        施設を登録して (施設ID, エラーメッセージ) を返す
+        同じIDの施設が既に登録されている場合や、登録数が上限に達している場合は登録せず、施設IDは None
+        """
+        with self._lock:
+            state = self._load()
+            facility_id = str(facility.get("id") or f"facility-{uuid.uuid4().hex[:8]}")
+            if facility_id in state["facilities"]:
+                return None, f"施設ID {facility_id} は既に登録されています（変更する場合は登録を解除してから登録し直してください）"
+            if len(state["facilities"]) >= self.max_facilities:
+                return None, f"登録できる施設数の上限（{self.max_facilities}件）に達しています"
+            state["facilities"][facility_id] = {**facility, "id": facility_id}
+            self._save()
+            return facility_id, None
+
+    def unregister(self, facility_id):
+        """
+        施設の登録を解除する。解除できたら True
+        """
+        with self._lock:
+            state = self._load()
+            removed = state["facilities"].pop(str(facility_id), None) is not None
+            if removed and state["results"]:
+                state["results"]["facilities"].pop(str(facility_id), None)
+            self._save()
+            return removed
+
+    def facilities(self):
+        with self._lock:
+            return list(self._load()["facilities"].values())
+
+    def results(self, facility_id=None):
+        """
+        保存済みの判定結果を返す（facility_id 指定時はその施設のみ）
+        """
+        with self._lock:
+            results = self._load()["results"]
+            if results is None or facility_id is None:
+                return results
+            entry = results["facilities"].get(str(facility_id))
+            if entry is None:
+                return None
+            advice_keys = {g.get("advice_key") for g in (entry.get("age_groups") or {}).values()}
+            return {
+                **{k: v for k, v in results.items() if k not in ("facilities", "advice")},
+                "facilities": {str(facility_id): entry},
+                "advice": {k: v for k, v in results["advice"].items() if k in advice_keys},
+            }
+
+    def evaluate(self, snapshot, force=False):
+        """
+        スナップショットで全施設を判定し直して保存する
+        既に同じ観測時刻で判定済みなら何もしない（force=True で強制）
+        判定した場合は True
+        """
+        with self._evaluate_lock:
+            with self._lock:
+                state = self._load()
+                latest = snapshot["latest"].isoformat()
+                previous = state["results"]
+                if not force and previous and previous.get("snapshot_latest") == latest:
+                    return False
+                facilities = list(state["facilities"].values())
+            if not facilities:
+                return False
+            if len(facilities) > self.max_facilities:
+                # 上限を設ける前の保存ファイルなどで超えている場合も、1回の判定は上限の件数までにする
+                print(f"登録施設が上限を超えています（{len(facilities)}件）。先頭の{self.max_facilities}件だけ判定します")
+                facilities = facilities[:self.max_facilities]
+
+            scored = score_roster(facilities, snapshot["data"], include_advice=True)
+            with self._lock:
+                state = self._load()
+                state["results"] = {
+                    "snapshot_latest": latest,
+                    "snapshot_time": format_jst(snapshot["latest"]),
+                    "evaluated_at": format_jst(datetime.now(timezone.utc)),
+                    "facilities": {str(entry["facility_id"]): entry for entry in scored["facilities"]},
+                    "advice": scored["advice"],
+                }
+                self._save()
+            print(f"登録施設 {len(facilities)} 件を再判定しました（観測時刻 {latest}）")
+            return True
+
+
+FACILITY_SCHEDULER = FacilityScheduler()
+
+
+@on_new_snapshot
+def evaluate_registered_facilities(snapshot):
+    """
+    新しいアメダスデータが届いたら登録施設を再判定する
+    """
+    FACILITY_SCHEDULER.evaluate(snapshot)
+
+
+@functions_framework.http
+def facility_schedule(request):
+    """
+    登録施設の管理と判定結果の取得用のHTTPエンドポイント
+    
+    GET    ?facility_id=...        : 保存済みの判定結果を返す（計算は行わない）
+    GET    ?view=alerts            : 直近に送信した危険レベル変化の通知を返す
+    POST   {"facility": {...}}     : 施設を登録（roster_risk と同じ形式。"webhook_url" は
+                                     ALERT_WEBHOOK_ALLOWED_HOSTS のホストへの https のみ）
+    POST   {"action": "tick"}      : 新しいアメダスデータを確認し、届いていれば再判定（定期実行用）
+    DELETE ?facility_id=...        : 施設の登録を解除
+    
+    - 登録と判定結果は FACILITY_STORE_PATH に保存される。既定の一時ディレクトリは
+      インスタンスごとのメモリ上にあるため、登録したインスタンス以外への ?facility_id=... は 404 になり、
+      インスタンスが入れ替わると登録は消える
+      （複数インスタンスで使う場合は FACILITY_STORE_PATH を共有ストレージにするか、最大インスタンス数を1にする）
+    
+    - POST と DELETE は、FACILITY_ADMIN_TOKEN と同じ値を X-Admin-Token ヘッダーで送った場合のみ受け付ける
+      （登録済みの施設IDでの登録や、FACILITY_MAX_REGISTERED 件を超える登録は受け付けず 409 を返す）
+    """
+    start_time = time.time()
+    
+    # CORS対応
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+            'Access-Control-Allow-Headers': f'Content-Type, {FACILITY_ADMIN_HEADER}',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+    
+    try:
+        if request.method == 'GET' and request.args.get('view') == 'alerts':
+            # 直近に送信した危険レベル変化の通知
+            response_payload = {"alerts": ALERT_ENGINE.recent_alerts}
+            return send_json(request, json.dumps(response_payload, ensure_ascii=False), 200, headers)
+        
+        if request.method == 'GET':
+            facility_id = request.args.get('facility_id')
+            results = FACILITY_SCHEDULER.results(facility_id)
+            if results is None:
+                error_resp = {
+                    "error": "判定結果がありません",
+                    "message": "施設が未登録か、まだ判定が行われていません",
+                    "facility_id": facility_id
+                }
+                return (json.dumps(error_resp, ensure_ascii=False), 404, headers)
+            response_payload = {
+                "results": results,
+                "registered_facilities": len(FACILITY_SCHEDULER.facilities())
+            }
+            return send_json(request, json.dumps(response_payload, ensure_ascii=False), 200, headers)
+        
+        if request.method in ('POST', 'DELETE') and not facility_admin_authorized(request):
+            error_resp = {
+                "error": "認証エラー",
+                "message": f"施設の登録・解除には管理用の合言葉（{FACILITY_ADMIN_HEADER} ヘッダー）が必要です"
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 401, headers)
+        
+        if request.method == 'DELETE':
+            facility_id = request.args.get('facility_id')
+            removed = FACILITY_SCHEDULER.unregister(facility_id) if facility_id else False
+            return (json.dumps({"removed": removed, "facility_id": facility_id}, ensure_ascii=False), 200 if removed else 404, headers)
+        
+        if request.method != 'POST':
+            error_resp = {
+                "error": "無効なHTTPメソッド",
+                "message": "GET / POST / DELETE メソッドを使用してください",
+                "method": request.method
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 405, headers)
+        
+        request_json = request.get_json(silent=True) or {}
+        
+        if request_json.get('action') == 'tick':
+            # 定期実行（Cloud Scheduler など）から呼ばれ、新しいデータがあれば再判定する
+            refresh_amedas_snapshot()
+            snapshot = get_amedas_snapshot()
+            evaluated = FACILITY_SCHEDULER.evaluate(snapshot) if snapshot else False
+            results = FACILITY_SCHEDULER.results()
+            response_payload = {
+                "evaluated": evaluated,  # このリクエストで再判定したか
+                "snapshot_time": format_jst(snapshot["latest"]) if snapshot else None,
+                "results_snapshot_time": results["snapshot_time"] if results else None,
+                "processing_time": time.time() - start_time
+            }
+            return (json.dumps(response_payload, ensure_ascii=False), 200, headers)
+        
+        facility = request_json.get('facility')
+        if not isinstance(facility, dict) or not facility.get("headcounts"):
+            error_resp = {
+                "error": "無効なリクエスト",
+                "message": "facility（headcountsを含む施設情報）が必要です"
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        _, error = validate_facility(facility)
+        if error:
+            error_resp = {
+                "error": "無効な施設情報",
+                "message": error,
+                "provided": facility
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        if facility.get("webhook_url") is not None and not webhook_url_allowed(facility["webhook_url"]):
+            error_resp = {
+                "error": "無効なwebhook_url",
+                "message": "webhook_urlは https で、管理者が許可したホスト（ALERT_WEBHOOK_ALLOWED_HOSTS）のみ指定できます",
+                "provided": facility["webhook_url"]
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        if not facility.get("station_id") and (facility.get("lat") is None or facility.get("lng") is None):
+            error_resp = {
+                "error": "無効なリクエスト",
+                "message": "station_id または lat/lng を指定してください"
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+        
+        facility_id, error = FACILITY_SCHEDULER.register(facility)
+        if error:
+            error_resp = {
+                "error": "登録できません",
+                "message": error,
+                "provided": facility.get("id")
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 409, headers)
+        response_payload = {
+            "facility_id": facility_id,
+            "registered_facilities": len(FACILITY_SCHEDULER.facilities()),
+            "message": "登録しました。次のアメダスデータ更新時に、保存先（FACILITY_STORE_PATH）を共有するインスタンスで判定されます"
+        }
+        return (json.dumps(response_payload, ensure_ascii=False), 201, headers)
+        
+    except Exception as e:
+        error_resp = {
+            "error": "内部エラー",
+            "message": str(e),
+            "timestamp": format_jst(datetime.now(timezone.utc)),
+            "processing_time": time.time() - start_time
+        }
+        return (json.dumps(error_resp, ensure_ascii=False), 500, headers)
+
+
+# =============================================================================
+# 【15. しきい値をまたいだ時の通知（アラート）】
+# 新しいアメダスデータが届くたびに前回との差分を取り、値が変わった観測所だけ判定し直します
+# 登録施設の年齢グループで危険レベルが変わったら（例: 警戒 → 厳重警戒）、Webhookで通知します
+# =============================================================================
+ALERT_STATE_PATH = os.environ.get(
+    'ALERT_STATE_PATH',
+    os.path.join(tempfile.gettempdir(), 'kids-heat-risk', 'alert_state.json')
+)
+# 施設ごとの webhook_url に加えて、全ての通知を送る先（カンマ区切り）
+ALERT_WEBHOOK_URLS = [u.strip() for u in os.environ.get('ALERT_WEBHOOK_URLS', '').split(',') if u.strip()]
+# 施設ごとの webhook_url に指定できるホスト（カンマ区切り、https のみ）
+# 登録は認証なしで受け付けるため、ここに無いホストへは送信しない（未設定なら施設ごとの通知先は使えない）
+ALERT_WEBHOOK_ALLOWED_HOSTS = {h.strip().lower() for h in os.environ.get('ALERT_WEBHOOK_ALLOWED_HOSTS', '').split(',') if h.strip()}
+ALERT_MIN_LEVEL = "厳重警戒"      # このレベル以上に上がった時・ここから下がった時に通知する
+ALERT_HYSTERESIS = 0.5            # レベルを下げるにはしきい値よりこの値（℃）以上下回る必要がある
+WEBHOOK_BATCH_SIZE = 50           # 1回の送信にまとめる通知の最大件数
+WEBHOOK_MAX_ATTEMPTS = 3          # 送信の最大試行回数
+WEBHOOK_RETRY_BASE_SECONDS = 0.5  # 再送までの待ち時間（試行ごとに2倍）
+WEBHOOK_TIMEOUT = 5               # 1回の送信の待ち時間（秒）
+
+
+def webhook_url_allowed(url):
+    """
+    施設ごとの webhook_url が送信してよい先か（https で、ALERT_WEBHOOK_ALLOWED_HOSTS のホスト）
+    """
+    from urllib.parse import urlsplit
+    if not isinstance(url, str):
+        return False
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+        parts.port  # 不正なポート番号は ValueError
+    except ValueError:
+        return False
+    return parts.scheme == "https" and host in ALERT_WEBHOOK_ALLOWED_HOSTS and not parts.username
+
+
+def classify_with_hysteresis(wbgt, age_group, previous_index):
+    """
+    前回の危険レベルを考慮して危険レベルの番号を返す
+    上がる時は通常のしきい値、下がる時はしきい値より ALERT_HYSTERESIS 以上下回った時だけ下げる
+    （しきい値付近で値が揺れた時に通知が繰り返されないようにする）
+    """
+    index = classify_wbgt_batch([wbgt], age_group)[0]
+    if index is None or previous_index is None or index >= previous_index:
+        return index
+    bounds = _THRESHOLD_BOUNDS.get(age_group, _THRESHOLD_BOUNDS["2-3"])
+    # レベル current に入るしきい値は bounds[current - 1]
+    current = previous_index
+    while current > index and wbgt < bounds[current - 1] - ALERT_HYSTERESIS:
+        current -= 1
+    return current
+
+
+class WebhookDispatcher:
+    """
+    通知をURLごとにまとめて送信し、失敗したら間隔を空けて再送する
+    """
+
+    def __init__(self, batch_size=WEBHOOK_BATCH_SIZE, max_attempts=WEBHOOK_MAX_ATTEMPTS,
+                 retry_base_seconds=WEBHOOK_RETRY_BASE_SECONDS, timeout=WEBHOOK_TIMEOUT):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.timeout = timeout
+
+    def _post(self, url, body):
+        """
+        1回分を送信する。成功したら True（4xx は再送しても直らないので諦める）
+        """
+        requests = get_requests()
+        for attempt in range(self.max_attempts):
+            try:
+                r = requests.post(url, data=body, timeout=self.timeout,
+                                  headers={'Content-Type': 'application/json; charset=utf-8'})
+                if r.status_code < 400:
+                    return True
+                if r.status_code < 500 and r.status_code != 429:
+                    print(f"Webhook送信エラー（再送しません）: {url} {r.status_code}")
+                    return False
+                print(f"Webhook送信エラー: {url} {r.status_code}（{attempt + 1}回目）")
+            except Exception as e:
+                print(f"Webhook送信エラー: {url} {e}（{attempt + 1}回目）")
+            if attempt + 1 < self.max_attempts:
+                time.sleep(self.retry_base_seconds * (2 ** attempt))
+        return False
+
+    def dispatch(self, alerts_by_url):
+        """
+        {URL: [通知, ...]} を送信し、{URL: 送信できた件数} を返す
+        """
+        delivered = {}
+        for url, alerts in alerts_by_url.items():
+            delivered[url] = 0
+            for i in range(0, len(alerts), self.batch_size):
+                batch = alerts[i:i + self.batch_size]
+                body = json.dumps({"alerts": batch, "count": len(batch)}, ensure_ascii=False).encode('utf-8')
+                if self._post(url, body):
+                    delivered[url] += len(batch)
+        return delivered
+
+
+class AlertEngine:
+    """
+    スナップショットの差分から危険レベルの変化を検出し、通知を作るエンジン
+    
+    状態（ALERT_STATE_PATH に保存）:
+    {"inputs": {観測所ID: [気温, 湿度, 風速, 日射量]}, "levels": {"観測所ID|年齢": レベル番号}}
+    """
+
+    def __init__(self, state_path=ALERT_STATE_PATH, dispatcher=None, scheduler=None):
+        self.state_path = state_path
+        self.dispatcher = dispatcher or WebhookDispatcher()
+        self.scheduler = scheduler
+        self._lock = threading.Lock()
+        self._state = None
+        self.recent_alerts = []   # 直近の通知（確認用、最大100件）
+
+    def _load(self):
+        if self._state is None:
+            try:
+                with open(self.state_path, encoding='utf-8') as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                self._state = {"inputs": {}, "levels": {}}
+        return self._state
+
+    def watched(self, all_data):
+        """
+        登録施設から、監視する (観測所ID, 年齢グループ) と通知先の対応を作る
+        """
+        watches = {}  # (観測所ID, 年齢) → [(施設, 通知先URL一覧)]
+        for facility in (self.scheduler.facilities() if self.scheduler else []):
+            # 1つの施設の登録内容が正しくなくても、他の施設の通知は止めない
+            try:
+                headcounts, error = validate_facility(facility)
+                if error:
+                    print(f"通知の対象外（{facility.get('id') if isinstance(facility, dict) else facility}）: {error}")
+                    continue
+                station = resolve_facility_station(facility, all_data)
+                if station is None:
+                    continue
+                urls = list(ALERT_WEBHOOK_URLS)
+                if facility.get("webhook_url") and webhook_url_allowed(facility["webhook_url"]):
+                    urls.append(facility["webhook_url"])
+                for group in headcounts:
+                    watches.setdefault((station["id"], group), []).append((facility, urls))
+            except Exception as e:
+                print(f"通知の対象の確認でエラー（{facility.get('id') if isinstance(facility, dict) else facility}）: {e}")
+        return watches
+
+    def detect(self, snapshot):
+        """
+        前回との差分を取り、危険レベルが変わった (観測所, 年齢) の通知を {URL: [通知]} で返す
+        """
+        all_data = snapshot["data"]
+        min_index = RISK_LEVELS.index(ALERT_MIN_LEVEL)
+        alerts_by_url = {}
+        with self._lock:
+            state = self._load()
+            watches = self.watched(all_data)
+            changed_stations = set()
+            for station_id in {sid for sid, _ in watches}:
+                sd = all_data.get(station_id)
+                if sd is None:
+                    continue
+                obs = observation_from_station_data(sd)
+                inputs = [obs["temperature"], obs["humidity"], obs["wind_speed"], obs["solar_radiation"]]
+                if state["inputs"].get(station_id) != inputs:
+                    state["inputs"][station_id] = inputs
+                    changed_stations.add(station_id)
+
+            # 値が変わった観測所だけ判定し直す
+            for (station_id, group), targets in watches.items():
+                if station_id not in changed_stations:
+                    continue
+                temp, humidity, wind, solar = state["inputs"][station_id]
+                wbgt = calculate_wbgt(temp, humidity, wind, solar)
+                level_key = f"{station_id}|{group}"
+                previous = state["levels"].get(level_key)
+                current = classify_with_hysteresis(wbgt, group, previous)
+                state["levels"][level_key] = current
+                if previous is None or current is None or current == previous:
+                    continue  # 初回は基準を記録するだけで通知しない
+                if max(previous, current) < min_index:
+                    continue  # 注意レベル以下の変化は通知しない
+                for facility, urls in targets:
+                    alert = {
+                        "facility_id": facility.get("id"),
+                        "facility_name": facility.get("name"),
+                        "station_id": station_id,
+                        "age_group": group,
+                        "from_level": RISK_LEVELS[previous],
+                        "to_level": RISK_LEVELS[current],
+                        "direction": "up" if current > previous else "down",
+                        "wbgt": wbgt,
+                        "snapshot_time": format_jst(snapshot["latest"]),
+                    }
+                    self.recent_alerts = (self.recent_alerts + [alert])[-100:]
+                    for url in urls:
+                        alerts_by_url.setdefault(url, []).append(alert)
+            write_json_atomic(self.state_path, state)
+        return alerts_by_url
+
+    def process(self, snapshot):
+        """
+        新しいスナップショットで変化を検出し、通知を送信する
+        """
+        alerts_by_url = self.detect(snapshot)
+        if alerts_by_url:
+            delivered = self.dispatcher.dispatch(alerts_by_url)
+            print(f"危険レベル変化の通知を送信しました: {delivered}")
+        return alerts_by_url
+
+
+ALERT_ENGINE = AlertEngine(scheduler=FACILITY_SCHEDULER)
+
+
+@on_new_snapshot
+def dispatch_threshold_alerts(snapshot):
+    """
+    新しいアメダスデータが届いたら危険レベルの変化を通知する
+    """
+    ALERT_ENGINE.process(snapshot)
+
+
+# =============================================================================
+# 【16. 暑さ指数の予報API】
+# 今の観測値と気象庁の予報から、1時間ごとの暑さ指数と年齢グループごとの危険レベルの予測を返します
+# （予報は発表ごとに1回だけ取得し、タイムラインは観測所・予報・観測時刻ごとに保存します。【9-0-4】参照）
+# =============================================================================
+@functions_framework.http
+def wbgt_forecast(request):
+    """
+    暑さ指数の予報用のHTTPエンドポイント
+
+    【リクエスト例】
+    GET /wbgt_forecast?station_id=44132&hours=24
+    GET /wbgt_forecast?lat=35.68&lng=139.76
+    """
+    start_time = time.time()
+
+    # CORS対応
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+
+    try:
+        params = dict(request.args)
+        if request.method == 'POST':
+            request_json = request.get_json(silent=True)
+            if isinstance(request_json, dict):
+                params.update(request_json)
+
+        try:
+            hours = int(params.get('hours', FORECAST_HOURS))
+        except (TypeError, ValueError):
+            hours = None
+        if hours is None or not 1 <= hours <= FORECAST_MAX_HOURS:
+            error_resp = {
+                "error": "無効なhours",
+                "message": f"hoursは1〜{FORECAST_MAX_HOURS}の整数で指定してください",
+                "provided": params.get('hours')
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        snapshot = get_amedas_snapshot()
+        if snapshot is None:
+            error_resp = {
+                "error": "気象データを取得できません",
+                "message": "しばらくしてから再度お試しください"
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 503, headers)
+
+        station = resolve_facility_station(params, snapshot["data"])
+        if station is None:
+            error_resp = {
+                "error": "観測所が見つかりません",
+                "message": "station_id、または lat と lng を指定してください",
+                "provided": {k: params.get(k) for k in ("station_id", "lat", "lng")}
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        timeline = build_forecast_timeline(station["id"], snapshot, hours)
+        if timeline is None:
+            error_resp = {
+                "error": "予報データを取得できません",
+                "message": "しばらくしてから再度お試しください",
+                "provided": station["id"]
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 503, headers)
+
+        response_payload = {
+            **timeline,
+            "thresholds": HEAT_RISK_THRESHOLDS,
+            "snapshot": {
+                "time": format_jst(snapshot["latest"]),
+                "data_status": snapshot["status"],
+                "data_age_seconds": snapshot["age_seconds"]
+            },
+            "metadata": {
+                "api_version": "4.3",
+                "timestamp": format_jst(datetime.now(timezone.utc)),
+                "method": "府県予報の最高・最低気温と天気から1時間ごとの気温・湿度・日射量を推定",
+                "total_processing_time": time.time() - start_time
+            }
+        }
+        response_headers = {**headers, 'Cache-Control': f'public, max-age={AMEDAS_REFRESH_SECONDS}'}
+        return send_json(request, json.dumps(response_payload, ensure_ascii=False), 200, response_headers)
+
+    except Exception as e:
+        error_resp = {
+            "error": "内部エラー",
+            "message": str(e),
+            "timestamp": format_jst(datetime.now(timezone.utc)),
+            "processing_time": time.time() - start_time
+        }
+        return (json.dumps(error_resp, ensure_ascii=False), 500, headers)
+
+
+# =============================================================================
+# 【17. 外出できる時間帯の提案API】
+# 「今日は何時なら公園に行けるか」に答えるため、暑さ指数の観測値と予測（【9-0-4】）の並びを
+# 外出したい長さの枠でずらしながら調べ、年齢グループの「警戒」（または「厳重警戒」）の
+# しきい値を超えない時間帯を、涼しい順に提案します
+# （結果は観測所・予報・観測時刻と条件ごとに保存します）
+# =============================================================================
+OUTING_LIMIT_LEVELS = ["警戒", "厳重警戒"]   # この危険レベルに達しない時間帯を探す
+OUTING_DEFAULT_MINUTES = 60                 # 外出の長さの既定値（分）
+OUTING_MAX_MINUTES = 8 * 60
+OUTING_DEFAULT_HOURS = (6, 19)              # 外出を考える時間帯（時）の既定値
+OUTING_MAX_WINDOWS = 3                      # 提案する時間帯の数
+OUTING_CACHE_SIZE = 1024
+
+_outing_plans = {}                          # 条件 → 提案（古い順）
+_outing_plans_lock = threading.Lock()
+
+
+def sliding_window_max(values, window_ends):
+    """
+    各位置 i から window_ends[i]（含まない）までの最大値を、単調なキューで一度に計算する
+    （window_ends は増加していく前提。範囲が空なら None）
+    """
+    maxima = []
+    queue = deque()  # 値が大きい順に並んだ位置
+    right = 0
+    for left, end in enumerate(window_ends):
+        while right < end:
+            while queue and values[queue[-1]] <= values[right]:
+                queue.pop()
+            queue.append(right)
+            right += 1
+        while queue and queue[0] < left:
+            queue.popleft()
+        maxima.append(values[queue[0]] if queue and end > left else None)
+    return maxima
+
+
+def plan_outing_windows(timeline, age_group, duration_minutes, limit_level="警戒",
+                        hours=OUTING_DEFAULT_HOURS, max_windows=OUTING_MAX_WINDOWS):
+    """
+    【機能説明】
+    暑さ指数の並び（観測値＋予測）から、外出しても危険レベルが limit_level に達しない時間帯を探す
+
+    【入力データ】
+    timeline : build_forecast_timeline() の結果
+    age_group : 年齢グループ
+    duration_minutes : 外出したい長さ（分）
+    limit_level : この危険レベルのしきい値を超えない時間帯を探す（"警戒" / "厳重警戒"）
+    hours : (開始時, 終了時) この時間内に収まる時間帯だけを探す
+    max_windows : 提案する時間帯の数（重ならないものを涼しい順に）
+
+    【出力データ】
+    [{"start", "end", "max_wbgt", "avg_wbgt", "max_risk_level", "peak_temperature",
+      "child_feels_like_min", "child_feels_like_max", "ground_temperature_normal", "ground_temperature_asphalt"}, ...]
+    """
+    threshold = HEAT_RISK_THRESHOLDS[age_group][limit_level]
+    entries = [h for h in timeline["hours"] if h["wbgt"] is not None]
+    if not entries:
+        return []
+    moments = [datetime.fromisoformat(h["timestamp"]) for h in entries]
+    wbgts = [h["wbgt"] for h in entries]
+    temps = [h["temperature"] for h in entries]
+    duration = timedelta(minutes=duration_minutes)
+
+    # ステップ1: 各時刻から外出した場合に含まれる範囲（開始時刻〜開始時刻＋外出の長さ）の終わりの位置
+    window_ends = []
+    end = 0
+    for start in moments:
+        while end < len(moments) and moments[end] <= start + duration:
+            end += 1
+        window_ends.append(end)
+
+    # ステップ2: 範囲ごとの最高の暑さ指数・気温をまとめて計算
+    max_wbgts = sliding_window_max(wbgts, window_ends)
+    max_temps = sliding_window_max(temps, window_ends)
+    prefix = [0.0]
+    for w in wbgts:
+        prefix.append(prefix[-1] + w)
+
+    # ステップ3: しきい値を超えず、時間内に収まり、予測の範囲内で終わる時間帯を候補にする
+    candidates = []
+    first_hour, last_hour = hours
+    for i, start in enumerate(moments):
+        finish = start + duration
+        if finish > moments[-1] or max_wbgts[i] is None or max_wbgts[i] >= threshold:
+            continue
+        if start.date() != finish.date() or start.hour < first_hour or (finish.hour, finish.minute) > (last_hour, 0):
+            continue
+        candidates.append((max_wbgts[i], start, i))
+
+    # ステップ4: 涼しい順（同じなら早い順）に、重ならない時間帯を選ぶ
+    windows = []
+    for max_wbgt, start, i in sorted(candidates, key=lambda c: (c[0], c[1])):
+        finish = start + duration
+        if any(start < w["_end"] and w["_start"] < finish for w in windows):
+            continue
+        count = window_ends[i] - i
+        child_min, child_max, ground_normal, ground_asphalt, _ = calculate_child_temperatures(max_temps[i], age_group)
+        windows.append({
+            "_start": start, "_end": finish,
+            "start": format_jst(start),
+            "end": format_jst(finish),
+            "start_timestamp": start.isoformat(),
+            "end_timestamp": finish.isoformat(),
+            "max_wbgt": max_wbgt,
+            "avg_wbgt": round((prefix[window_ends[i]] - prefix[i]) / count, 1),
+            "max_risk_level": classify_wbgt(max_wbgt, age_group),
+            "peak_temperature": max_temps[i],
+            "child_feels_like_min": child_min,
+            "child_feels_like_max": child_max,
+            "ground_temperature_normal": ground_normal,
+            "ground_temperature_asphalt": ground_asphalt,
+        })
+        if len(windows) >= max_windows:
+            break
+    for w in windows:
+        del w["_start"], w["_end"]
+    return windows
+
+
+def get_outing_plan(timeline, age_group, duration_minutes, limit_level, hours):
+    """
+    plan_outing_windows の結果を、観測所・予報・観測時刻と条件ごとに保存して使い回す
+    """
+    cache_key = (timeline["station_id"], timeline["report_time"], timeline["observation_time"],
+                 len(timeline["hours"]), age_group, duration_minutes, limit_level, hours)
+    plan = _outing_plans.get(cache_key)
+    if plan is None:
+        plan = plan_outing_windows(timeline, age_group, duration_minutes, limit_level, hours)
+        with _outing_plans_lock:
+            _outing_plans[cache_key] = plan
+            while len(_outing_plans) > OUTING_CACHE_SIZE:
+                del _outing_plans[next(iter(_outing_plans))]
+    return plan
+
+
+@functions_framework.http
+def outing_windows(request):
+    """
+    外出できる時間帯の提案用のHTTPエンドポイント
+
+    【リクエスト例】
+    GET /outing_windows?station_id=44132&age_group=2-3&duration_minutes=60
+    GET /outing_windows?lat=35.68&lng=139.76&age_group=0-1&duration_minutes=90&limit_level=厳重警戒&from_hour=7&to_hour=18
+    """
+    start_time = time.time()
+
+    # CORS対応
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+
+    try:
+        params = dict(request.args)
+        if request.method == 'POST':
+            request_json = request.get_json(silent=True)
+            if isinstance(request_json, dict):
+                params.update(request_json)
+
+        # 年齢グループの検証
+        age_group = params.get('age_group', '2-3')
+        valid_age_groups = ["0-1", "2-3", "4-6"]
+        if age_group not in valid_age_groups:
+            error_resp = {
+                "error": "無効な年齢グループ",
+                "message": f"age_groupは {valid_age_groups} のいずれかを指定してください",
+                "provided": age_group
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        # 外出の長さの検証
+        try:
+            duration_minutes = int(params.get('duration_minutes', OUTING_DEFAULT_MINUTES))
+        except (TypeError, ValueError):
+            duration_minutes = None
+        if duration_minutes is None or not 10 <= duration_minutes <= OUTING_MAX_MINUTES:
+            error_resp = {
+                "error": "無効なduration_minutes",
+                "message": f"duration_minutesは10〜{OUTING_MAX_MINUTES}の整数（分）で指定してください",
+                "provided": params.get('duration_minutes')
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        # 基準の危険レベルの検証
+        limit_level = params.get('limit_level', OUTING_LIMIT_LEVELS[0])
+        if limit_level not in OUTING_LIMIT_LEVELS:
+            error_resp = {
+                "error": "無効なlimit_level",
+                "message": f"limit_levelは {OUTING_LIMIT_LEVELS} のいずれかを指定してください",
+                "provided": limit_level
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        # 時間帯の検証
+        try:
+            hours = (int(params.get('from_hour', OUTING_DEFAULT_HOURS[0])), int(params.get('to_hour', OUTING_DEFAULT_HOURS[1])))
+        except (TypeError, ValueError):
+            hours = None
+        if hours is None or not 0 <= hours[0] < hours[1] <= 24:
+            error_resp = {
+                "error": "無効な時間帯",
+                "message": "from_hour と to_hour は 0〜24 の整数で、from_hour < to_hour となるように指定してください",
+                "provided": {"from_hour": params.get('from_hour'), "to_hour": params.get('to_hour')}
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        snapshot = get_amedas_snapshot()
+        if snapshot is None:
+            error_resp = {
+                "error": "気象データを取得できません",
+                "message": "しばらくしてから再度お試しください"
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 503, headers)
+
+        station = resolve_facility_station(params, snapshot["data"])
+        if station is None:
+            error_resp = {
+                "error": "観測所が見つかりません",
+                "message": "station_id、または lat と lng を指定してください",
+                "provided": {k: params.get(k) for k in ("station_id", "lat", "lng")}
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 400, headers)
+
+        timeline = build_forecast_timeline(station["id"], snapshot, FORECAST_HOURS)
+        if timeline is None:
+            error_resp = {
+                "error": "予報データを取得できません",
+                "message": "しばらくしてから再度お試しください",
+                "provided": station["id"]
+            }
+            return (json.dumps(error_resp, ensure_ascii=False), 503, headers)
+
+        windows = get_outing_plan(timeline, age_group, duration_minutes, limit_level, hours)
+        response_payload = {
+            "station_id": timeline["station_id"],
+            "station": timeline["station"],
+            "age_group": age_group,
+            "duration_minutes": duration_minutes,
+            "limit_level": limit_level,
+            "threshold_wbgt": HEAT_RISK_THRESHOLDS[age_group][limit_level],
+            "hours": {"from": hours[0], "to": hours[1]},
+            "windows": windows,
+            "message": (
+                f"{windows[0]['start'][11:16]}〜{windows[0]['end'][11:16]}が最も涼しい時間帯です"
+                if windows else f"{limit_level}に達しない時間帯が見つかりません。屋内で過ごしましょう"
+            ),
+            "forecast_point": timeline["forecast_point"],
+            "report_time": timeline["report_time"],
+            "observation_time": timeline["observation_time"],
+            "metadata": {
+                "api_version": "4.3",
+                "timestamp": format_jst(datetime.now(timezone.utc)),
+                "total_processing_time": time.time() - start_time
+            }
+        }
+        response_headers = {**headers, 'Cache-Control': f'public, max-age={AMEDAS_REFRESH_SECONDS}'}
+        return send_json(request, json.dumps(response_payload, ensure_ascii=False), 200, response_headers)
+
+    except Exception as e:
+        error_resp = {
+            "error": "内部エラー",
+            "message": str(e),
+            "timestamp": format_jst(datetime.now(timezone.utc)),
+            "processing_time": time.time() - start_time
+        }
+        return (json.dumps(error_resp, ensure_ascii=False), 500, headers)
+
+
+# =============================================================================
+# 【18. 起動時間の記録とウォームアップ】
+# モジュールの読み込み時間を記録し、必要ならバックグラウンドで準備を始める
+# =============================================================================
+STARTUP_PROFILE["module_import"] = round(time.perf_counter() - _MODULE_IMPORT_STARTED, 4)
+
+if WARMUP_ON_START:
+    threading.Thread(target=warmup, daemon=True).start()
+
+
+# =============================================================================
+# 【19. ローカルテスト用のコード】
 # 開発者がローカル環境でテストする際に使用するコード
 # =============================================================================
 if __name__ == "__main__":
@@ -1679,10 +4774,11 @@ if __name__ == "__main__":
     functions_framework.testing.run_function_with_test_client(heat_risk)
 
 # =============================================================================
-# 【14. 必要なライブラリ一覧】
+# 【20. 必要なライブラリ一覧】
 # このプログラムを動かすために必要なPythonライブラリのバージョン指定
 # requirements.txt ファイルに記載する内容:
 # =============================================================================
 # functions-framework>=3.0.0  # Google Cloud Functions用
 # requests>=2.28.0             # HTTP通信用
 # google-generativeai>=0.3.0   # Google AI用
+# Brotli>=1.0.9                # レスポンス圧縮（brotli）用
@@ -0,0 +1,254 @@
+# =============================================================================
+# 【リクエスト単位のプロファイラー】
+# 特定のリクエストが遅い時に、関数の中のどこで時間がかかったか（気象庁との通信・JSONの変換・
+# プロンプトの作成・AI処理の待ち時間など）を調べるための仕組みです
+#
+# - 次のどちらかの場合だけ、そのリクエストを処理しているスレッドの呼び出し履歴を一定間隔で記録する
+#     ・X-Profile ヘッダーの値が環境変数 PROFILE_TOKEN と一致する（PROFILE_TOKEN を設定した時のみ）
+#     ・環境変数 PROFILE_SAMPLE_RATE（0〜1）の割合で抽選に当たった
+# - Gemini の共有スレッドプールで動くAI処理も、そのリクエストの分だけ一緒に記録する
+# - 結果は collapsed-stack 形式（flamegraph.pl / speedscope で表示）か speedscope 形式で書き出す
+# - PROFILE_TOKEN も PROFILE_SAMPLE_RATE も設定しなければ、関数は包まれず処理は一切増えない
+#
+# 環境変数:
+#   PROFILE_TOKEN        … X-Profile ヘッダーで指定する合言葉（未設定ならヘッダーでは有効にならない）
+#   PROFILE_SAMPLE_RATE  … 抽選で記録する割合（既定 0）
+#   PROFILE_INTERVAL_MS  … 呼び出し履歴を記録する間隔（ミリ秒、既定 5）
+#   PROFILE_FORMAT       … "collapsed"（既定）または "speedscope"
+#   PROFILE_DIR          … 書き出し先のディレクトリ。"log" ならログに出力（Cloud Functions ではこちら）
+#
+# 使い方:
+#   PROFILE_TOKEN=secret functions-framework --target heat_risk
+#   curl -H "X-Profile: secret" "http://localhost:8080/?age_group=2-3"   # 応答の X-Profile-File に保存先
+# =============================================================================
+import functools
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_FORMAT = os.environ.get('PROFILE_FORMAT', 'collapsed')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'profiles'))
+PROFILING_ENABLED = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+_active = {}  # 記録中のスレッドID → StackSampler
+_active_lock = threading.Lock()
+
+
+class StackSampler:
+    """
+    指定したスレッドの呼び出し履歴を一定間隔で記録する（実時間で記録するため、通信や待ち時間も含まれる）
+    """
+
+    def __init__(self, name, interval=PROFILE_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.counts = {}          # (スレッド名, 呼び出し履歴) → 記録した時間（秒）
+        self.samples = 0
+        self.duration = None
+        self._threads = {}        # スレッドID → スレッド名
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def attach(self, thread_name=None):
+        """
+        今のスレッドを記録の対象に加える
+        """
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = thread_name or threading.current_thread().name
+        with _active_lock:
+            _active[ident] = self
+
+    def detach(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads.pop(ident, None)
+        with _active_lock:
+            if _active.get(ident) is self:
+                del _active[ident]
+
+    def start(self):
+        self._started = time.perf_counter()
+        self.attach("request")
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.detach()
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self._threads.items())
+            for ident, thread_name in threads:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                key = (thread_name, tuple(reversed(stack)))
+                with self._lock:
+                    self.counts[key] = self.counts.get(key, 0.0) + elapsed
+                    self.samples += 1
+
+    @staticmethod
+    def _label(frame):
+        name, filename, line = frame
+        return f"{name} ({filename}:{line})"
+
+    def collapsed(self):
+        """
+        collapsed-stack 形式（1行ごとに "スレッド;呼び出し元;...;呼び出し先 マイクロ秒"）
+        """
+        lines = []
+        for (thread_name, stack), seconds in sorted(self.counts.items(), key=lambda item: -item[1]):
+            path = ";".join([thread_name] + [self._label(frame).replace(";", ",") for frame in stack])
+            lines.append(f"{path} {max(1, round(seconds * 1e6))}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self):
+        """
+        speedscope 形式（スレッドごとに1つのプロファイル）
+        """
+        frames, index = [], {}
+        profiles = {}
+        for (thread_name, stack), seconds in self.counts.items():
+            sample = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                sample.append(index[frame])
+            profile = profiles.setdefault(thread_name, {"samples": [], "weights": []})
+            profile["samples"].append(sample)
+            profile["weights"].append(seconds)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "kids-heat-risk request_profiler",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled", "name": thread_name, "unit": "seconds",
+                    "startValue": 0, "endValue": sum(p["weights"]),
+                    "samples": p["samples"], "weights": p["weights"],
+                }
+                for thread_name, p in profiles.items()
+            ],
+        }
+
+    def write(self, output_dir=PROFILE_DIR, output_format=PROFILE_FORMAT):
+        """
+        結果を書き出し、保存先のファイル名（ログに出力した場合は "log"）を返す
+        """
+        if output_format == "speedscope":
+            body, extension = json.dumps(self.speedscope(), ensure_ascii=False), "speedscope.json"
+        else:
+            body, extension = self.collapsed(), "collapsed.txt"
+        summary = f"{self.name}: {self.duration:.3f}秒 / {self.samples}サンプル"
+        if output_dir == "log":
+            print(f"🔬 プロファイル（{summary}）\n{body}")
+            return "log"
+        os.makedirs(output_dir, exist_ok=True)
+        filename = f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.{extension}"
+        with open(os.path.join(output_dir, filename), "w", encoding="utf-8") as f:
+            f.write(body)
+        print(f"🔬 プロファイルを保存しました（{summary}）: {os.path.join(output_dir, filename)}")
+        return filename
+
+
+def current_sampler():
+    """
+    今のスレッドを記録中の StackSampler（記録していなければ None）
+    """
+    if not _active:
+        return None
+    return _active.get(threading.get_ident())
+
+
+def propagate(fn, thread_name=None):
+    """
+    別スレッドで実行する処理（fn）を、呼び出し元と同じプロファイルに含める
+    記録中でなければ fn をそのまま返す
+    """
+    sampler = current_sampler()
+    if sampler is None:
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        sampler.attach(thread_name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sampler.detach()
+    return run
+
+
+def should_profile(request):
+    """
+    このリクエストを記録するかどうか（合言葉のヘッダー、または抽選）
+    """
+    if PROFILE_TOKEN:
+        provided = request.headers.get(PROFILE_HEADER)
+        if provided and hmac.compare_digest(provided, PROFILE_TOKEN):
+            return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def profile_request(handler):
+    """
+    【機能説明】
+    HTTP関数を包み、対象のリクエストだけ呼び出し履歴を記録する
+    記録した場合は、応答ヘッダー X-Profile-File に保存先のファイル名を付ける
+    （ブラウザから使えるよう、heat_risk のプリフライトで X-Profile を許可し、X-Profile-File を公開する）
+
+    プロファイラーが無効（PROFILE_TOKEN・PROFILE_SAMPLE_RATE とも未設定）なら、handler をそのまま返す
+    """
+    if not PROFILING_ENABLED:
+        return handler
+
+    @functools.wraps(handler)
+    def wrapper(request):
+        if not should_profile(request):
+            return handler(request)
+        sampler = StackSampler(handler.__name__).start()
+        try:
+            result = handler(request)
+        finally:
+            sampler.stop()
+        try:
+            filename = sampler.write()
+        except OSError as e:
+            print(f"プロファイルの書き出しに失敗: {e}")
+            return result
+        if isinstance(result, tuple) and len(result) == 3 and isinstance(result[2], dict):
+            headers = {**result[2], 'X-Profile-File': filename}
+            # ブラウザの JavaScript からも読めるようにする（ETag など既存の指定に追加）
+            exposed = [h.strip() for h in headers.get('Access-Control-Expose-Headers', '').split(',') if h.strip()]
+            headers['Access-Control-Expose-Headers'] = ', '.join(exposed + ['X-Profile-File'])
+            result = (result[0], result[1], headers)
+        return result
+    return wrapper
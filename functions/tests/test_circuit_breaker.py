@@ -0,0 +1,63 @@
+# =============================================================================
+# 【AIサーキットブレーカー（AICircuitBreaker）のテスト】
+# half_open の時に、試行（プローブ）の結果だけで回復を判定することを確認します
+#
+# 使い方:
+#   cd functions
+#   python -m pytest tests/
+# =============================================================================
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+def tripped_breaker():
+    """
+    クールダウン0秒で作動済みのブレーカーと、作動前に受け付けた呼び出しのトークンを返す
+    """
+    breaker = main.AICircuitBreaker(min_calls=2, failure_rate=0.5, cooldown_seconds=0)
+    late = breaker.allow_request()
+    for _ in range(2):
+        breaker.record("error", breaker.allow_request())
+    assert breaker.snapshot()["trip_count"] == 1
+    return breaker, late
+
+
+def test_late_pre_trip_success_does_not_close():
+    breaker, late = tripped_breaker()
+    probe = breaker.allow_request()
+    assert probe is not None
+    assert breaker.allow_request() is None  # 試行は同時に1件だけ
+
+    breaker.record("success", late)
+    assert breaker._state == "half_open"
+    assert breaker.allow_request() is None
+
+    breaker.record("success", probe)
+    assert breaker._state == "closed"
+
+
+def test_probe_failure_reopens():
+    breaker, _ = tripped_breaker()
+    breaker.record("timeout", breaker.allow_request())
+    assert breaker._state == "open"
+    assert breaker.snapshot()["trip_count"] == 2
+
+
+def test_cancel_returns_probe_slot():
+    breaker, late = tripped_breaker()
+    probe = breaker.allow_request()
+    breaker.cancel(late)
+    assert breaker.allow_request() is None
+    breaker.cancel(probe)
+    assert breaker.allow_request() is not None
+
+
+def test_record_without_token_is_ignored():
+    breaker = main.AICircuitBreaker(min_calls=1, failure_rate=0.5)
+    breaker.record("error", None)
+    assert breaker.snapshot()["recent_calls"] == 0
+    assert breaker._state == "closed"
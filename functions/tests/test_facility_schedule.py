@@ -0,0 +1,80 @@
+# =============================================================================
+# 【登録施設の管理（facility_schedule / FacilityScheduler）のテスト】
+# 登録・解除に管理用の合言葉が必要なことと、登録済みの施設を上書きしないことを確認します
+#
+# 使い方:
+#   cd functions
+#   python -m pytest tests/
+# =============================================================================
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+class FakeRequest:
+    """
+    facility_schedule が使う分だけの HTTP リクエスト
+    """
+
+    def __init__(self, method, args=None, json_body=None, headers=None):
+        self.method = method
+        self.args = args or {}
+        self.headers = headers or {}
+        self._json = json_body
+
+    def get_json(self, silent=False):
+        return self._json
+
+
+ADMIN = {main.FACILITY_ADMIN_HEADER: "secret"}
+FACILITY = {"id": "A園", "station_id": "44132", "headcounts": {"2-3": 8}}
+
+
+@pytest.fixture
+def scheduler(monkeypatch, tmp_path):
+    scheduler = main.FacilityScheduler(store_path=str(tmp_path / "facilities.json"))
+    monkeypatch.setattr(main, "FACILITY_SCHEDULER", scheduler)
+    monkeypatch.setattr(main, "FACILITY_ADMIN_TOKEN", "secret")
+    return scheduler
+
+
+def call(method, headers=None, **kwargs):
+    body, status, _ = main.facility_schedule(FakeRequest(method, headers=headers, **kwargs))
+    return status, json.loads(body)
+
+
+def test_post_and_delete_require_admin_token(scheduler):
+    assert call("POST", json_body={"facility": FACILITY})[0] == 401
+    assert call("POST", headers={main.FACILITY_ADMIN_HEADER: "wrong"}, json_body={"facility": FACILITY})[0] == 401
+    assert call("POST", headers=ADMIN, json_body={"facility": FACILITY})[0] == 201
+    assert call("DELETE", args={"facility_id": "A園"})[0] == 401
+    assert call("DELETE", headers=ADMIN, args={"facility_id": "A園"})[0] == 200
+
+
+def test_admin_token_unset_refuses_changes(scheduler, monkeypatch):
+    monkeypatch.setattr(main, "FACILITY_ADMIN_TOKEN", None)
+    assert call("POST", headers=ADMIN, json_body={"facility": FACILITY})[0] == 401
+    assert scheduler.facilities() == []
+
+
+def test_existing_facility_is_not_overwritten(scheduler):
+    assert call("POST", headers=ADMIN, json_body={"facility": FACILITY})[0] == 201
+    hijack = {**FACILITY, "headcounts": {"4-6": 1}}
+    status, body = call("POST", headers=ADMIN, json_body={"facility": hijack})
+    assert status == 409
+    assert body["provided"] == "A園"
+    assert scheduler.facilities()[0]["headcounts"] == {"2-3": 8}
+
+
+def test_registrations_beyond_limit_are_refused(scheduler):
+    scheduler.max_facilities = 2
+    for name in ("A園", "B園"):
+        assert call("POST", headers=ADMIN, json_body={"facility": {**FACILITY, "id": name}})[0] == 201
+    assert call("POST", headers=ADMIN, json_body={"facility": {**FACILITY, "id": "C園"}})[0] == 409
+    assert len(scheduler.facilities()) == 2
@@ -0,0 +1,170 @@
+# =============================================================================
+# 【危険レベル変化の通知（WebhookDispatcher / AlertEngine）のテスト】
+# 手元で http.server の受け口を立て、まとめ送信と 5xx の時の再送を確認します
+# しきい値をまたいだ時の通知と、しきい値付近の揺れ（不感帯）で通知しないことも確認します
+#
+# 使い方:
+#   cd functions
+#   python -m pytest tests/
+# =============================================================================
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+class WebhookSink:
+    """
+    受け取った通知を記録する HTTP サーバー（最初の fail_first 回は 503 を返す）
+    """
+
+    def __init__(self, fail_first=0, status=503):
+        self.received = []        # 受け取った本文（JSON）
+        self.responses = []       # 返したステータスコード
+        self.fail_first = fail_first
+        self.status = status
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                sink.received.append(json.loads(body))
+                status = sink.status if len(sink.responses) < sink.fail_first else 200
+                sink.responses.append(status)
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/hook"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_alerts(count):
+    return [{"facility_id": f"F{i}", "age_group": "2-3", "from_level": "警戒", "to_level": "厳重警戒"} for i in range(count)]
+
+
+def test_dispatch_batches_alerts():
+    dispatcher = main.WebhookDispatcher(batch_size=50, retry_base_seconds=0)
+    with WebhookSink() as sink:
+        delivered = dispatcher.dispatch({sink.url: make_alerts(120)})
+    assert delivered == {sink.url: 120}
+    assert [body["count"] for body in sink.received] == [50, 50, 20]
+    assert [len(body["alerts"]) for body in sink.received] == [50, 50, 20]
+    assert sink.received[2]["alerts"][-1]["facility_id"] == "F119"
+
+
+def test_dispatch_retries_on_5xx():
+    dispatcher = main.WebhookDispatcher(batch_size=50, max_attempts=3, retry_base_seconds=0)
+    with WebhookSink(fail_first=2) as sink:
+        delivered = dispatcher.dispatch({sink.url: make_alerts(10)})
+    assert delivered == {sink.url: 10}
+    assert sink.responses == [503, 503, 200]
+    assert sink.received[0] == sink.received[2]  # 同じ内容を再送する
+
+
+def test_dispatch_gives_up_after_max_attempts():
+    dispatcher = main.WebhookDispatcher(max_attempts=3, retry_base_seconds=0)
+    with WebhookSink(fail_first=10) as sink:
+        delivered = dispatcher.dispatch({sink.url: make_alerts(5)})
+    assert delivered == {sink.url: 0}
+    assert sink.responses == [503, 503, 503]
+
+
+def test_dispatch_does_not_retry_4xx():
+    dispatcher = main.WebhookDispatcher(max_attempts=3, retry_base_seconds=0)
+    with WebhookSink(fail_first=10, status=400) as sink:
+        delivered = dispatcher.dispatch({sink.url: make_alerts(5)})
+    assert delivered == {sink.url: 0}
+    assert sink.responses == [400]
+
+
+class StaticScheduler:
+    def __init__(self, facilities):
+        self._facilities = facilities
+
+    def facilities(self):
+        return list(self._facilities)
+
+
+def test_watched_skips_malformed_facilities():
+    all_data = {"44132": {"temp": [30.0, 0], "humidity": [70, 0]}}
+    scheduler = StaticScheduler([
+        {"id": "bad-count", "station_id": "44132", "headcounts": {"2-3": "x"}},
+        {"id": "bad-list", "station_id": "44132", "headcounts": [3]},
+        {"id": "ok", "station_id": "44132", "headcounts": {"0-1": 2, "4-6": 0},
+         "webhook_url": "http://169.254.169.254/latest"},
+    ])
+    engine = main.AlertEngine(state_path=os.devnull, scheduler=scheduler)
+    watches = engine.watched(all_data)
+    assert list(watches) == [("44132", "0-1")]
+    facility, urls = watches[("44132", "0-1")][0]
+    assert facility["id"] == "ok"
+    assert "http://169.254.169.254/latest" not in urls  # 許可されていない通知先には送らない
+
+
+def test_webhook_url_allowed(monkeypatch):
+    monkeypatch.setattr(main, "ALERT_WEBHOOK_ALLOWED_HOSTS", {"hooks.example.com"})
+    assert main.webhook_url_allowed("https://hooks.example.com/alerts")
+    assert not main.webhook_url_allowed("http://hooks.example.com/alerts")
+    assert not main.webhook_url_allowed("https://evil.example.com/alerts")
+    assert not main.webhook_url_allowed("https://user@hooks.example.com/alerts")
+    assert not main.webhook_url_allowed(["https://hooks.example.com/alerts"])
+
+
+def test_classify_with_hysteresis_rises_at_threshold():
+    bound = main._THRESHOLD_BOUNDS["2-3"][2]        # 厳重警戒に入るしきい値
+    keikai = main.RISK_LEVELS.index("警戒")
+    assert main.classify_with_hysteresis(bound - 0.1, "2-3", keikai) == keikai
+    assert main.classify_with_hysteresis(bound, "2-3", keikai) == keikai + 1
+
+
+def test_classify_with_hysteresis_falls_below_dead_band():
+    bound = main._THRESHOLD_BOUNDS["2-3"][2]
+    genju = main.RISK_LEVELS.index("厳重警戒")
+    # しきい値を下回っても、ALERT_HYSTERESIS の幅の中ではレベルを下げない
+    assert main.classify_with_hysteresis(bound - 0.1, "2-3", genju) == genju
+    assert main.classify_with_hysteresis(bound - main.ALERT_HYSTERESIS, "2-3", genju) == genju
+    assert main.classify_with_hysteresis(bound - main.ALERT_HYSTERESIS - 0.1, "2-3", genju) == genju - 1
+    # 前回の記録が無い時はしきい値どおり
+    assert main.classify_with_hysteresis(bound - 0.1, "2-3", None) == genju - 1
+
+
+def test_alert_engine_notifies_on_crossings_only(monkeypatch, tmp_path):
+    # 気温をそのまま暑さ指数として扱い、しきい値の前後の値を順に与える
+    monkeypatch.setattr(main, "calculate_wbgt", lambda temp, humidity, wind, solar: temp)
+    monkeypatch.setattr(main, "ALERT_WEBHOOK_URLS", ["https://hooks.example.com/alerts"])
+    bound = main._THRESHOLD_BOUNDS["2-3"][2]
+    scheduler = StaticScheduler([{"id": "A園", "station_id": "44132", "headcounts": {"2-3": 5}}])
+    engine = main.AlertEngine(state_path=str(tmp_path / "alerts.json"), scheduler=scheduler)
+
+    def step(wbgt):
+        snapshot = {"data": {"44132": {"temp": [wbgt, 0], "humidity": [70, 0]}},
+                    "latest": datetime(2026, 8, 1, tzinfo=timezone.utc)}
+        alerts = engine.detect(snapshot).get("https://hooks.example.com/alerts", [])
+        return [(a["from_level"], a["to_level"], a["direction"]) for a in alerts]
+
+    assert step(bound - 1.0) == []                                # 初回は基準を記録するだけ
+    assert step(bound + 0.1) == [("警戒", "厳重警戒", "up")]
+    assert step(bound - 0.3) == []                                # 不感帯の中
+    assert step(bound + 0.2) == []                                # 同じレベルのまま
+    assert step(bound - main.ALERT_HYSTERESIS - 0.2) == [("厳重警戒", "警戒", "down")]
+    assert step(bound - 0.1) == []                                # しきい値未満なので上がらない
+    assert step(bound) == [("警戒", "厳重警戒", "up")]
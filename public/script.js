@@ -556,6 +556,13 @@ let afterImageData = null;     // 帰宅後の画像データ
 let beforeTimestamp = null;    // 外出前の撮影時刻
 let afterTimestamp = null;     // 帰宅後の撮影時刻
 
+// 送信前の画像縮小の設定
+// スマートフォンの写真（3〜8MB）をそのまま送ると通信とサーバーのメモリを圧迫するため、
+// 長い辺がこの大きさを超える画像は縮小し、JPEGで保存し直してから送信します
+const IMAGE_MAX_DIMENSION = 1280;   // 長い辺の最大ピクセル数
+const IMAGE_JPEG_QUALITY = 0.8;     // JPEGの画質（0〜1）
+const imageSelectionIds = { before: 0, after: 0 };  // 選び直した時に古い処理結果を捨てるための番号
+
 // 年齢グループ選択の視覚的フィードバック
 // 年齢グループを選択した時の見た目を変更します
 document.querySelectorAll('input[name="ageGroup"]').forEach(radio => {
@@ -620,26 +627,33 @@ if (removeImage) {
 }
 
 // ファイル選択処理
-// ユーザーが選択した画像ファイルを処理します
+// ユーザーが選択した画像ファイルを縮小してから保存します
 function handleFileSelect(event, type) {
 const file = event.target.files[0];
 if (file && file.type.startsWith('image/')) {
-    const reader = new FileReader();
-    reader.onload = function(e) {
-    const imageDataUrl = e.target.result;
+    const selectionId = ++imageSelectionIds[type];
+    downscaleImage(file).then(({ dataUrl, width, height }) => {
+    // 処理中に別の画像が選ばれた場合は、この結果を使わない
+    if (selectionId !== imageSelectionIds[type]) {
+        return;
+    }
     const timestamp = new Date();
     
     // 画像データとタイムスタンプを保存
     if (type === 'before') {
-        beforeImageData = imageDataUrl;
+        beforeImageData = dataUrl;
         beforeTimestamp = timestamp;
     } else {
-        afterImageData = imageDataUrl;
+        afterImageData = dataUrl;
         afterTimestamp = timestamp;
     }
     
-    // プレビューを表示
-    showImagePreview(imageDataUrl, `${type === 'before' ? '外出前' : '帰宅後'}の選択画像: ${file.name}`, type);
+    // プレビューを表示（縮小した場合は縮小後の大きさも表示）
+    let info = `${type === 'before' ? '外出前' : '帰宅後'}の選択画像: ${file.name}`;
+    if (width && height) {
+        info += `（${width}×${height}・${formatDataSize(file.size)} → ${formatDataSize(dataUrlByteLength(dataUrl))}）`;
+    }
+    showImagePreview(dataUrl, info, type);
     
     // ステータス更新
     updateImageStatus(type);
@@ -648,13 +662,101 @@ if (file && file.type.startsWith('image/')) {
     if (beforeImageData && afterImageData) {
         showImageComparison();
     }
-    };
-    reader.readAsDataURL(file);
+    }).catch(error => {
+    console.error('画像の読み込みに失敗しました:', error);
+    alert('画像を読み込めませんでした。別の画像を選択してください。');
+    });
 } else {
     alert('画像ファイルを選択してください。');
 }
 }
 
+// 画像の縮小
+// 長い辺が maxDimension を超える画像を縮小し、JPEGのデータURLにします
+// 縮小が不要なJPEGや、ブラウザが画像を読み込めない場合（HEICなど）は元のファイルのまま返します
+// 戻り値: { dataUrl, width, height }（縮小しなかった場合 width・height は null）
+async function downscaleImage(file, maxDimension = IMAGE_MAX_DIMENSION, quality = IMAGE_JPEG_QUALITY) {
+let image;
+try {
+    image = await decodeImage(file);
+} catch (error) {
+    console.warn('画像を縮小できないため、元の画像を使います:', error);
+    return { dataUrl: await readFileAsDataUrl(file), width: null, height: null };
+}
+
+try {
+    const scale = Math.min(1, maxDimension / Math.max(image.width, image.height));
+    if (scale === 1 && file.type === 'image/jpeg') {
+    return { dataUrl: await readFileAsDataUrl(file), width: null, height: null };
+    }
+    const width = Math.round(image.width * scale);
+    const height = Math.round(image.height * scale);
+
+    // OffscreenCanvas が使えるブラウザでは画面に描画せずに変換する
+    const useOffscreen = typeof OffscreenCanvas !== 'undefined' && typeof OffscreenCanvas.prototype.convertToBlob === 'function';
+    const canvas = useOffscreen ? new OffscreenCanvas(width, height) : Object.assign(document.createElement('canvas'), { width, height });
+    const context = canvas.getContext('2d');
+    context.fillStyle = '#ffffff';  // 透明部分（PNGなど）がJPEGで黒くならないように白で塗る
+    context.fillRect(0, 0, width, height);
+    context.imageSmoothingQuality = 'high';
+    context.drawImage(image, 0, 0, width, height);
+
+    const dataUrl = useOffscreen
+    ? await readFileAsDataUrl(await canvas.convertToBlob({ type: 'image/jpeg', quality: quality }))
+    : canvas.toDataURL('image/jpeg', quality);
+    return { dataUrl, width, height };
+} finally {
+    if (image.close) {
+    image.close();  // ImageBitmap のメモリを解放
+    }
+}
+}
+
+// 画像ファイルの読み込み
+// createImageBitmap が使えれば写真の向き（EXIF）を反映して読み込み、使えなければ img 要素で読み込みます
+function decodeImage(file) {
+if (typeof createImageBitmap === 'function') {
+    return createImageBitmap(file, { imageOrientation: 'from-image' });
+}
+return new Promise((resolve, reject) => {
+    const url = URL.createObjectURL(file);
+    const img = new Image();
+    img.onload = () => {
+    URL.revokeObjectURL(url);
+    resolve(img);
+    };
+    img.onerror = () => {
+    URL.revokeObjectURL(url);
+    reject(new Error('画像を読み込めません'));
+    };
+    img.src = url;
+});
+}
+
+// ファイル（Blob）をデータURLとして読み込みます
+function readFileAsDataUrl(blob) {
+return new Promise((resolve, reject) => {
+    const reader = new FileReader();
+    reader.onload = e => resolve(e.target.result);
+    reader.onerror = () => reject(reader.error);
+    reader.readAsDataURL(blob);
+});
+}
+
+// データURLの中身のおおよそのバイト数（Base64部分から計算）
+function dataUrlByteLength(dataUrl) {
+const base64 = dataUrl.split(',')[1] || '';
+return Math.floor(base64.length * 3 / 4);
+}
+
+// バイト数を「1.2MB」「350KB」のような表示にします
+function formatDataSize(bytes) {
+if (bytes >= 1024 * 1024) {
+    return `${(bytes / 1024 / 1024).toFixed(1)}MB`;
+}
+return `${Math.round(bytes / 1024)}KB`;
+}
+
 // 画像プレビュー表示
 // 選択した画像をプレビューエリアに表示します
 function showImagePreview(imageDataUrl, info, type) {
@@ -670,6 +772,9 @@ imagePreview.style.display = 'block';
 // 選択画像の削除
 // アップロードした画像を削除してリセットします
 function removeSelectedImage(type) {
+// 縮小中の画像があれば、その結果を使わないようにする
+imageSelectionIds[type]++;
+
 // 画像データとタイムスタンプをリセット
 if (type === 'before') {
     beforeImageData = null;
@@ -887,14 +992,32 @@ try {
         document.querySelector('.ai-analyzing span').textContent = analyzeText;
     }, 500);
     
-    const response1 = await fetch('https://kids-heat-risk-dev-865761751183.asia-northeast1.run.app', {
-        method: 'POST',
-        headers: {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json'
-        },
-        body: JSON.stringify(requestPayload)
-    });
+    // 画像がない場合はGETで呼び出し、ブラウザのHTTPキャッシュ（ETag）を活用する
+    // 同じ観測時刻・観測所・年齢グループなら再計算せずにキャッシュから表示される
+    const hasImages = Boolean(requestPayload.image_data || requestPayload.before_image);
+    let response1;
+    if (hasImages) {
+        response1 = await fetch('https://kids-heat-risk-dev-865761751183.asia-northeast1.run.app', {
+            method: 'POST',
+            headers: {
+                'Accept': 'application/json',
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(requestPayload)
+        });
+    } else {
+        const getParams = new URLSearchParams({ age_group: ageGroup, detailed: 'true' });
+        if (requestPayload.station_id) {
+            getParams.set('station_id', requestPayload.station_id);
+            getParams.set('station_name', requestPayload.station_name);
+        }
+        response1 = await fetch(`https://kids-heat-risk-dev-865761751183.asia-northeast1.run.app?${getParams.toString()}`, {
+            method: 'GET',
+            headers: {
+                'Accept': 'application/json'
+            }
+        });
+    }
     
     if (response1.ok) {
         data = await response1.json();